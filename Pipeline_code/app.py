@@ -1,36 +1,53 @@
 import streamlit as st
 import pandas as pd
-import json
 import os
 import sys
 import time
 import numpy as np
-from streamlit_image_comparison import image_comparison
 from datetime import date
-import pydeck as pdk
 
 # --- 1. SETUP & IMPORTS ---
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
 sys.path.append(CURRENT_DIR)
 
+# Only what every page needs is imported here. Detection (ultralytics / torch /
+# cv2), fetching, PDF rendering and the map widgets are imported where they are
+# used, so the dashboard and Citizen Corner never load the ML stack.
+_cold_start = "results_store" not in sys.modules
+_t_imports = time.perf_counter()
 try:
-    from report import generate_pdf
-    import fetch_pipeline
-    import detect
+    import jobs
+    import results_store
+    import dashboard_cache
+    import coord_store
+    import overlay
+    import tile_archive
+    import integrity
+    import spatial_index
+    from metrics import METRICS, peak_rss_mb
 except ImportError as e:
     st.error(f"❌ Import Error: {e}")
     st.stop()
+if _cold_start:
+    # First script run in this server process; later reruns find the modules already loaded
+    METRICS.set_gauge("app_import_s", round(time.perf_counter() - _t_imports, 3))
+    METRICS.set_gauge("app_peak_rss_mb", peak_rss_mb())
+    METRICS.write("app")
 
 # Define Paths
 DATA_PATHS = os.path.join(PARENT_DIR, "Prediction_files")
-INPUT_EXCEL_PATH = os.path.join(PARENT_DIR, "input", "coordinates.xlsx")
+INPUT_DIR = os.path.join(PARENT_DIR, "input")
 OUTPUT_IMG_DIR = os.path.join(PARENT_DIR, "output", "images")
 REQUESTS_DIR = os.path.join(PARENT_DIR, "output", "requests")
 CITIZEN_UPLOADS_DIR = os.path.join(PARENT_DIR, "output", "citizen_uploads")
 REPORT_DIR = os.path.join(PARENT_DIR, "output", "reports")
+THUMBS_PER_PAGE = 24
+NEARBY_LIMIT = 200
+JOB_POLL_S = 3          # seconds between progress polls of the batch jobs panel
+JOBS_SHOWN = 5
 
-for d in [REQUESTS_DIR, CITIZEN_UPLOADS_DIR, OUTPUT_IMG_DIR, REPORT_DIR, os.path.dirname(INPUT_EXCEL_PATH)]: 
+for d in [REQUESTS_DIR, CITIZEN_UPLOADS_DIR, OUTPUT_IMG_DIR, REPORT_DIR, INPUT_DIR]: 
     os.makedirs(d, exist_ok=True)
 
 st.set_page_config(page_title="SuryaNetra", page_icon="🛰️", layout="wide")
@@ -102,20 +119,24 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 # --- 4. HELPERS ---
-@st.cache_data
+@st.cache_resource
+def init_store():
+    # First run after upgrading: migrate the existing Prediction_files JSON into the store
+    if results_store.count() == 0: results_store.import_json_dir(DATA_PATHS)
+    return True
+
+@st.cache_resource
+def get_dashboard():
+    # Shared across sessions; refreshed with per-record deltas from the store
+    init_store()
+    return dashboard_cache.DashboardCache()
+
 def load_data():
-    data = []
-    if os.path.exists(DATA_PATHS):
-        for f in os.listdir(DATA_PATHS):
-            if f.endswith('.json'):
-                try:
-                    with open(os.path.join(DATA_PATHS, f)) as file: data.append(json.load(file))
-                except: pass
-    df = pd.DataFrame(data)
-    if not df.empty and 'sample_id' in df.columns:
-        df['sample_id'] = df['sample_id'].astype(str)
-        df = df.drop_duplicates(subset=['sample_id'], keep='last')
-    return df
+    return get_dashboard().frame()
+
+def get_record(sid):
+    data = results_store.get(sid)
+    return pd.Series(data) if data is not None else None
 
 def sanitize_json(data):
     if isinstance(data, dict): return {k: sanitize_json(v) for k, v in data.items()}
@@ -126,15 +147,15 @@ def sanitize_json(data):
     return data
 
 def save_record(data):
-    sid = data['sample_id']
-    file_path = os.path.join(DATA_PATHS, f"{sid}.json")
-    with open(file_path, 'w') as f: json.dump(sanitize_json(data), f, indent=4)
-    load_data.clear()
+    # Returns the stored copy, whose integrity_hash matches what was written
+    data = results_store.upsert(sanitize_json(data))
+    results_store.export_json(data, DATA_PATHS)
+    get_dashboard().refresh()
+    return data
 
 def update_status(sid, new_status, has_solar_bool, note=None):
-    file_path = os.path.join(DATA_PATHS, f"{sid}.json")
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f: data = json.load(f)
+    data = results_store.get(sid)
+    if data is not None:
         data['qc_status'] = new_status
         data['has_solar'] = has_solar_bool
         if note:
@@ -142,6 +163,8 @@ def update_status(sid, new_status, has_solar_bool, note=None):
             data['qc_notes'].append(note)
         save_record(data)
 
+init_store()
+
 # --- 5. SESSION STATE INIT ---
 if 'target_id' not in st.session_state: st.session_state['target_id'] = None
 if 'current_view' not in st.session_state: st.session_state['current_view'] = "Audits"
@@ -175,12 +198,12 @@ if mode == "Official Audit Portal":
         st.info("System Initialized. Run an audit to begin.")
     else:
         # METRICS
-        verified_df = df[(df['qc_status'] == 'VERIFIABLE') & (df['has_solar'] == True)]
+        m = get_dashboard().metrics()
         c1, c2, c3, c4 = st.columns(4)
-        c1.markdown(f'''<div class="metric-box"><p class="metric-value">{len(df)}</p><p class="metric-label">{L["met_sites"]}</p></div>''', unsafe_allow_html=True)
-        c2.markdown(f'''<div class="metric-box"><p class="metric-value">{(verified_df['pv_area_sqm_est'].sum() * 0.15):.1f} kW</p><p class="metric-label">{L["met_cap"]}</p></div>''', unsafe_allow_html=True)
-        c3.markdown(f'''<div class="metric-box"><p class="metric-value">{verified_df['pv_area_sqm_est'].sum():.1f} m²</p><p class="metric-label">{L["met_area"]}</p></div>''', unsafe_allow_html=True)
-        c4.markdown(f'''<div class="metric-box"><p class="metric-value">{(verified_df['pv_area_sqm_est'].sum() * 0.15 * 1.2):.1f}</p><p class="metric-label">{L["met_carbon"]} (Tons)</p></div>''', unsafe_allow_html=True)
+        c1.markdown(f'''<div class="metric-box"><p class="metric-value">{m['sites']}</p><p class="metric-label">{L["met_sites"]}</p></div>''', unsafe_allow_html=True)
+        c2.markdown(f'''<div class="metric-box"><p class="metric-value">{m['capacity_kw']:.1f} kW</p><p class="metric-label">{L["met_cap"]}</p></div>''', unsafe_allow_html=True)
+        c3.markdown(f'''<div class="metric-box"><p class="metric-value">{m['area_sqm']:.1f} m²</p><p class="metric-label">{L["met_area"]}</p></div>''', unsafe_allow_html=True)
+        c4.markdown(f'''<div class="metric-box"><p class="metric-value">{m['carbon_tons']:.1f}</p><p class="metric-label">{L["met_carbon"]} (Tons)</p></div>''', unsafe_allow_html=True)
         st.write("") 
 
     nav_c1, nav_c2, nav_c3 = st.columns(3)
@@ -199,6 +222,56 @@ if mode == "Official Audit Portal":
             view_df['sort_key'] = view_df['qc_status'].apply(lambda x: 0 if 'PENDING' in x else 1)
             view_df = view_df.sort_values('sort_key')
             st.dataframe(view_df[['sample_id', 'qc_status', 'has_solar', 'pv_area_sqm_est', 'confidence']], use_container_width=True)
+            
+            with st.expander("🖼️ Overlay Thumbnails"):
+                thumbs = [(sid, overlay.ensure_thumbnail(sid)) for sid in view_df['sample_id'].head(THUMBS_PER_PAGE)]
+                thumbs = [(sid, p) for sid, p in thumbs if p]
+                if thumbs: st.image([p for _, p in thumbs], caption=[sid for sid, _ in thumbs])
+                else: st.write("No overlays available.")
+            
+            with st.expander("🗺️ Site Map"):
+                c_lat, c_lon, c_zoom = st.columns(3)
+                map_lat = c_lat.number_input("Centre Lat", value=float(df['lat'].median()), format="%.4f")
+                map_lon = c_lon.number_input("Centre Lon", value=float(df['lon'].median()), format="%.4f")
+                map_zoom = c_zoom.slider("Zoom", 4, 19, 12)
+                import pydeck as pdk
+                kind, rows = spatial_index.viewport(map_lat, map_lon, map_zoom)
+                frame = pd.DataFrame(rows)
+                if kind == "bins":
+                    layer = pdk.Layer("ScatterplotLayer", data=frame, get_position=["lon", "lat"], get_radius="radius",
+                                      get_fill_color=[255, 140, 0, 160], pickable=True)
+                    tooltip = {"text": "{sites} sites, {solar} verified solar"}
+                    st.caption(f"{int(frame['sites'].sum()) if not frame.empty else 0} sites in view, grouped into {len(frame)} cells — zoom in for individual sites")
+                else:
+                    if not frame.empty: frame['color'] = [[0, 200, 0] if s else [200, 0, 0] for s in frame['has_solar']]
+                    layer = pdk.Layer("ScatterplotLayer", data=frame, get_position=["lon", "lat"], get_fill_color="color",
+                                      get_radius=6, radius_min_pixels=3, pickable=True)
+                    tooltip = {"text": "{sample_id}: {qc_status}"}
+                    st.caption(f"{len(frame)} sites in view")
+                st.pydeck_chart(pdk.Deck(layers=[layer], tooltip=tooltip,
+                                         initial_view_state=pdk.ViewState(latitude=map_lat, longitude=map_lon, zoom=map_zoom)))
+                
+                radius_m = st.number_input("Find sites within (m) of the centre", value=500, min_value=10, step=100)
+                near = spatial_index.query_radius(map_lat, map_lon, radius_m, limit=NEARBY_LIMIT)
+                if near:
+                    st.dataframe(pd.DataFrame(near)[['sample_id', 'distance_m', 'qc_status', 'has_solar']], use_container_width=True)
+                    pick = st.selectbox("Site", [r['sample_id'] for r in near])
+                    if st.button("🔍 Inspect Site"):
+                        st.session_state['target_id'] = pick
+                        st.session_state['current_view'] = "Inspection"; st.rerun()
+                else: st.write("No sites in range.")
+            
+            with st.expander("📦 Bulk Certificate Export"):
+                solar_only = st.checkbox("Verified solar sites only", value=True)
+                if st.button("Build ZIP"):
+                    from report import export_reports
+                    zip_path = os.path.join(REPORT_DIR, "certificates.zip")
+                    records = (r for r in results_store.iter_records()
+                               if not solar_only or (r.get('qc_status') == 'VERIFIABLE' and r.get('has_solar')))
+                    with st.spinner("Rendering certificates..."):
+                        stats = export_reports(records, zip_path)
+                    st.success(f"✅ {stats['rendered']} rendered, {stats['reused']} unchanged, {len(stats['failed'])} failed")
+                    with open(zip_path, "rb") as f: st.download_button("⬇️ Download ZIP", f, file_name="certificates.zip")
         else: st.write("No data in queue.")
 
     # VIEW 2: INSPECTION
@@ -214,7 +287,7 @@ if mode == "Official Audit Portal":
             if selected_id != st.session_state['target_id']: st.session_state['target_id'] = selected_id
 
             if selected_id:
-                rec = df[df['sample_id'] == selected_id].iloc[0]
+                rec = get_record(selected_id)
                 status = rec['qc_status']
                 
                 # STATUS BANDS
@@ -234,17 +307,26 @@ if mode == "Official Audit Portal":
                 c_img, c_map = st.columns([2, 1])
                 with c_img:
                     st.subheader("👁️ AI Analysis")
-                    img_raw = os.path.join(OUTPUT_IMG_DIR, f"{selected_id}.png")
-                    img_audit = os.path.join(PARENT_DIR, "output", "audits", f"{selected_id}_audit.jpg")
-                    if os.path.exists(img_raw) and os.path.exists(img_audit):
+                    from streamlit_image_comparison import image_comparison
+                    img_raw = tile_archive.find(selected_id, OUTPUT_IMG_DIR)
+                    if tile_archive.is_ref(img_raw):
+                        from PIL import Image
+                        from io import BytesIO
+                        img_raw = Image.open(BytesIO(tile_archive.read_bytes(img_raw)))
+                    img_audit = overlay.ensure_overlay(selected_id)
+                    if img_raw is not None and img_audit:
                         image_comparison(img1=img_raw, img2=img_audit, label1="Raw", label2="AI Overlay", width=800)
                     else: st.warning("Images missing.")
                 
                 with c_map:
                     st.subheader("📍 Location")
+                    import pydeck as pdk
                     view_state = pdk.ViewState(latitude=rec['lat'], longitude=rec['lon'], zoom=19)
                     layer = pdk.Layer("ScatterplotLayer", data=pd.DataFrame([rec]), get_position=["lon", "lat"], get_fill_color=[0, 0, 255], get_radius=5)
-                    st.pydeck_chart(pdk.Deck(layers=[layer], initial_view_state=view_state))
+                    neighbours = [n for n in spatial_index.query_radius(rec['lat'], rec['lon'], 150) if n['sample_id'] != selected_id]
+                    near_layer = pdk.Layer("ScatterplotLayer", data=pd.DataFrame(neighbours), get_position=["lon", "lat"],
+                                           get_fill_color=[150, 150, 150], get_radius=3, pickable=True)
+                    st.pydeck_chart(pdk.Deck(layers=[near_layer, layer], initial_view_state=view_state, tooltip={"text": "{sample_id}"}))
                     
                     # --- ACTION BLOCK (STRICT SEPARATION) ---
                     proof_path = os.path.join(CITIZEN_UPLOADS_DIR, f"{selected_id}_proof.jpg")
@@ -313,8 +395,9 @@ if mode == "Official Audit Portal":
                         updated_rec['pv_area_sqm_est'] = new_area
                         updated_rec['confidence'] = new_conf
                         updated_rec['qc_notes'] = [n.strip() for n in new_notes.split(',')]
-                        save_record(updated_rec)
+                        updated_rec = save_record(updated_rec)
                         pdf_path = os.path.join(REPORT_DIR, f"{selected_id}_audit.pdf")
+                        from report import generate_pdf
                         generate_pdf(updated_rec, pdf_path)
                         st.session_state['target_id'] = selected_id
                         st.session_state['current_view'] = "Inspection"
@@ -341,6 +424,10 @@ if mode == "Official Audit Portal":
                     if os.path.exists(pdf_path):
                         with open(pdf_path, "rb") as f: st.download_button("⬇️ Download PDF", f, file_name=f"{selected_id}_audit.pdf")
                 with st.expander("View System JSON"): st.json(sanitize_json(rec.to_dict()))
+                with st.expander("🔐 Integrity Proof"):
+                    prf = integrity.proof(results_store.connect(), selected_id)
+                    if prf: st.caption("✅ Proof verifies against the current root" if integrity.verify_proof(results_store.get(selected_id), prf) else "❌ Record does not match its proof")
+                    st.json(prf or {})
 
     elif st.session_state['current_view'] == "New":
         c_single, c_batch = st.columns(2)
@@ -352,36 +439,57 @@ if mode == "Official Audit Portal":
             sid = st.text_input("ID", value=st.session_state['session_id'])
             if st.button("Audit"):
                 with st.spinner("Analyzing..."):
+                    # Imported here so only an actual audit loads the detection stack
+                    import fetch_pipeline
+                    import inference_server
                     fetch_pipeline.fetch_satellite_image(slat, slon, sid, OUTPUT_IMG_DIR)
-                    if os.path.exists(INPUT_EXCEL_PATH): df_c = pd.read_excel(INPUT_EXCEL_PATH)
-                    else: df_c = pd.DataFrame(columns=['sample_id','latitude','longitude'])
-                    new_row = {'sample_id': sid, 'latitude': slat, 'longitude': slon}
-                    df_c = pd.concat([df_c[df_c['sample_id'].astype(str) != sid], pd.DataFrame([new_row])], ignore_index=True)
-                    df_c.to_excel(INPUT_EXCEL_PATH, index=False)
-                    detect.run_pipeline()
+                    coord_store.add_site(sid, slat, slon)
+                    inference_server.run_detection([sid])
                 st.session_state['target_id'] = sid
                 st.session_state['current_view'] = "Inspection"
-                load_data.clear()
                 st.success("Run Complete!")
                 st.rerun()
 
         with c_batch:
             st.subheader("Batch")
-            up = st.file_uploader("Upload Excel", type=['xlsx'])
+            up = st.file_uploader("Upload Coordinates", type=['xlsx', 'csv', 'parquet'])
             if up and st.button("Start"):
-                with open(INPUT_EXCEL_PATH, "wb") as f: f.write(up.getbuffer())
-                df_up = pd.read_excel(INPUT_EXCEL_PATH)
-                bar = st.progress(0)
-                for i, row in df_up.iterrows():
-                    fetch_pipeline.fetch_satellite_image(row['latitude'], row['longitude'], str(row['sample_id']), OUTPUT_IMG_DIR)
-                    bar.progress((i+1)/len(df_up)*0.5)
-                detect.run_pipeline()
-                bar.progress(1.0)
-                load_data.clear()
-                if not df_up.empty: st.session_state['target_id'] = str(df_up.iloc[0]['sample_id'])
-                st.session_state['current_view'] = "Inspection"
-                st.success("Batch Complete!")
-                st.rerun()
+                upload_path = os.path.join(INPUT_DIR, f"batch_{int(time.time())}{os.path.splitext(up.name)[1].lower()}")
+                with open(upload_path, "wb") as f: f.write(up.getbuffer())
+                try:
+                    coord_store.ingest(upload_path)
+                except (OSError, ValueError, ImportError) as e:
+                    st.error(f"❌ Could not read {up.name}: {e}")
+                else:
+                    # Runs in a separate worker process, so it survives closing the tab
+                    job_id = jobs.submit(coord_store.iter_sites(source=upload_path), source=upload_path)
+                    st.success(f"Queued {job_id}")
+
+            def jobs_panel():
+                # Also restarts a worker for queued or orphaned jobs (crashed worker, server restart)
+                jobs.ensure_worker()
+                for job in jobs.recent(JOBS_SHOWN):
+                    done, total = job['finished_sites'], max(job['total'], 1)
+                    counts = job['sites']
+                    st.markdown(f"**{job['job_id']}** · {job['status']}")
+                    st.progress(min(done / total, 1.0), text=f"{done}/{job['total']} · {counts['done']} audited, {counts['skipped']} unchanged, {counts['failed']} failed")
+                    jc1, jc2 = st.columns(2)
+                    if job['status'] in ("queued", "running") and jc1.button("Cancel", key=f"cancel_{job['job_id']}"):
+                        jobs.cancel(job['job_id']); st.rerun()
+                    if job['status'] in ("done", "cancelled") and jc1.button("Inspect", key=f"inspect_{job['job_id']}"):
+                        first = jobs.sites_in(job['job_id'], "done", 1) or jobs.sites_in(job['job_id'], "skipped", 1)
+                        if first: st.session_state['target_id'] = first[0][0]
+                        st.session_state['current_view'] = "Inspection"; st.rerun()
+                    if counts['failed']:
+                        with jc2.expander(f"⚠️ {counts['failed']} failed"):
+                            for fsid, err in jobs.sites_in(job['job_id'], "failed", 10): st.caption(f"{fsid}: {err}")
+
+            st.markdown("##### Jobs")
+            if hasattr(st, "fragment"):
+                st.fragment(run_every=JOB_POLL_S)(jobs_panel)()
+            else:
+                if st.button("🔄 Refresh"): st.rerun()
+                jobs_panel()
 
 # ==========================================
 # MODE 2: CITIZEN
@@ -391,16 +499,16 @@ elif mode == "Citizen Corner":
     cid = st.text_input("Consumer ID")
     
     if cid:
-        df = load_data()
-        if not df.empty and cid in df['sample_id'].values:
-            rec = df[df['sample_id'] == cid].iloc[0]
+        rec = get_record(cid)
+        if rec is not None:
             status = rec.get('qc_status', 'NOT_VERIFIABLE')
             
             if status == "VERIFIABLE" and rec['has_solar']:
                 st.balloons()
                 st.success(f"✅ VERIFIED SOLAR")
                 pdf_path = os.path.join(REPORT_DIR, f"{cid}_audit.pdf")
-                if not os.path.exists(pdf_path): generate_pdf(rec.to_dict(), pdf_path)
+                from report import ensure_pdf
+                ensure_pdf(sanitize_json(rec.to_dict()), pdf_path)
                 st.markdown("### 📄 Official Documents")
                 with open(pdf_path, "rb") as f: st.download_button("⬇️ Download Certificate", f, file_name=f"{cid}_certificate.pdf", type="primary")
 
@@ -423,7 +531,8 @@ elif mode == "Citizen Corner":
                 st.error(f"❌ NOT VERIFIABLE")
                 st.write(f"Reason: {rec.get('qc_notes', ['Unknown'])[0]}")
                 pdf_path = os.path.join(REPORT_DIR, f"{cid}_audit.pdf")
-                if not os.path.exists(pdf_path): generate_pdf(rec.to_dict(), pdf_path)
+                from report import ensure_pdf
+                ensure_pdf(sanitize_json(rec.to_dict()), pdf_path)
                 with open(pdf_path, "rb") as f: st.download_button("⬇️ Download Report", f, file_name=f"{cid}_report.pdf")
                 
                 with st.expander("File Appeal"):
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+
+import cv2
+import numpy as np
+
+import tile_archive
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.path.join(BASE_DIR, "Trained_model_file")
+TORCH_PATH = os.path.join(MODEL_DIR, "best.pt")
+ONNX_PATH = os.path.join(MODEL_DIR, "best.onnx")
+INT8_PATH = os.path.join(MODEL_DIR, "best.int8.onnx")
+REPORT_DIR = os.path.join(BASE_DIR, "output", "metrics")
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_THREADS = int(os.environ.get("SURYANETRA_ONNX_THREADS", 0))   # intra-op threads; 0 lets onnxruntime use every core
+IMGSZ = 640               # export / letterbox size (dynamic exports also accept the 1280 shared tiles)
+NMS_IOU = 0.7             # ultralytics' default, so the ONNX path keeps the same boxes as predict()
+MAX_DET = 300
+CALIB_TILES = 200         # tiles run through the float model to calibrate INT8 activation ranges
+PARITY_IOU = 0.5          # a box counts as reproduced when the other backend has one at this IoU
+
+# --- RESULTS (the slice of the ultralytics Results surface detect.predict_batch reads) ---
+class _Arr:
+    def __init__(self, a): self.a = a
+    def cpu(self): return self
+    def numpy(self): return self.a
+
+class _Boxes:
+    def __init__(self, xyxy, conf): self.xyxy, self.conf = _Arr(xyxy), _Arr(conf)
+    def __len__(self): return len(self.conf.a)
+
+class _Result:
+    def __init__(self, xyxy, conf): self.boxes = _Boxes(xyxy, conf)
+
+# --- ONNX RUNTIME ---
+def letterbox(img, size):
+    """
+    Resize-and-pad to a size x size NCHW float blob the way ultralytics does.
+    Returns (blob, (ratio, pad_x, pad_y)).
+    """
+    h, w = img.shape[:2]
+    r = min(size / h, size / w)
+    nw, nh = int(round(w * r)), int(round(h * r))
+    if (nw, nh) != (w, h): img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    px, py = (size - nw) / 2, (size - nh) / 2
+    top, left = int(round(py - 0.1)), int(round(px - 0.1))
+    img = cv2.copyMakeBorder(img, top, size - nh - top, left, size - nw - left, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    blob = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+    return blob, (r, left, top)
+
+def nms(boxes, scores, iou):
+    order, keep = scores.argsort()[::-1], []
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    while order.size and len(keep) < MAX_DET:
+        i = order[0]
+        keep.append(i)
+        xx1, yy1 = np.maximum(boxes[i, 0], boxes[order[1:], 0]), np.maximum(boxes[i, 1], boxes[order[1:], 1])
+        xx2, yy2 = np.minimum(boxes[i, 2], boxes[order[1:], 2]), np.minimum(boxes[i, 3], boxes[order[1:], 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        order = order[1:][inter / (areas[i] + areas[order[1:]] - inter + 1e-9) <= iou]
+    return np.array(keep, dtype=np.int64)
+
+def postprocess(pred, conf, iou, meta, shape):
+    """
+    Raw YOLO head output (4 + classes, anchors) for one image -> (xyxy, conf) in tile pixels.
+    """
+    pred = pred.T
+    scores, cls = pred[:, 4:].max(axis=1), pred[:, 4:].argmax(axis=1)
+    keep = scores >= conf
+    pred, scores, cls = pred[keep], scores[keep], cls[keep]
+    if not len(pred): return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+    cx, cy, bw, bh = pred[:, 0], pred[:, 1], pred[:, 2], pred[:, 3]
+    boxes = np.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], axis=1)
+    # Class-aware NMS by pushing each class into its own coordinate range
+    keep = nms(boxes + cls[:, None] * 7680.0, scores, iou)
+    r, left, top = meta
+    boxes = (boxes[keep] - np.array([left, top, left, top], dtype=np.float32)) / r
+    h, w = shape
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    return boxes.astype(np.float32), scores[keep].astype(np.float32)
+
+class OnnxDetector:
+    """
+    onnxruntime CPU session behind the call surface detect.predict_batch uses
+    (model(imgs, conf=..., imgsz=...) -> results with .boxes.xyxy / .boxes.conf).
+    """
+    def __init__(self, path, threads=ONNX_THREADS):
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = int(threads)
+            opts.inter_op_num_threads = 1
+        self.path = path
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        # Static exports pin batch and size; dynamic ones take what the caller asks for
+        self.fixed_batch = inp.shape[0] if isinstance(inp.shape[0], int) else None
+        self.fixed_size = inp.shape[2] if isinstance(inp.shape[2], int) else None
+
+    def __call__(self, imgs, conf=0.25, imgsz=None, iou=NMS_IOU, **kwargs):
+        imgs = imgs if isinstance(imgs, list) else [imgs]
+        size = self.fixed_size or imgsz or IMGSZ
+        prepped = [letterbox(img, size) for img in imgs]
+        step = self.fixed_batch or len(prepped)
+        preds = []
+        for i in range(0, len(prepped), step):
+            blob = np.concatenate([b for b, _ in prepped[i:i + step]])
+            preds.extend(self.session.run(None, {self.input_name: blob})[0])
+        return [_Result(*postprocess(p, conf, iou, meta, img.shape[:2])) for p, (_, meta), img in zip(preds, prepped, imgs)]
+
+# --- LOADING ---
+def model_path(backend):
+    if backend not in BACKENDS: raise ValueError(f"unknown backend {backend!r} (expected one of {BACKENDS})")
+    return {"torch": TORCH_PATH, "onnx": ONNX_PATH, "onnx-int8": INT8_PATH}[backend]
+
+def load_model(backend="torch", path=None, threads=None):
+    """
+    Detector for the given backend. threads caps the CPU threads it uses
+    (torch.set_num_threads for torch, intra-op threads for onnxruntime).
+    """
+    path = path or model_path(backend)
+    if backend == "torch":
+        from ultralytics import YOLO
+        if threads:
+            try:
+                import torch
+                torch.set_num_threads(int(threads))
+            except ImportError: pass
+        return YOLO(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; run `python Pipeline_code/backends.py export{' --int8' if backend == 'onnx-int8' else ''}`")
+    return OnnxDetector(path, ONNX_THREADS if threads is None else threads)
+
+# --- EXPORT / QUANTIZATION ---
+def export_onnx(src=TORCH_PATH, dst=ONNX_PATH, imgsz=IMGSZ):
+    """
+    Exports best.pt to ONNX with dynamic batch and image size.
+    """
+    from ultralytics import YOLO
+    out = YOLO(src).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+    if os.path.abspath(out) != os.path.abspath(dst): os.replace(out, dst)
+    return dst
+
+def reference_tiles(img_dir=None, limit=None):
+    """
+    Tile references for calibration and parity: a directory of PNG/JPGs, or
+    everything in the tile archive plus detect.IMG_DIR. Spread evenly when limited.
+    """
+    if img_dir: refs = [os.path.join(img_dir, f) for f in sorted(os.listdir(img_dir)) if f.lower().endswith(('.png', '.jpg'))]
+    else:
+        import detect
+        files = {}
+        if os.path.isdir(detect.IMG_DIR):
+            files = {os.path.splitext(f)[0]: os.path.join(detect.IMG_DIR, f) for f in os.listdir(detect.IMG_DIR) if f.lower().endswith(('.png', '.jpg'))}
+        files.update({sid: tile_archive.ref_for(sid) for sid in tile_archive.ARCHIVE.ids()})
+        refs = [files[sid] for sid in sorted(files)]
+    if limit and len(refs) > limit: refs = [refs[int(i * len(refs) / limit)] for i in range(limit)]
+    return refs
+
+def quantize_int8(src=ONNX_PATH, dst=INT8_PATH, refs=None, imgsz=IMGSZ):
+    """
+    Static INT8 quantization (QDQ, per-channel weights) with activation ranges
+    calibrated on our own tiles.
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    refs = refs if refs is not None else reference_tiles(limit=CALIB_TILES)
+    if not refs: raise RuntimeError("no tiles to calibrate on")
+    input_name = ort.InferenceSession(src, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+
+    class TileReader(CalibrationDataReader):
+        def __init__(self): self.it = iter(refs)
+        def get_next(self):
+            for ref in self.it:
+                img = tile_archive.imread(ref)
+                if img is not None: return {input_name: letterbox(img, imgsz)[0]}
+            return None
+
+    prepped = dst + ".prep.onnx"
+    quant_pre_process(src, prepped)
+    try:
+        quantize_static(prepped, dst, TileReader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+    finally:
+        if os.path.exists(prepped): os.remove(prepped)
+    return dst
+
+# --- PARITY ---
+def box_iou(a, b):
+    tl, br = np.maximum(a[:, None, :2], b[None, :, :2]), np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area = lambda x: (x[:, 2] - x[:, 0]) * (x[:, 3] - x[:, 1])
+    return inter / (area(a)[:, None] + area(b)[None, :] - inter + 1e-9)
+
+def match_boxes(a, b, thr=PARITY_IOU):
+    """
+    Greedy one-to-one matching by IoU. Returns [(i, j, iou)].
+    """
+    if not len(a) or not len(b): return []
+    iou = box_iou(a, b)
+    pairs, used_a, used_b = [], set(), set()
+    for i, j in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+        if iou[i, j] < thr: break
+        if i in used_a or j in used_b: continue
+        used_a.add(i); used_b.add(j)
+        pairs.append((int(i), int(j), float(iou[i, j])))
+    return pairs
+
+def parity(backend, refs, threads=None, path=REPORT_DIR):
+    """
+    Runs the PyTorch model and `backend` over the same tiles and compares boxes,
+    confidences and the final has_solar / buffer_radius_sqft decisions.
+    Writes output/metrics/parity_<backend>.json and returns the report.
+    """
+    import detect
+    import quality_gate
+    ref_model, cand = load_model("torch", detect.MODEL_PATH, threads), load_model(backend, threads=threads)
+    sids = [r[len(tile_archive.REF_PREFIX):] if tile_archive.is_ref(r) else os.path.splitext(os.path.basename(r))[0] for r in refs]
+    coords = detect.load_coord_map(sids)
+    n = n_ref = n_cand = n_match = solar_ok = buffer_ok = 0
+    ious, dconf, mismatches, times = [], [], [], {"torch": 0.0, backend: 0.0}
+    for sid, ref in zip(sids, refs):
+        img = tile_archive.imread(ref)
+        if img is None: continue
+        site = coords.get(sid, {'lat': 20.5937, 'lon': 78.9629})
+        usable, _, note, _ = quality_gate.assess(img, detect.QUALITY_THRESHOLDS)
+        out, recs = {}, {}
+        for name, model in (("torch", ref_model), (backend, cand)):
+            t0 = time.perf_counter()
+            out[name] = detect.predict_batch(model, [img])[0]
+            times[name] += time.perf_counter() - t0
+            h, w = img.shape[:2]
+            candidates, geo = detect.filter_candidates(*out[name], w, h, detect.get_meters_per_pixel(site['lat']))
+            recs[name] = detect.build_record(sid, site, usable, note, candidates, geo)
+        (xa, ca), (xb, cb) = out["torch"], out[backend]
+        pairs = match_boxes(xa, xb)
+        n += 1; n_ref += len(xa); n_cand += len(xb); n_match += len(pairs)
+        ious += [p[2] for p in pairs]
+        dconf += [abs(float(ca[i]) - float(cb[j])) for i, j, _ in pairs]
+        a, b = recs["torch"], recs[backend]
+        solar_ok += a['has_solar'] == b['has_solar']
+        buffer_ok += a['buffer_radius_sqft'] == b['buffer_radius_sqft']
+        if (a['has_solar'], a['buffer_radius_sqft']) != (b['has_solar'], b['buffer_radius_sqft']):
+            mismatches.append({"sample_id": sid, "torch": [a['has_solar'], a['buffer_radius_sqft']],
+                               backend: [b['has_solar'], b['buffer_radius_sqft']]})
+    report = {
+        "backend": backend, "model": model_path(backend), "threads": threads or ONNX_THREADS, "tiles": n,
+        "boxes_torch": n_ref, f"boxes_{backend}": n_cand, "boxes_matched": n_match,
+        "box_recall": round(n_match / n_ref, 4) if n_ref else 1.0,
+        "box_precision": round(n_match / n_cand, 4) if n_cand else 1.0,
+        "mean_iou": round(float(np.mean(ious)), 4) if ious else None,
+        "conf_mae": round(float(np.mean(dconf)), 4) if dconf else None,
+        "conf_max_abs": round(float(np.max(dconf)), 4) if dconf else None,
+        "has_solar_agreement": round(solar_ok / n, 4) if n else None,
+        "buffer_agreement": round(buffer_ok / n, 4) if n else None,
+        "decision_mismatches": mismatches,
+        "ms_per_tile": {k: round(v / n * 1000, 2) if n else None for k, v in times.items()},
+        "speedup": round(times["torch"] / times[backend], 2) if n and times[backend] else None,
+    }
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f"parity_{backend}.json"), "w") as f: json.dump(report, f, indent=1)
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="ONNX / INT8 inference backends for best.pt")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export", help="Export best.pt to ONNX (and optionally an INT8 variant)")
+    p_exp.add_argument("--int8", action="store_true", help="Also write best.int8.onnx calibrated on our tiles")
+    p_exp.add_argument("--calib-dir", default=None, help="Calibrate on this directory instead of the archive / output/images")
+    p_exp.add_argument("--calib-tiles", type=int, default=CALIB_TILES)
+    p_par = sub.add_parser("parity", help="Compare a backend against the PyTorch model")
+    p_par.add_argument("--backend", default="onnx", choices=BACKENDS[1:])
+    p_par.add_argument("--dir", default=None, help="Reference tiles (default: archive + output/images)")
+    p_par.add_argument("--limit", type=int, default=200)
+    p_par.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.cmd == "export":
+        print(f"✅ {export_onnx()}")
+        if args.int8:
+            refs = reference_tiles(args.calib_dir, args.calib_tiles)
+            print(f"✅ {quantize_int8(refs=refs)} (calibrated on {len(refs)} tiles)")
+    elif args.cmd == "parity":
+        report = parity(args.backend, reference_tiles(args.dir, args.limit), args.threads)
+        print(json.dumps({k: v for k, v in report.items() if k != "decision_mismatches"}, indent=1))
+        for m in report["decision_mismatches"][:20]: print(f"   ⚠️ {m}")
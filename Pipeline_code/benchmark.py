@@ -0,0 +1,369 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(CURRENT_DIR)
+sys.path.append(CURRENT_DIR)
+from metrics import peak_rss_mb
+
+BENCH_DIR = os.path.join(BASE_DIR, "output", "benchmarks")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+BENCHMARKS = ["fetch", "detect", "load_data", "report", "startup"]
+
+# A run regresses if throughput drops or p99 latency grows by more than this fraction
+THROUGHPUT_TOLERANCE = 0.15
+LATENCY_TOLERANCE = 0.25
+RSS_TOLERANCE = 0.25      # ... or peak RSS grows by more than this fraction (startup benchmark)
+
+# Modules each portal page imports on a cold script run (keep in step with app.py),
+# and the ones that must not come along with them
+STARTUP_PATHS = {
+    "dashboard": ["streamlit", "pandas", "jobs", "results_store", "dashboard_cache", "coord_store", "overlay",
+                  "tile_archive", "integrity", "spatial_index", "metrics", "pydeck"],
+    "citizen": ["streamlit", "pandas", "jobs", "results_store", "dashboard_cache", "coord_store", "overlay",
+                "tile_archive", "integrity", "spatial_index", "metrics", "report"],
+}
+HEAVY_MODULES = ["detect", "ultralytics", "torch", "onnxruntime", "cv2"]
+STARTUP_REPEATS = 5
+
+# --- SYNTHETIC DATA ---
+def make_tile(rng, size=640):
+    """
+    Rooftop-like tile: textured ground, a few roofs, and sometimes dark-blue panel arrays near the centre.
+    """
+    import cv2
+    tile = rng.integers(70, 130, (size, size, 3), dtype=np.uint8)
+    for _ in range(rng.integers(3, 8)):
+        x, y = rng.integers(0, size - 120, 2)
+        w, h = rng.integers(60, 200, 2)
+        cv2.rectangle(tile, (int(x), int(y)), (int(x + w), int(y + h)), tuple(int(v) for v in rng.integers(140, 220, 3)), -1)
+    if rng.random() < 0.5:
+        c = size // 2
+        for _ in range(rng.integers(1, 4)):
+            x, y = c + rng.integers(-80, 60, 2)
+            cv2.rectangle(tile, (int(x), int(y)), (int(x + rng.integers(20, 60)), int(y + rng.integers(15, 40))), (120, 40, 20), -1)
+    return tile
+
+def make_workspace(root, n_sites, unique_tiles=200, seed=0):
+    """
+    Writes n_sites tiles (hardlinked from a pool of unique ones) plus coordinates.xlsx/.csv.
+    """
+    import cv2
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    img_dir = os.path.join(root, "images")
+    pool_dir = os.path.join(root, "pool")
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(pool_dir, exist_ok=True)
+    pool = []
+    for i in range(min(unique_tiles, n_sites)):
+        path = os.path.join(pool_dir, f"tile_{i}.png")
+        cv2.imwrite(path, make_tile(rng))
+        pool.append(path)
+    sids = [f"bench_{i:06d}" for i in range(n_sites)]
+    for i, sid in enumerate(sids):
+        dest = os.path.join(img_dir, f"{sid}.png")
+        try: os.link(pool[i % len(pool)], dest)
+        except OSError: shutil.copyfile(pool[i % len(pool)], dest)
+    df = pd.DataFrame({"sample_id": sids,
+                       "latitude": rng.uniform(8.0, 32.0, n_sites).round(6),
+                       "longitude": rng.uniform(70.0, 90.0, n_sites).round(6)})
+    df.to_csv(os.path.join(root, "coordinates.csv"), index=False)
+    df.to_excel(os.path.join(root, "coordinates.xlsx"), index=False)
+    # Placeholder weights so model hashing works without best.pt
+    with open(os.path.join(root, "stub.pt"), "wb") as f: f.write(b"stub-detector")
+    return sids
+
+# --- STUB DETECTOR (ultralytics-compatible surface used by detect.predict_batch) ---
+class _Arr:
+    def __init__(self, a): self.a = a
+    def cpu(self): return self
+    def numpy(self): return self.a
+
+class _Boxes:
+    def __init__(self, xyxy, conf): self.xyxy, self.conf = _Arr(xyxy), _Arr(conf)
+    def __len__(self): return len(self.conf.a)
+
+class _Result:
+    def __init__(self, xyxy, conf): self.boxes = _Boxes(xyxy, conf)
+
+class StubDetector:
+    """
+    CPU-cheap stand-in for YOLO: finds dark-blue blobs with connected components.
+    """
+    def __call__(self, imgs, **kwargs):
+        import cv2
+        out = []
+        for img in (imgs if isinstance(imgs, list) else [imgs]):
+            mask = cv2.inRange(img, (100, 20, 0), (140, 60, 40))
+            n, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+            boxes = [[x, y, x + w, y + h] for x, y, w, h, area in stats[1:] if area > 50]
+            xyxy = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+            out.append(_Result(xyxy, np.full(len(xyxy), 0.8, dtype=np.float32)))
+        return out
+
+# --- STUB TILE SERVER ---
+class _TileHandler(BaseHTTPRequestHandler):
+    payload = b""
+    delay_s = 0.0
+    def do_GET(self):
+        if self.delay_s: time.sleep(self.delay_s)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+    def log_message(self, *args): pass
+
+def start_stub_server(payload, delay_s=0.0):
+    handler = type("Handler", (_TileHandler,), {"payload": payload, "delay_s": delay_s})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/staticmap"
+
+# --- MEASUREMENT ---
+def summarize(name, n_items, wall_s, latencies_s, extra=None):
+    lat = np.array(latencies_s) * 1000 if latencies_s else np.zeros(1)
+    res = {"benchmark": name, "items": n_items, "wall_s": round(wall_s, 3),
+           "throughput_per_s": round(n_items / wall_s, 2) if wall_s > 0 else None,
+           "p50_ms": round(float(np.percentile(lat, 50)), 2), "p99_ms": round(float(np.percentile(lat, 99)), 2),
+           "peak_rss_mb": peak_rss_mb()}
+    if extra: res.update(extra)
+    return res
+
+def timed(fn, sink):
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try: return fn(*args, **kwargs)
+        finally: sink.append(time.perf_counter() - t0)
+    return wrapper
+
+def point_detect_at(root, stub_model=True):
+    """
+    Redirects detect/results_store module paths into a benchmark workspace.
+    """
+    import detect
+    import results_store
+    import coord_store
+    import overlay
+    import tile_archive
+    import fetch_planner
+    detect.IMG_DIR = os.path.join(root, "images")
+    detect.JSON_OUT_DIR = os.path.join(root, "json")
+    overlay.AUDIT_DIR = os.path.join(root, "audits")
+    overlay.THUMB_DIR = os.path.join(root, "audits", "thumbs")
+    detect.COORD_FILE = os.path.join(root, "coordinates.csv")
+    detect.MANIFEST_PATH = os.path.join(root, "manifest.json")
+    if stub_model: detect.MODEL_PATH = os.path.join(root, "stub.pt")
+    results_store.DB_PATH = os.path.join(root, "results.db")
+    coord_store.DB_PATH = os.path.join(root, "coordinates.db")
+    tile_archive.ARCHIVE = tile_archive.TileArchive(os.path.join(root, "tiles"))
+    fetch_planner.PLAN_PATH = os.path.join(root, "fetch_plan.db")
+    return detect
+
+# --- BENCHMARKS ---
+def bench_detect(root, n_sites, batch_size=8, real_model=False):
+    from metrics import METRICS
+    detect = point_detect_at(root, stub_model=not real_model)
+    if not real_model: detect.load_model = lambda threads=None: StubDetector()
+    METRICS.reset()
+    t0 = time.perf_counter()
+    done = detect.run_pipeline(force=True, batch_size=batch_size)
+    wall = time.perf_counter() - t0
+    snap = METRICS.snapshot(include_sites=True)
+    per_site = [sum(stages.values()) for stages in snap["sites"].values()]
+    stage_totals = {k: v["total_s"] for k, v in snap["spans"].items()}
+    return summarize("detect", len(done), wall, per_site, {"stage_total_s": stage_totals, "batch_size": batch_size})
+
+def bench_fetch(root, n_sites, workers=16, delay_s=0.02):
+    import cv2
+    import fetch_pipeline
+    import tile_archive
+    tile_archive.ARCHIVE = tile_archive.TileArchive(os.path.join(root, "fetched_tiles"))
+    ok, buf = cv2.imencode(".png", make_tile(np.random.default_rng(1)))
+    server, url = start_stub_server(buf.tobytes(), delay_s)
+    fetch_pipeline.API_KEY = "benchmark"
+    lat = []
+    fetch_pipeline.download_tile = timed(fetch_pipeline.download_tile, lat)
+    rng = np.random.default_rng(2)
+    sites = [(float(a), float(b), f"fetch_{i}") for i, (a, b) in enumerate(zip(rng.uniform(8, 32, n_sites), rng.uniform(70, 90, n_sites)))]
+    try:
+        t0 = time.perf_counter()
+        res = fetch_pipeline.fetch_many(sites, os.path.join(root, "fetched"), max_workers=workers,
+                                        rate=10 ** 6, base_url=url, use_cache=False)
+        wall = time.perf_counter() - t0
+    finally:
+        server.shutdown()
+    errors = sum(1 for r in res.values() if r["error"])
+    return summarize("fetch", n_sites, wall, lat, {"errors": errors, "workers": workers, "server_delay_s": delay_s})
+
+def bench_load_data(root, n_sites, repeats=5):
+    import results_store
+    import dashboard_cache
+    # Separate store from the detect benchmark so the row count is exactly n_sites
+    results_store.DB_PATH = os.path.join(root, "load_data.db")
+    rng = np.random.default_rng(3)
+    if results_store.count() < n_sites:
+        results_store.upsert_many({"sample_id": f"load_{i}", "lat": 20.0, "lon": 78.0, "has_solar": bool(rng.random() < 0.4),
+                                   "confidence": 0.6, "pv_area_sqm_est": 12.5, "buffer_radius_sqft": 1200,
+                                   "qc_status": "VERIFIABLE", "qc_notes": ["bench"], "bbox_or_mask": "[]",
+                                   "integrity_hash": "0" * 64} for i in range(n_sites))
+    full = []
+    for _ in range(repeats):
+        t0 = time.perf_counter(); cache = dashboard_cache.DashboardCache(); full.append(time.perf_counter() - t0)
+    delta = []
+    for i in range(repeats * 10):
+        rec = results_store.get(f"load_{i % n_sites}")
+        rec["qc_status"] = "NOT_VERIFIABLE" if rec["qc_status"] == "VERIFIABLE" else "VERIFIABLE"
+        t0 = time.perf_counter(); results_store.upsert(rec); cache.refresh(); delta.append(time.perf_counter() - t0)
+    return summarize("load_data", n_sites * repeats, sum(full), full,
+                     {"delta_update_p50_ms": round(float(np.percentile(np.array(delta) * 1000, 50)), 2)})
+
+def bench_report(root, n_sites):
+    import report
+    out_dir = os.path.join(root, "reports")
+    os.makedirs(out_dir, exist_ok=True)
+    n = min(n_sites, 2000)
+    lat = []
+    t0 = time.perf_counter()
+    for i in range(n):
+        rec = {"sample_id": f"rep_{i}", "has_solar": i % 2 == 0, "pv_area_sqm_est": 10.0 + i % 7, "confidence": 0.7,
+               "buffer_radius_sqft": 1200, "qc_notes": ["Solar Confirmed (Zone: 1200)"], "integrity_hash": "0" * 64}
+        t1 = time.perf_counter()
+        report.generate_pdf(rec, os.path.join(out_dir, f"rep_{i}.pdf"))
+        lat.append(time.perf_counter() - t1)
+    return summarize("report", n, time.perf_counter() - t0, lat)
+
+_PROBE = """
+import sys, json, time, importlib
+sys.path.append({dir!r})
+t0 = time.perf_counter()
+for m in {mods!r}: importlib.import_module(m)
+t = time.perf_counter() - t0
+from metrics import peak_rss_mb
+print(json.dumps({{"import_s": t, "rss_mb": peak_rss_mb(), "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def bench_startup(repeats=STARTUP_REPEATS):
+    """
+    Cold import time and peak RSS of each portal page, each sample in a fresh
+    interpreter. Latencies are per-page import times; heavy_modules lists any
+    ML modules a page pulled in.
+    """
+    lat, extra = [], {}
+    for page, mods in STARTUP_PATHS.items():
+        code = _PROBE.format(dir=CURRENT_DIR, mods=mods, heavy=HEAVY_MODULES)
+        runs = []
+        for _ in range(repeats):
+            proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=BASE_DIR)
+            if proc.returncode != 0: raise RuntimeError(f"{page} imports failed: {proc.stderr[-500:]}")
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        lat += [r["import_s"] for r in runs]
+        extra[f"{page}_import_ms"] = round(float(np.median([r["import_s"] for r in runs])) * 1000, 1)
+        extra[f"{page}_rss_mb"] = max((r["rss_mb"] or 0) for r in runs)
+        extra[f"{page}_heavy_modules"] = runs[0]["heavy"]
+    res = summarize("startup", len(lat), sum(lat), lat, extra)
+    # The children's memory, not this process's, is what the portal pays
+    res["peak_rss_mb"] = max(extra[f"{page}_rss_mb"] for page in STARTUP_PATHS)
+    return res
+
+def run_single(name, root, n_sites, args):
+    if name == "detect":
+        if not os.path.isdir(os.path.join(root, "images")): make_workspace(root, n_sites, args.unique_tiles)
+        return bench_detect(root, n_sites, args.batch_size, args.real_model)
+    if name == "fetch": return bench_fetch(root, n_sites, args.fetch_workers)
+    if name == "load_data": return bench_load_data(root, n_sites)
+    if name == "report": return bench_report(root, n_sites)
+    if name == "startup": return bench_startup()
+    raise ValueError(f"unknown benchmark {name!r}")
+
+# --- BASELINE COMPARISON ---
+def compare(results, baseline):
+    """
+    Returns a list of human-readable regressions against the baseline.
+    """
+    base = {r["benchmark"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        b = base.get(r["benchmark"])
+        if not b or b.get("items") != r.get("items"): continue
+        if b.get("throughput_per_s") and r.get("throughput_per_s") is not None:
+            if r["throughput_per_s"] < b["throughput_per_s"] * (1 - THROUGHPUT_TOLERANCE):
+                regressions.append(f"{r['benchmark']}: throughput {r['throughput_per_s']}/s vs baseline {b['throughput_per_s']}/s")
+        if b.get("p99_ms") and r["p99_ms"] > b["p99_ms"] * (1 + LATENCY_TOLERANCE):
+            regressions.append(f"{r['benchmark']}: p99 {r['p99_ms']}ms vs baseline {b['p99_ms']}ms")
+        if r["benchmark"] == "startup":
+            if b.get("peak_rss_mb") and r.get("peak_rss_mb") and r["peak_rss_mb"] > b["peak_rss_mb"] * (1 + RSS_TOLERANCE):
+                regressions.append(f"startup: peak RSS {r['peak_rss_mb']}MB vs baseline {b['peak_rss_mb']}MB")
+    return regressions
+
+def startup_leaks(results):
+    """
+    Portal pages must never load the ML stack, whatever the baseline recorded.
+    """
+    return [f"startup: {page} imports {', '.join(r[f'{page}_heavy_modules'])}"
+            for r in results if r["benchmark"] == "startup"
+            for page in STARTUP_PATHS if r.get(f"{page}_heavy_modules")]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SūryaNetra benchmark suite (CPU, no network)")
+    parser.add_argument("--scale", type=int, default=100, help="Number of synthetic sites (100 - 100000)")
+    parser.add_argument("--only", nargs="*", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--fetch-workers", type=int, default=16)
+    parser.add_argument("--unique-tiles", type=int, default=200)
+    parser.add_argument("--real-model", action="store_true", help="Use best.pt instead of the stub detector")
+    parser.add_argument("--workdir", default=None, help="Reuse a workspace instead of a temp dir")
+    parser.add_argument("--save-baseline", action="store_true", help="Write results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--single", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # Child process: one benchmark, so peak RSS is attributable to it
+        print(json.dumps(run_single(args.single, args.workdir, args.scale, args)))
+        sys.exit(0)
+
+    root = args.workdir or tempfile.mkdtemp(prefix="suryanetra_bench_")
+    results = []
+    for name in args.only:
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", name, "--workdir", root,
+               "--scale", str(args.scale), "--batch-size", str(args.batch_size),
+               "--fetch-workers", str(args.fetch_workers), "--unique-tiles", str(args.unique_tiles)]
+        if args.real_model: cmd.append("--real-model")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ {name} failed:\n{proc.stderr[-2000:]}")
+            continue
+        res = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(res)
+        print(f"   {name:<10} {res['throughput_per_s']}/s  p50 {res['p50_ms']}ms  p99 {res['p99_ms']}ms  peak {res['peak_rss_mb']}MB")
+
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    report_doc = {"scale": args.scale, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    with open(os.path.join(BENCH_DIR, "latest.json"), "w") as f: json.dump(report_doc, f, indent=2)
+    if not args.workdir: shutil.rmtree(root, ignore_errors=True)
+
+    leaks = startup_leaks(results)
+    if leaks:
+        print("❌ ML stack loaded at portal startup:\n   " + "\n   ".join(leaks))
+        sys.exit(1)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f: json.dump(report_doc, f, indent=2)
+        print(f"✅ Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f: regressions = compare(results, json.load(f))
+        if regressions:
+            print("❌ Regressions:\n   " + "\n   ".join(regressions))
+            sys.exit(1)
+        print("✅ No regressions against baseline")
@@ -0,0 +1,124 @@
+import os
+import json
+import math
+import time
+import hashlib
+
+import numpy as np
+
+import geometry
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(BASE_DIR, "input", "cascade.json")   # tuned threshold written by calibrate()
+REPORT_PATH = os.path.join(BASE_DIR, "output", "metrics", "cascade_calibration.json")
+
+SETTINGS = {
+    "imgsz": 256,             # stage-1 inference size; the crop is ~200 px at zoom 20 so it runs near native scale
+    "margin_m": 6.0,          # context kept around the 2400 sq.ft buffer so arrays straddling its edge are still seen
+    "min_conf": 0.01,         # stage-1 detector floor; the threshold below is applied on top
+    "threshold": 0.05,        # tiles scoring at or above this go on to full detection
+    "audit_rate": 0.02,       # share of screened-out tiles sent to the full detector anyway to measure the recall cost
+}
+TARGET_RECALL = 0.99      # share of full-detector has_solar sites stage 1 must pass when calibrating
+
+def load_settings(path=CONFIG_PATH):
+    """
+    SETTINGS with any values from input/cascade.json applied.
+    """
+    settings = dict(SETTINGS)
+    if os.path.exists(path):
+        with open(path) as f: settings.update({k: v for k, v in json.load(f).items() if k in SETTINGS})
+    return settings
+
+def crop(img, scale, margin_m=SETTINGS["margin_m"]):
+    """
+    Square around the tile centre covering the 2400 sq.ft buffer plus margin_m.
+    """
+    h, w = img.shape[:2]
+    half = int(math.ceil((geometry.R_2400_M + margin_m) / scale))
+    cx, cy = w // 2, h // 2
+    return img[max(0, cy - half):cy + half, max(0, cx - half):cx + half]
+
+def score(xyxy, confs, crop_shape, scale):
+    """
+    Stage-1 score: the highest confidence among boxes reaching into the 2400 buffer (0 if none).
+    """
+    if len(xyxy) == 0: return 0.0
+    h, w = crop_shape[:2]
+    near = geometry.box_zones(geometry.centre_distances(np.asarray(xyxy, dtype=np.float64), w, h), scale) > 0
+    return float(np.max(confs[near])) if near.any() else 0.0
+
+def audit_pick(sample_id, rate):
+    """
+    Deterministic sample of screened-out sites that still get full detection.
+    """
+    if rate <= 0: return False
+    return int(hashlib.sha256(str(sample_id).encode()).hexdigest()[:8], 16) < rate * 2 ** 32
+
+def pick_threshold(scores, positives, target_recall=TARGET_RECALL):
+    """
+    Highest threshold that still passes target_recall of the positive tiles.
+    """
+    pos = sorted((s for s, p in zip(scores, positives) if p), reverse=True)
+    if not pos: return SETTINGS["min_conf"]
+    return max(pos[max(0, math.ceil(target_recall * len(pos)) - 1)], SETTINGS["min_conf"])
+
+def calibrate(model, refs, target_recall=TARGET_RECALL, path=CONFIG_PATH, report_path=REPORT_PATH):
+    """
+    Runs stage 1 and the full detector over reference tiles, picks the
+    threshold that keeps target_recall of the full detector's has_solar
+    sites, and writes it to input/cascade.json with the measured pass rate,
+    recall and per-stage timings.
+    """
+    import detect
+    import tile_archive
+    settings = load_settings(path)
+    sids = [r[len(tile_archive.REF_PREFIX):] if tile_archive.is_ref(r) else os.path.splitext(os.path.basename(r))[0] for r in refs]
+    coords = detect.load_coord_map(sids)
+    scores, positives, t1, t2 = [], [], 0.0, 0.0
+    for sid, ref in zip(sids, refs):
+        img = tile_archive.imread(ref)
+        if img is None: continue
+        site = coords.get(sid, {'lat': 20.5937, 'lon': 78.9629})
+        scale = detect.get_meters_per_pixel(site['lat'])
+        t0 = time.perf_counter()
+        scores.append(detect.cascade_scores(model, [img], [scale], settings)[0])
+        t1 += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        xyxy, confs = detect.predict_batch(model, [img])[0]
+        t2 += time.perf_counter() - t0
+        h, w = img.shape[:2]
+        candidates, geo = detect.filter_candidates(xyxy, confs, w, h, scale)
+        positives.append(detect.build_record(sid, site, True, "", candidates, geo)['has_solar'])
+    n, n_pos = len(scores), sum(positives)
+    if not n: raise RuntimeError("no readable reference tiles")
+    threshold = pick_threshold(scores, positives, target_recall)
+    passed = [s >= threshold for s in scores]
+    stage1_ms, full_ms = t1 / n * 1000, t2 / n * 1000
+    pass_rate = sum(passed) / n
+    report = {
+        "tiles": n, "positives": n_pos, "target_recall": target_recall, "threshold": round(threshold, 4),
+        "pass_rate": round(pass_rate, 4),
+        "recall": round(sum(p and q for p, q in zip(passed, positives)) / n_pos, 4) if n_pos else None,
+        "stage1_ms": round(stage1_ms, 2), "full_ms": round(full_ms, 2),
+        "expected_speedup": round(full_ms / (stage1_ms + pass_rate * full_ms), 2) if full_ms else None,
+        "settings": dict(settings, threshold=round(threshold, 4)),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f: json.dump(report["settings"], f, indent=1)
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, "w") as f: json.dump(report, f, indent=1)
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    import backends
+    parser = argparse.ArgumentParser(description="Calibrate the cascade's stage-1 threshold on reference tiles")
+    parser.add_argument("--dir", default=None, help="Reference tiles (default: archive + output/images)")
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--target-recall", type=float, default=TARGET_RECALL)
+    args = parser.parse_args()
+    import detect
+    report = calibrate(detect.load_model(), backends.reference_tiles(args.dir, args.limit), args.target_recall)
+    print(json.dumps(report, indent=1))
+    print(f"✅ Threshold {report['threshold']} passes {report['pass_rate'] * 100:.1f}% of tiles at recall {report['recall']}")
@@ -0,0 +1,200 @@
+import os
+import time
+import sqlite3
+import threading
+
+import sqlite_journal
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(BASE_DIR, "output", "coordinates.db")
+CHUNK_ROWS = 50000     # rows parsed and inserted per transaction
+
+# Accepted header spellings for each canonical column
+COLUMN_ALIASES = {
+    "sample_id": ("sample_id", "id", "site_id", "consumer_id"),
+    "latitude": ("latitude", "lat"),
+    "longitude": ("longitude", "lon", "lng", "long"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coordinates (
+    sample_id TEXT PRIMARY KEY,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_coordinates_source ON coordinates(source);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    mtime REAL, size INTEGER, rows INTEGER, ingested_at REAL
+);
+-- Which file lists which site. coordinates.source only names the file whose
+-- coordinates won (a manual entry keeps "manual"), so a file's sites come from here.
+CREATE TABLE IF NOT EXISTS site_sources (
+    path TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    PRIMARY KEY (path, sample_id)
+);
+"""
+
+_local = threading.local()
+
+def connect(db_path=None):
+    db_path = db_path or DB_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None: conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        sqlite_journal.apply(conn, db_path)
+        fresh = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'site_sources'").fetchone() is None
+        conn.executescript(SCHEMA)
+        if fresh:
+            # Stores from before site_sources: every file's sites are the ones it still owns
+            with conn: conn.execute("INSERT OR IGNORE INTO site_sources SELECT source, sample_id FROM coordinates "
+                                    "WHERE source IS NOT NULL AND source != 'manual'")
+        conns[db_path] = conn
+    return conn
+
+def _canonical_columns(columns):
+    lowered = {str(c).strip().lower(): c for c in columns}
+    mapping = {}
+    for canon, aliases in COLUMN_ALIASES.items():
+        for a in aliases:
+            if a in lowered:
+                mapping[lowered[a]] = canon
+                break
+        else:
+            raise ValueError(f"Missing column '{canon}' (accepted: {', '.join(aliases)})")
+    return mapping
+
+def _iter_frames(path, chunk_rows):
+    """
+    Yields DataFrame chunks with sample_id/latitude/longitude columns, never the whole file at once.
+    """
+    import pandas as pd
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        # Keep ids as text (leading zeros) whichever column they are in
+        mapping = _canonical_columns(pd.read_csv(path, nrows=0).columns)
+        sid_col = next(c for c, canon in mapping.items() if canon == "sample_id")
+        for chunk in pd.read_csv(path, chunksize=chunk_rows, dtype={sid_col: str}):
+            yield chunk.rename(columns=mapping)
+    elif ext == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            chunk = batch.to_pandas()
+            yield chunk.rename(columns=_canonical_columns(chunk.columns))
+    elif ext in (".xlsx", ".xlsm"):
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None: return
+            mapping = _canonical_columns(header)
+            buf = []
+            for row in rows:
+                buf.append(row)
+                if len(buf) >= chunk_rows:
+                    yield pd.DataFrame(buf, columns=header).rename(columns=mapping)
+                    buf = []
+            if buf: yield pd.DataFrame(buf, columns=header).rename(columns=mapping)
+        finally:
+            wb.close()
+    else:
+        raise ValueError(f"Unsupported coordinates file: {path}")
+
+def ingest(path, db_path=None, force=False, chunk_rows=CHUNK_ROWS):
+    """
+    Streams a CSV / Parquet / xlsx file into the coordinate table in chunks.
+    Files already ingested with the same mtime and size are skipped unless force.
+    Sites added by hand (source "manual") keep their coordinates.
+    Returns the number of rows ingested (0 when skipped).
+    """
+    import numpy as np
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    conn = connect(db_path)
+    seen = conn.execute("SELECT mtime, size FROM sources WHERE path = ?", (path,)).fetchone()
+    if seen and not force and seen[0] == st.st_mtime and seen[1] == st.st_size: return 0
+
+    total = 0
+    with conn: conn.execute("DELETE FROM site_sources WHERE path = ?", (path,))
+    for chunk in _iter_frames(path, chunk_rows):
+        chunk = chunk.dropna(subset=["sample_id", "latitude", "longitude"])
+        sids = chunk["sample_id"].astype(str).str.strip().to_numpy()
+        lats = chunk["latitude"].astype(float).to_numpy()
+        lons = chunk["longitude"].astype(float).to_numpy()
+        valid = (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO site_sources VALUES (?, ?)", ((path, sid) for sid in sids[valid].tolist()))
+            cur = conn.executemany("INSERT INTO coordinates VALUES (?, ?, ?, ?) ON CONFLICT(sample_id) DO UPDATE SET "
+                                   "latitude = excluded.latitude, longitude = excluded.longitude, source = excluded.source "
+                                   "WHERE coordinates.source IS NOT 'manual'",
+                                   zip(sids[valid].tolist(), lats[valid].tolist(), lons[valid].tolist(), [path] * int(valid.sum())))
+        total += max(cur.rowcount, 0)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)", (path, st.st_mtime, st.st_size, total, time.time()))
+    return total
+
+def add_site(sample_id, latitude, longitude, db_path=None, source="manual"):
+    """
+    Adds or moves one site without touching any input file. Manual entries
+    take priority over later re-ingests of a coordinate file.
+    """
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?, ?)",
+                     (str(sample_id), float(latitude), float(longitude), source))
+
+def get(sample_id, db_path=None):
+    row = connect(db_path).execute("SELECT latitude, longitude FROM coordinates WHERE sample_id = ?", (str(sample_id),)).fetchone()
+    return {'lat': row[0], 'lon': row[1]} if row else None
+
+def lookup(sample_ids=None, db_path=None):
+    """
+    {sample_id: {'lat', 'lon'}} for the given ids (or every site when None).
+    """
+    conn = connect(db_path)
+    if sample_ids is None:
+        rows = conn.execute("SELECT sample_id, latitude, longitude FROM coordinates")
+        return {sid: {'lat': lat, 'lon': lon} for sid, lat, lon in rows}
+    sample_ids = [str(s) for s in sample_ids]
+    out = {}
+    for i in range(0, len(sample_ids), 900):   # stay under SQLite's bound-parameter limit
+        part = sample_ids[i:i + 900]
+        rows = conn.execute(f"SELECT sample_id, latitude, longitude FROM coordinates WHERE sample_id IN ({','.join('?' * len(part))})", part)
+        out.update({sid: {'lat': lat, 'lon': lon} for sid, lat, lon in rows})
+    return out
+
+def iter_sites(source=None, db_path=None, chunk=10000):
+    """
+    Yields (lat, lon, sample_id) tuples, optionally only the sites listed in `source`
+    (including those whose manual coordinates took priority over the file's).
+    """
+    conn = connect(db_path)
+    if source is None: cur = conn.execute("SELECT latitude, longitude, sample_id FROM coordinates")
+    else: cur = conn.execute("SELECT c.latitude, c.longitude, c.sample_id FROM site_sources s "
+                             "JOIN coordinates c ON c.sample_id = s.sample_id WHERE s.path = ?", (os.path.abspath(source),))
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows: break
+        yield from rows
+
+def count(source=None, db_path=None):
+    conn = connect(db_path)
+    if source is None: return conn.execute("SELECT COUNT(*) FROM coordinates").fetchone()[0]
+    return conn.execute("SELECT COUNT(*) FROM site_sources WHERE path = ?", (os.path.abspath(source),)).fetchone()[0]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Ingest coordinate files (CSV / Parquet / xlsx)")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--force", action="store_true", help="Re-ingest even if the file is unchanged")
+    args = parser.parse_args()
+    for p in args.paths:
+        t0 = time.time()
+        n = ingest(p, force=args.force)
+        print(f"✅ {p}: {n} row(s) in {time.time() - t0:.1f}s" if n else f"   {p}: unchanged")
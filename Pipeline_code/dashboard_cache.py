@@ -0,0 +1,78 @@
+import threading
+
+import pandas as pd
+
+import results_store
+
+KW_PER_SQM = 0.15          # panel capacity used by the dashboard metrics
+TONS_CO2_PER_KW = 1.2      # carbon offset factor used by the dashboard metrics
+
+def is_verified(row):
+    return row.get('qc_status') == 'VERIFIABLE' and bool(row.get('has_solar'))
+
+def verified_area(row):
+    area = row.get('pv_area_sqm_est')
+    return float(area) if is_verified(row) and area is not None and area == area else 0.0
+
+class DashboardCache:
+    """
+    In-memory copy of the store's summary columns plus running aggregates.
+    refresh() pulls only rows whose revision is newer than the last one seen and
+    applies them as deltas, so a status change costs O(changed rows) rather
+    than a full reload.
+    """
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        with self.lock:
+            df = results_store.load_frame(self.db_path, with_rev=True)
+            self.rev = int(df['rev'].max()) if not df.empty else 0
+            self.df = df.drop(columns=['rev']).set_index('sample_id', drop=False)
+            verified = self.df[(self.df['qc_status'] == 'VERIFIABLE') & (self.df['has_solar'] == True)]
+            self.verified_area = float(verified['pv_area_sqm_est'].fillna(0).sum())
+            self.verified_sites = int(len(verified))
+
+    def apply(self, row):
+        """
+        Applies one changed summary row to the frame and the aggregates.
+        """
+        sid = str(row['sample_id'])
+        new_rows = []
+        if sid in self.df.index:
+            old = self.df.loc[sid].to_dict()
+            self.verified_area -= verified_area(old)
+            self.verified_sites -= int(is_verified(old))
+            cols = [c for c in self.df.columns if c in row]
+            self.df.loc[sid, cols] = [row[c] for c in cols]
+        else:
+            new_rows.append(row)
+        self.verified_area += verified_area(row)
+        self.verified_sites += int(is_verified(row))
+        return new_rows
+
+    def refresh(self):
+        with self.lock:
+            changes = results_store.changes_since(self.rev, self.db_path)
+            if not changes: return 0
+            added = []
+            for row in changes:
+                self.rev = max(self.rev, row.pop('rev'))
+                added.extend(self.apply(row))
+            if added:
+                new = pd.DataFrame(added).drop_duplicates('sample_id', keep='last').set_index('sample_id', drop=False)
+                self.df = pd.concat([self.df, new])
+            return len(changes)
+
+    def frame(self):
+        self.refresh()
+        return self.df
+
+    def metrics(self):
+        self.refresh()
+        capacity = self.verified_area * KW_PER_SQM
+        return {"sites": len(self.df), "verified_sites": self.verified_sites,
+                "area_sqm": self.verified_area, "capacity_kw": capacity,
+                "carbon_tons": capacity * TONS_CO2_PER_KW}
@@ -1,27 +1,47 @@
 import os
-import cv2
 import json
 import numpy as np
 import hashlib
-import pandas as pd
 import math
-from ultralytics import YOLO
 from datetime import date
+import time
+import geometry
+import quality_gate
+import results_store
+import coord_store
+import overlay
+import tile_archive
+import fetch_planner
+import backends
+import settings
+import cascade
+from metrics import METRICS
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MODEL_PATH = os.path.join(BASE_DIR, "Trained_model_file", "best.pt")
 IMG_DIR = os.path.join(BASE_DIR, "output", "images")
 JSON_OUT_DIR = os.path.join(BASE_DIR, "Prediction_files")
-ARTIFACT_OUT_DIR = os.path.join(BASE_DIR, "output", "audits")
 COORD_FILE = os.path.join(BASE_DIR, "input", "coordinates.xlsx")
+MANIFEST_PATH = os.path.join(BASE_DIR, "output", "manifest.json")
 
 FOOTER_HEIGHT_PX = 50   
 EDGE_MARGIN_PX = 5      
+MAX_ASPECT_RATIO = 4.5  
 ZOOM_LEVEL = 20         
 DETECT_CONF = 0.10      
 VERIFY_CONF = 0.40      
 MIN_VALID_AREA = 1.0    
-SHADOW_THRESH = 50      
+QUALITY_THRESHOLDS = quality_gate.load_thresholds()   # pre-inference gate; override in input/quality_gate.json
+BATCH_SIZE = 8          # tiles per inference call
+EXPORT_JSON = True      # also write the per-site compliance JSON into Prediction_files
+RENDER_OVERLAYS = False # batch runs leave overlays to overlay.ensure_overlay (drawn on first inspection)
+INFERENCE_BACKEND = os.environ.get(settings.BACKEND_ENV, "torch")  # "torch" (best.pt), "onnx" or "onnx-int8" (see backends.py)
+CASCADE = False         # two-stage mode: cheap centre-buffer screen before the full detector (see cascade.py)
+CASCADE_SETTINGS = cascade.load_settings()
+RECLASSIFY_CHUNK = 2000 # sites per write when re-deciding from stored raw detections
+MANIFEST_SAVE_S = 30.0  # manifest checkpoint interval during a run (a crash only re-processes the sites since)
+REUSE_RAW = True        # re-apply the decision tree to stored raw detections instead of re-inferring when only thresholds changed
+USE_SHARED_TILES = True # sites cropped from one fetch_planner shared tile share a single inference
 
 def get_meters_per_pixel(latitude, zoom=ZOOM_LEVEL):
     return 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
@@ -35,12 +55,149 @@ def generate_trust_hash(data):
     return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
 
 def check_image_quality(img):
+    """
+    Pre-inference gate: darkness, blur, haze, "no imagery" placeholder and footer
+    occlusion from one downsampled pass. Rejections are counted per reason.
+    """
+    is_usable, reason, note, _ = quality_gate.assess(img, QUALITY_THRESHOLDS)
+    METRICS.inc("quality_checked")
+    if not is_usable:
+        METRICS.inc("quality_rejected")
+        METRICS.inc(f"quality_rejected_{reason}")
+    return is_usable, note
+
+def quality_gate_report():
+    """
+    Skip counts and rate for the quality gate so far, also published as the quality_skip_rate gauge.
+    """
+    counters = METRICS.snapshot()["counters"]
+    checked, rejected = counters.get("quality_checked", 0), counters.get("quality_rejected", 0)
+    report = {"checked": checked, "rejected": rejected, "skip_rate": round(rejected / checked, 4) if checked else 0.0,
+              "by_reason": {r: counters.get(f"quality_rejected_{r}", 0) for r in quality_gate.REASONS}}
+    METRICS.set_gauge("quality_skip_rate", report["skip_rate"])
+    if rejected:
+        reasons = ", ".join(f"{r}: {n}" for r, n in report["by_reason"].items() if n)
+        print(f"   ⏭️ Quality gate skipped inference on {rejected}/{checked} tile(s) ({reasons})")
+    return report
+
+def no_detections():
+    return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): h.update(chunk)
+    return h.hexdigest()
+
+def get_config_hash(model_hash):
+    """
+    Fingerprint of everything (besides the image) that can change a site's result.
+    """
+    config = {
+        "model": model_hash,
+        "DETECT_CONF": DETECT_CONF, "VERIFY_CONF": VERIFY_CONF,
+        "MIN_VALID_AREA": MIN_VALID_AREA, "QUALITY": QUALITY_THRESHOLDS,
+        "MAX_ASPECT_RATIO": MAX_ASPECT_RATIO, "FOOTER_HEIGHT_PX": FOOTER_HEIGHT_PX, "EDGE_MARGIN_PX": EDGE_MARGIN_PX,
+        "BUFFER_RADII_M": [geometry.R_1200_M, geometry.R_2400_M],
+    }
+    if CASCADE: config["CASCADE"] = CASCADE_SETTINGS
+    return generate_trust_hash(config)
+
+def load_manifest():
+    if os.path.exists(MANIFEST_PATH):
+        try:
+            with open(MANIFEST_PATH) as f: return json.load(f)
+        except (OSError, ValueError): pass
+    return {"sites": {}}
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, MANIFEST_PATH)
+
+class ManifestCheckpoint:
+    """
+    Collects a run's manifest entries and rewrites manifest.json at most every
+    `every_s` seconds (and on flush), so a long run doesn't rewrite the whole
+    file once per batch.
+    """
+    def __init__(self, manifest, every_s=MANIFEST_SAVE_S):
+        self.manifest = manifest
+        self.every_s = every_s
+        self.saved = time.monotonic()
+        self.dirty = False
+
+    def add(self, sid, entry):
+        self.manifest["sites"][sid] = entry
+        self.dirty = True
+        if time.monotonic() - self.saved >= self.every_s: self.flush()
+
+    def flush(self):
+        if self.dirty: save_manifest(self.manifest)
+        self.saved, self.dirty = time.monotonic(), False
+
+def manifest_entry(image_hash, config_hash, site_data):
+    return {"image_hash": image_hash, "config_hash": config_hash,
+            "lat": float(site_data['lat']), "lon": float(site_data['lon'])}
+
+_MODEL_HASHES = {}
+
+def model_hash():
+    """
+    sha256 of the weights in use, cached per file version so batches don't re-hash them.
+    """
+    path = weights_path()
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size)
+    if key not in _MODEL_HASHES: _MODEL_HASHES[key] = file_sha256(path)
+    return _MODEL_HASHES[key]
+
+def raw_keys():
+    """
+    Fingerprints a stored raw detection must match to be reused: weights, quality gate and (for screened tiles) cascade.
+    """
+    return {"model_hash": model_hash(), "quality_hash": generate_trust_hash(QUALITY_THRESHOLDS),
+            "cascade_hash": generate_trust_hash(CASCADE_SETTINGS)}
+
+def raw_row(sid, image_hash, img, quality, xyxy, confs, keys, screen_score=None):
     h, w = img.shape[:2]
-    center = img[int(h*0.3):int(h*0.7), int(w*0.3):int(w*0.7)]
-    gray = cv2.cvtColor(center, cv2.COLOR_BGR2GRAY)
-    if np.mean(gray) < SHADOW_THRESH:
-        return False, f"Severe Shadow (Level: {np.mean(gray):.1f})"
-    return True, "Clear"
+    return {"sample_id": sid, "image_hash": image_hash, "model_hash": keys["model_hash"],
+            "quality_hash": keys["quality_hash"], "min_conf": DETECT_CONF, "width": w, "height": h,
+            "usable": int(quality[0]), "quality_note": quality[1], "screen_score": screen_score,
+            "cascade_hash": keys["cascade_hash"] if screen_score is not None else None,
+            "boxes": np.asarray(xyxy, dtype=np.float32).reshape(-1, 4).tobytes(),
+            "confs": np.asarray(confs, dtype=np.float32).reshape(-1).tobytes()}
+
+def raw_current(raw, image_hash, keys):
+    """
+    True when a stored raw detection can stand in for running the model on this image now.
+    """
+    if raw is None or raw['image_hash'] != image_hash: return False
+    if raw['model_hash'] != keys['model_hash'] or raw['quality_hash'] != keys['quality_hash']: return False
+    if raw['min_conf'] > DETECT_CONF: return False
+    # Screened tiles never had a full pass; they only stand while the same screen is in force
+    return raw['screen_score'] is None or (CASCADE and raw['cascade_hash'] == keys['cascade_hash'])
+
+def cascade_note(score):
+    return f"Cascade Screen: No Signal Near Centre (Score: {score:.2f})"
+
+def site_from_raw(sid, site_data, raw, img_path=None, image_hash=None):
+    """
+    Decision tree over stored raw detections: (record, detection_row) without decoding or inference.
+    """
+    xyxy = np.frombuffer(raw['boxes'], dtype=np.float32).reshape(-1, 4)
+    confs = np.frombuffer(raw['confs'], dtype=np.float32)
+    keep = confs >= DETECT_CONF
+    w, h, scale = raw['width'], raw['height'], get_meters_per_pixel(site_data['lat'])
+    candidates, geo = filter_candidates(xyxy[keep], confs[keep], w, h, scale)
+    notes = [cascade_note(raw['screen_score'])] if raw['screen_score'] is not None else None
+    rec = build_record(sid, site_data, bool(raw['usable']), raw['quality_note'], candidates, geo, notes)
+    METRICS.inc("sites_solar" if rec['has_solar'] else "sites_no_solar")
+    return rec, detection_row(sid, img_path, image_hash, w, h, scale, candidates, rec)
 
 def get_buffer_status_overlap(candidates, img_w, img_h, scale):
     """
@@ -48,161 +205,459 @@ def get_buffer_status_overlap(candidates, img_w, img_h, scale):
     This is more permissible than checking the center point.
     """
     if not candidates: return 0
-    scale = float(scale)
+    boxes = np.array([c['box'] for c in candidates], dtype=np.float64)
+    return geometry.buffer_zone(geometry.box_zones(geometry.centre_distances(boxes, img_w, img_h), scale))
+
+def predict_batch(model, imgs, imgsz=None, conf=DETECT_CONF):
+    """
+    Runs the detector once over a list of decoded BGR tiles.
+    Returns one (xyxy, conf) pair of numpy arrays per tile.
+    """
+    kwargs = {"imgsz": imgsz} if imgsz else {}
+    results = model(imgs, verbose=False, conf=conf, batch=len(imgs), **kwargs)
+    out = []
+    for r in results:
+        if r.boxes is None or len(r.boxes) == 0:
+            out.append((np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)))
+        else:
+            out.append((r.boxes.xyxy.cpu().numpy(), r.boxes.conf.cpu().numpy()))
+    return out
+
+def cascade_scores(model, imgs, scales, settings=None):
+    """
+    Stage-1 scores: the detector at reduced imgsz on just the centre buffer crop of each tile.
+    """
+    s = settings or CASCADE_SETTINGS
+    crops = [cascade.crop(img, scale, s["margin_m"]) for img, scale in zip(imgs, scales)]
+    out = predict_batch(model, crops, imgsz=s["imgsz"], conf=s["min_conf"])
+    return [cascade.score(xyxy, confs, c.shape, scale) for (xyxy, confs), c, scale in zip(out, crops, scales)]
+
+def cascade_report():
+    """
+    Stage-1 pass rate and the recall cost measured on audited screen-outs, also published as gauges.
+    """
+    c = METRICS.snapshot()["counters"]
+    checked, passed = c.get("cascade_checked", 0), c.get("cascade_passed", 0)
+    audited, misses = c.get("cascade_audited", 0), c.get("cascade_audit_misses", 0)
+    screened = checked - passed
+    miss_rate = misses / audited if audited else None
+    report = {"checked": checked, "passed": passed, "pass_rate": round(passed / checked, 4) if checked else 0.0,
+              "screened": screened, "audited": audited, "audit_misses": misses,
+              "screened_solar_rate": round(miss_rate, 4) if miss_rate is not None else None,
+              "est_missed_sites": round(miss_rate * (screened - audited), 1) if miss_rate is not None else None}
+    METRICS.set_gauge("cascade_pass_rate", report["pass_rate"])
+    if miss_rate is not None: METRICS.set_gauge("cascade_screened_solar_rate", report["screened_solar_rate"])
+    if checked:
+        print(f"   🪜 Cascade: {passed}/{checked} tile(s) passed stage 1 ({report['pass_rate'] * 100:.1f}%), "
+              f"{misses}/{audited} audited screen-out(s) had solar")
+    return report
+
+def crop_detections(xyxy, confs, dx, dy, size=fetch_planner.CROP_PX):
+    """
+    Detections on a shared tile moved into one site's crop and clipped to it.
+    """
+    if len(xyxy) == 0: return no_detections()
+    boxes = np.clip(xyxy - np.array([dx, dy, dx, dy], dtype=xyxy.dtype), 0, size)
+    keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    return boxes[keep], confs[keep]
+
+def filter_candidates(xyxy, confs, w, h, scale):
+    """
+    Vectorized filtering of raw detections. Returns (candidates, geo) where each
+    candidate carries its box, conf, area and buffer zone, and geo holds the
+    site-level aggregates from geometry.analyze_boxes.
+    """
+    geo = geometry.analyze_boxes(xyxy, confs, w, h, scale, FOOTER_HEIGHT_PX, EDGE_MARGIN_PX, MAX_ASPECT_RATIO)
+    candidates = [{'box': b, 'conf': c, 'area': a, 'zone': z}
+                  for b, c, a, z in zip(geo['boxes'].tolist(), geo['confs'].tolist(), geo['areas'].tolist(), geo['zones'].tolist())]
+    return candidates, geo
+
+def build_record(sid, site_data, is_usable, quality_note, candidates, geo, extra_notes=None):
+    total_area, max_conf, buffer_val = geo['total_area'], geo['max_conf'], geo['buffer_zone']
     
-    # Radius in Pixels
-    r_1200_px = 5.96 / scale  
-    r_2400_px = 8.42 / scale  
+    # Decision Tree
+    qc_status = "VERIFIABLE"
+    has_solar = False
+    qc_notes = []
+
+    if not is_usable:
+        qc_status = "NOT_VERIFIABLE"
+        qc_notes.append(quality_note)
+    elif not candidates:
+        qc_status = "VERIFIABLE"
+        has_solar = False
+        qc_notes.append("Clear View: Empty Roof")
+    else:
+        is_valid_signal = (max_conf >= VERIFY_CONF) and (total_area >= MIN_VALID_AREA)
+        
+        if not is_valid_signal:
+            qc_status = "VERIFIABLE"
+            has_solar = False
+            qc_notes.append("Ignored Noise (Weak Signal)")
+        elif buffer_val > 0:
+            qc_status = "VERIFIABLE"
+            has_solar = True
+            qc_notes.append(f"Solar Confirmed (Zone: {buffer_val})")
+        else:
+            qc_status = "VERIFIABLE"
+            has_solar = False # Detected, but outside valid zone
+            qc_notes.append("Solar Detected OUTSIDE 2400 sqft Limit")
+    if extra_notes: qc_notes.extend(extra_notes)
+
+    rec = {
+        "sample_id": sid, "lat": site_data['lat'], "lon": site_data['lon'],
+        "has_solar": has_solar, "confidence": round(max_conf, 2),
+        "pv_area_sqm_est": round(total_area, 2),
+        "buffer_radius_sqft": buffer_val,
+        "qc_status": qc_status, "qc_notes": qc_notes,
+        "bbox_or_mask": str([c['box'] for c in candidates]) if candidates else "[]",
+        "image_metadata": {"source": "Google Static Maps", "capture_date": str(date.today())}
+    }
+    rec['integrity_hash'] = generate_trust_hash(rec)
+    return rec
+
+def detection_row(sid, img_path, image_hash, w, h, scale, candidates, rec):
+    """
+    What overlay.render needs to redraw a site later without re-running the model.
+    """
+    return {"sample_id": sid, "image": img_path, "image_hash": image_hash, "width": w, "height": h,
+            "scale": scale, "verify_conf": VERIFY_CONF, "candidates": candidates,
+            "has_solar": rec['has_solar'], "buffer_radius_sqft": rec['buffer_radius_sqft']}
+
+def process_site(sid, img, site_data, xyxy, confs, img_path=None, image_hash=None, render=False, quality=None, extra_notes=None):
+    """
+    Filtering and decision tree for one decoded tile and its raw detections.
+    Pass the (is_usable, note) from an earlier check_image_quality as quality.
+    Returns (record, detection_row) for save_results; the overlay is only drawn
+    here when render=True, otherwise overlay.ensure_overlay draws it on demand.
+    """
+    h, w = img.shape[:2]
+    scale = get_meters_per_pixel(site_data['lat'])
     
-    cx, cy = img_w // 2, img_h // 2
-    in_1200, in_2400 = False, False
+    if quality is None:
+        with METRICS.span("quality", sid):
+            quality = check_image_quality(img)
+    is_usable, quality_note = quality
+    with METRICS.span("postprocess", sid):
+        candidates, geo = filter_candidates(xyxy, confs, w, h, scale)
+        rec = build_record(sid, site_data, is_usable, quality_note, candidates, geo, extra_notes)
     
-    for item in candidates:
-        x1, y1, x2, y2 = item['box']
-        
-        # Check if box intersects circle
-        # Simple proximity check: closest point on box to circle center
-        closest_x = max(x1, min(cx, x2))
-        closest_y = max(y1, min(cy, y2))
-        
-        dist_x = cx - closest_x
-        dist_y = cy - closest_y
-        distance = np.sqrt(dist_x**2 + dist_y**2)
-        
-        if distance <= r_1200_px: in_1200 = True
-        if distance <= r_2400_px: in_2400 = True
-            
-    if in_1200: return 1200
-    if in_2400: return 2400
-    return 0
-
-def run_pipeline():
-    print("🚀 Running SūryaNetra 'Overlap' Logic...")
-    if not os.path.exists(MODEL_PATH): print("❌ No Model"); return
-    model = YOLO(MODEL_PATH)
+    det = detection_row(sid, img_path, image_hash, w, h, scale, candidates, rec)
+    if render: overlay.write_overlay(sid, img, det)
+    METRICS.inc("sites_solar" if rec['has_solar'] else "sites_no_solar")
     
-    coord_map = {}
+    status_text = f"SOLAR: {rec['buffer_radius_sqft']}" if rec['has_solar'] else "NO SOLAR"
+    print(f"   👉 {sid}: {status_text} | Zone: {rec['buffer_radius_sqft']}")
+    return rec, det
+
+def save_results(records, detections=None, raw=None):
+    """
+    Upserts records (and their detection rows and raw model output) into the
+    results store, plus the compliance JSON files when EXPORT_JSON.
+    """
+    if not records: return
+    results_store.upsert_many(records)
+    if detections: results_store.upsert_detections(detections)
+    if raw: results_store.upsert_raw_detections(raw)
+    if EXPORT_JSON:
+        for rec in records: results_store.export_json(rec, JSON_OUT_DIR)
+
+def load_coord_map(sample_ids=None):
+    """
+    Coordinates for the given sites from the indexed coordinate store.
+    COORD_FILE is only re-parsed when it has changed since the last ingest.
+    """
     if os.path.exists(COORD_FILE):
-        try:
-            df = pd.read_excel(COORD_FILE)
-            for _, row in df.iterrows():
-                coord_map[str(row['sample_id'])] = {'lat': row['latitude'], 'lon': row['longitude']}
-        except: pass
-            
+        try: coord_store.ingest(COORD_FILE)
+        except (OSError, ValueError) as e: print(f"⚠️ Could not ingest {COORD_FILE}: {e}")
+    return coord_store.lookup(sample_ids)
+
+def weights_path():
+    """
+    Weights file the configured backend loads (best.pt, or its ONNX export).
+    """
+    return MODEL_PATH if INFERENCE_BACKEND == "torch" else backends.model_path(INFERENCE_BACKEND)
+
+def load_model(threads=None):
+    t0 = time.perf_counter()
+    model = backends.load_model(INFERENCE_BACKEND, weights_path(), threads)
+    elapsed = time.perf_counter() - t0
+    METRICS.observe("model_load", elapsed)
+    METRICS.set_gauge("model_load_seconds", round(elapsed, 3))
+    return model
+
+def plan_pipeline(sample_ids=None, force=False):
+    """
+    Works out which tiles (output/images and the tile archive) need (re)processing.
+    Returns (pending, manifest) where pending is a list of (sid, img_path, site_data, entry).
+    """
     os.makedirs(JSON_OUT_DIR, exist_ok=True)
-    os.makedirs(ARTIFACT_OUT_DIR, exist_ok=True)
     
-    files = [f for f in os.listdir(IMG_DIR) if f.lower().endswith(('.png', '.jpg'))]
+    # Archived tiles take precedence over loose files; their sha256 comes from the index
+    tiles = {}
+    if os.path.isdir(IMG_DIR):
+        tiles = {os.path.splitext(f)[0]: os.path.join(IMG_DIR, f) for f in os.listdir(IMG_DIR) if f.lower().endswith(('.png', '.jpg'))}
+    archived = tile_archive.ARCHIVE.hashes(sample_ids)
+    tiles.update({sid: tile_archive.ref_for(sid) for sid in archived})
+    if sample_ids is not None:
+        wanted = {str(s) for s in sample_ids}
+        tiles = {sid: ref for sid, ref in tiles.items() if sid in wanted}
+    coord_map = load_coord_map(list(tiles))
     
-    for f in files:
-        sid = os.path.splitext(f)[0]
-        img_path = os.path.join(IMG_DIR, f)
-        img = cv2.imread(img_path)
-        if img is None: continue
-        h, w = img.shape[:2]
-        
-        site_data = coord_map.get(sid, {'lat': 20.5937, 'lon': 78.9629}) 
-        scale = get_meters_per_pixel(site_data['lat'])
-        
-        # 1. Quality Check
-        is_usable, quality_note = check_image_quality(img)
-        
-        # 2. Inference
-        results = model(img_path, verbose=False, conf=DETECT_CONF)
-        candidates = []
-        max_conf = 0.0
-        
-        if results[0].boxes:
-            for i, box in enumerate(results[0].boxes.xyxy):
-                conf = float(results[0].boxes.conf[i])
-                b = box.tolist()
-                
-                if b[3] > (h - FOOTER_HEIGHT_PX): continue
-                if (b[0] < EDGE_MARGIN_PX) or (b[1] < EDGE_MARGIN_PX) or (b[2] > w - EDGE_MARGIN_PX): continue
-                
-                bw, bh = b[2]-b[0], b[3]-b[1]
-                if min(bw, bh) == 0: continue
-                if max(bw, bh) / min(bw, bh) > 4.5: continue 
-
-                area = calculate_area_sqm(b, scale)
-                candidates.append({'box': b, 'conf': conf, 'area': area})
-                if conf > max_conf: max_conf = conf
-
-        total_area = sum(c['area'] for c in candidates)
-        buffer_val = get_buffer_status_overlap(candidates, w, h, scale)
-        
-        # 3. Decision Tree
-        qc_status = "VERIFIABLE"
-        has_solar = False
-        qc_notes = []
+    manifest = load_manifest()
+    config_hash = get_config_hash(model_hash())
+    stored = results_store.ids()
+    
+    pending = []
+    for sid, img_path in tiles.items():
+        site_data = coord_map.get(sid, {'lat': 20.5937, 'lon': 78.9629})
+        image_hash = archived[sid] if sid in archived else file_sha256(img_path)
+        entry = manifest_entry(image_hash, config_hash, site_data)
+        up_to_date = manifest["sites"].get(sid) == entry and sid in stored
+        if force or not up_to_date: pending.append((sid, img_path, site_data, entry))
+    
+    print(f"   {len(pending)} to process, {len(tiles) - len(pending)} unchanged")
+    return pending, manifest
 
-        if not is_usable:
-            qc_status = "NOT_VERIFIABLE"
-            qc_notes.append(quality_note)
-        elif not candidates:
-            qc_status = "VERIFIABLE"
-            has_solar = False
-            qc_notes.append("Clear View: Empty Roof")
-        else:
-            is_valid_signal = (max_conf >= VERIFY_CONF) and (total_area >= MIN_VALID_AREA)
-            
-            if not is_valid_signal:
-                qc_status = "VERIFIABLE"
-                has_solar = False
-                qc_notes.append("Ignored Noise (Weak Signal)")
-            elif buffer_val > 0:
-                qc_status = "VERIFIABLE"
-                has_solar = True
-                qc_notes.append(f"Solar Confirmed (Zone: {buffer_val})")
-            else:
-                qc_status = "VERIFIABLE"
-                has_solar = False # Detected, but outside valid zone
-                qc_notes.append("Solar Detected OUTSIDE 2400 sqft Limit")
-
-        # 4. JSON Output
-        rec = {
-            "sample_id": sid, "lat": site_data['lat'], "lon": site_data['lon'],
-            "has_solar": has_solar, "confidence": round(max_conf, 2),
-            "pv_area_sqm_est": round(total_area, 2),
-            "buffer_radius_sqft": buffer_val,
-            "qc_status": qc_status, "qc_notes": qc_notes,
-            "bbox_or_mask": str([c['box'] for c in candidates]) if candidates else "[]",
-            "image_metadata": {"source": "Google Static Maps", "capture_date": str(date.today())}
-        }
-        rec['integrity_hash'] = generate_trust_hash(rec)
-        
-        with open(os.path.join(JSON_OUT_DIR, f"{sid}.json"), 'w') as jf: json.dump(rec, jf, indent=4)
+def shared_crops(batch):
+    """
+    {sid: (tile_id, dx, dy)} for the sites in batch whose stored tile is still
+    the crop fetch_planner cut from a shared tile.
+    """
+    if not USE_SHARED_TILES: return {}
+    crops, out = fetch_planner.crops_for([b[0] for b in batch]), {}
+    for sid, img_path, site_data, entry in batch:
+        c = crops.get(sid)
+        if c and c[3] == entry['image_hash']: out[sid] = c[:3]
+    return out
+
+def reuse_raw(batch, raw=None, keys=None):
+    """
+    Splits batch into (reusable, rest): sites whose stored raw detections are
+    still current are re-decided from them. Returns the first part as
+    [(sid, entry, rec, det)].
+    """
+    if not batch: return [], []
+    keys = keys or raw_keys()
+    raw = raw if raw is not None else results_store.get_raw_detections([b[0] for b in batch])
+    reused, rest = [], []
+    for sid, img_path, site_data, entry in batch:
+        r = raw.get(sid)
+        if not raw_current(r, entry['image_hash'], keys): rest.append((sid, img_path, site_data, entry)); continue
+        rec, det = site_from_raw(sid, site_data, r, img_path, entry['image_hash'])
+        reused.append((sid, entry, rec, det))
+    return reused, rest
+
+def reclassify_pending(pending, manifest):
+    """
+    Re-decides every pending site whose stored raw detections are still current
+    and records it in the manifest. Returns (reclassified sample_ids, sites that still need the model).
+    """
+    keys, done, rest = raw_keys(), [], []
+    for start in range(0, len(pending), RECLASSIFY_CHUNK):
+        reused, left = reuse_raw(pending[start:start + RECLASSIFY_CHUNK], keys=keys)
+        rest += left
+        if not reused: continue
+        with METRICS.span("write"):
+            save_results([r[2] for r in reused], [r[3] for r in reused])
+        for sid, entry, _, _ in reused:
+            manifest["sites"][sid] = entry
+            done.append(sid)
+    if done:
+        save_manifest(manifest)
+        METRICS.inc("sites_reused_raw", len(done))
+        METRICS.inc("sites_processed", len(done))
+    return done, rest
+
+def run_batch(model, batch, render=RENDER_OVERLAYS, shared=None, raw=None, errors=None):
+    """
+    Decodes one chunk of pending sites, runs the quality gate, infers the usable
+    tiles in a single model call and writes outputs (rejected tiles are recorded
+    as NOT_VERIFIABLE without inference).
+    Sites whose stored raw detections still match their image, weights and gate
+    are re-decided from those without decoding (pass raw to skip the lookup).
+    Sites cropped from a shared tile are sliced out of it and the shared tile
+    is inferred once at full size; pass the same `shared` dict to consecutive
+    calls to keep a tile (and its detections) that spans batches.
+    Returns [(sid, entry)] for the sites that were processed; pass an `errors`
+    dict to collect {sid: reason} for the ones that were not.
+    """
+    keys = raw_keys()
+    reused, batch = reuse_raw(batch, raw, keys) if REUSE_RAW else ([], list(batch))
+    if reused:
+        with METRICS.span("write"):
+            save_results([r[2] for r in reused], [r[3] for r in reused])
+        METRICS.inc("sites_reused_raw", len(reused))
+        METRICS.inc("sites_processed", len(reused))
+    done = [(sid, entry) for sid, entry, _, _ in reused]
+    if not batch: return done
+
+    crops = shared_crops(batch)
+    shared = {} if shared is None else shared
+    for tid in set(shared) - {c[0] for c in crops.values()}: del shared[tid]
+    decoded = []
+    for sid, img_path, site_data, entry in batch:
+        with METRICS.span("decode", sid):
+            img = None
+            if sid in crops:
+                tid, dx, dy = crops[sid]
+                if tid not in shared: shared[tid] = {"img": fetch_planner.load_shared(tid)}
+                if shared[tid]["img"] is not None: img = shared[tid]["img"][dy:dy + fetch_planner.CROP_PX, dx:dx + fetch_planner.CROP_PX]
+            if img is None:
+                crops.pop(sid, None)
+                img = tile_archive.imread(img_path)
+        if img is None:
+            METRICS.inc("errors_decode")
+            if errors is not None: errors[sid] = f"decode: unreadable tile {img_path}"
+            continue
+        with METRICS.span("quality", sid):
+            quality = check_image_quality(img)
+        decoded.append((sid, img_path, img, site_data, entry, quality))
+    if not decoded: return done
     
-        plot = img.copy()
-        
-        # Draw 1200 Ring (Yellow)
-        cv2.circle(plot, (w//2, h//2), int(5.96/scale), (0, 255, 255), 1)
-        # Draw 2400 Ring (Cyan)
-        cv2.circle(plot, (w//2, h//2), int(8.42/scale), (255, 255, 0), 1)
-        
-        if candidates:
-            for c in candidates:
-                x1, y1, x2, y2 = map(int, c['box'])
-                
-                b_color = (0, 0, 255) 
-                
-                if (c['conf'] >= VERIFY_CONF):
-                    # Check Overlap for individual box coloring
-                    cx, cy = w//2, h//2
-                    closest_x = max(x1, min(cx, x2))
-                    closest_y = max(y1, min(cy, y2))
-                    dist = np.sqrt((cx-closest_x)**2 + (cy-closest_y)**2)
-                    
-                    if dist <= (5.96/scale): b_color = (0, 255, 0)      # Green (1200)
-                    elif dist <= (8.42/scale): b_color = (255, 165, 0)  # Orange/Cyan (2400)
-                
-                cv2.rectangle(plot, (x1, y1), (x2, y2), b_color, 2)
-                cv2.putText(plot, f"{c['conf']:.2f}", (x1, y1-5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, b_color, 1)
-
-        status_text = f"SOLAR: {buffer_val}" if has_solar else "NO SOLAR"
-        cv2.putText(plot, status_text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0) if has_solar else (0, 0, 255), 2)
-        cv2.imwrite(os.path.join(ARTIFACT_OUT_DIR, f"{sid}_audit.jpg"), plot)
-        print(f"   👉 {sid}: {status_text} | Zone: {buffer_val}")
+    # Rejected tiles never reach the model
+    usable = [i for i, d in enumerate(decoded) if d[5][0]]
+    detections = [no_detections()] * len(decoded)
+    screened, audited = {}, set()
+    if usable:
+        t0 = time.perf_counter()
+        single = [i for i in usable if decoded[i][0] not in crops]
+        if CASCADE and single:
+            # Stage 1 drops tiles with no signal near the centre; a sample of those still runs in full
+            t1 = time.perf_counter()
+            scores = cascade_scores(model, [decoded[i][2] for i in single], [get_meters_per_pixel(decoded[i][3]['lat']) for i in single])
+            METRICS.observe("cascade_stage1", time.perf_counter() - t1)
+            METRICS.inc("cascade_checked", len(single))
+            passed = []
+            for i, score in zip(single, scores):
+                if score >= CASCADE_SETTINGS["threshold"]:
+                    passed.append(i)
+                    METRICS.inc("cascade_passed")
+                elif cascade.audit_pick(decoded[i][0], CASCADE_SETTINGS["audit_rate"]):
+                    passed.append(i)
+                    audited.add(i)
+                    METRICS.inc("cascade_audited")
+                else: screened[i] = score
+            single = passed
+        if single:
+            for i, det in zip(single, predict_batch(model, [decoded[i][2] for i in single])): detections[i] = det
+        # Each shared tile is inferred once, at its full size, for all of its sites
+        needed = sorted({crops[decoded[i][0]][0] for i in usable if decoded[i][0] in crops} - {t for t, v in shared.items() if "det" in v})
+        if needed:
+            for tid, det in zip(needed, predict_batch(model, [shared[t]["img"] for t in needed], imgsz=fetch_planner.SHARED_PX)):
+                shared[tid]["det"] = det
+            METRICS.inc("shared_tile_inferences", len(needed))
+        for i in usable:
+            if decoded[i][0] not in crops: continue
+            tid, dx, dy = crops[decoded[i][0]]
+            detections[i] = crop_detections(*shared[tid]["det"], dx, dy)
+            METRICS.inc("shared_tile_sites")
+        elapsed = time.perf_counter() - t0
+        METRICS.observe("inference_batch", elapsed)
+        METRICS.inc("batches")
+    records, dets, raws = [], [], []
+    for i, ((sid, img_path, img, site_data, entry, quality), (xyxy, confs)) in enumerate(zip(decoded, detections)):
+        # Batch inference time is shared evenly across the sites that were inferred
+        if quality[0]: METRICS.observe("inference", elapsed / len(usable), sid)
+        try:
+            notes = [cascade_note(screened[i])] if i in screened else None
+            rec, det = process_site(sid, img, site_data, xyxy, confs, img_path, entry['image_hash'], render, quality, notes)
+            if i in audited and rec['has_solar']: METRICS.inc("cascade_audit_misses")
+            records.append(rec)
+            dets.append(det)
+            raws.append(raw_row(sid, entry['image_hash'], img, quality, xyxy, confs, keys, screened.get(i)))
+            done.append((sid, entry))
+        except Exception as e:
+            METRICS.inc("errors_postprocess")
+            if errors is not None: errors[sid] = f"postprocess: {e}"
+            print(f"   ❌ {sid}: {e}")
+    with METRICS.span("write"):
+        save_results(records, dets, raws)
+    METRICS.inc("sites_processed", len(records))
+    return done
+
+def run_pipeline(sample_ids=None, force=False, batch_size=BATCH_SIZE, model=None, render=RENDER_OVERLAYS):
+    """
+    Runs detection over output/images and the tile archive. Sites whose image, coordinates, model weights
+    and thresholds match the manifest are skipped (so auditor edits survive) unless
+    force=True. Pass sample_ids to restrict the run to those sites.
+    Tiles are decoded once and inferred in batches of batch_size; pass an already
+    loaded model to skip loading best.pt. Overlays are rendered lazily by the
+    dashboard unless render=True.
+    Returns the list of sample_ids that were (re)processed.
+    """
+    print("🚀 Running SūryaNetra 'Overlap' Logic...")
+    if not os.path.exists(weights_path()): print(f"❌ No Model ({weights_path()})"); return []
+    
+    with METRICS.span("plan"):
+        pending, manifest = plan_pipeline(sample_ids, force)
+    if not pending: return []
+    processed = []
+    batch_size = max(1, int(batch_size))
+    t_start = time.perf_counter()
+    
+    # Sites whose stored raw detections still match only need the decision tree re-run
+    if REUSE_RAW:
+        with METRICS.span("reclassify"):
+            processed, pending = reclassify_pending(pending, manifest)
+        if processed: print(f"   ♻️ {len(processed)} site(s) re-decided from stored raw detections")
+    
+    if pending and model is None: model = load_model()
+    # Sites cut from the same shared tile run back to back so the tile is inferred once
+    crops = fetch_planner.crops_for([p[0] for p in pending]) if USE_SHARED_TILES else {}
+    pending.sort(key=lambda p: crops[p[0]][0] if p[0] in crops else "")
+    shared = {}
+    checkpoint = ManifestCheckpoint(manifest)
+    try:
+        for start in range(0, len(pending), batch_size):
+            for sid, entry in run_batch(model, pending[start:start + batch_size], render, shared, {}):
+                checkpoint.add(sid, entry)
+                processed.append(sid)
+    finally:
+        checkpoint.flush()
+    
+    elapsed = time.perf_counter() - t_start
+    METRICS.set_gauge("images_per_second", round(len(processed) / elapsed, 3) if elapsed > 0 else 0)
+    quality_gate_report()
+    if CASCADE: cascade_report()
+    METRICS.write("detect")
+    
+    return processed
+
+def reclassify(sample_ids=None, force=False):
+    """
+    Reclassify mode: re-applies the current thresholds and buffer rules to the
+    stored raw detections of every changed site (every site with force=True)
+    and regenerates their records and JSON without loading the model. Sites
+    without current raw detections are left for a normal run.
+    Returns the list of sample_ids that were reclassified.
+    """
+    print("♻️ Reclassifying from stored raw detections...")
+    if not os.path.exists(weights_path()): print(f"❌ No Model ({weights_path()})"); return []
+    t0 = time.perf_counter()
+    with METRICS.span("plan"):
+        pending, manifest = plan_pipeline(sample_ids, force)
+    done, rest = reclassify_pending(pending, manifest)
+    print(f"✅ Reclassified {len(done)} site(s) in {time.perf_counter() - t0:.1f}s"
+          + (f"; {len(rest)} need inference (run without --reclassify)" if rest else ""))
+    METRICS.write("reclassify")
+    return done
 
 if __name__ == "__main__":
-    run_pipeline()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="SūryaNetra detection pipeline")
+    parser.add_argument("sample_ids", nargs="*", help="Only process these sites (default: all)")
+    parser.add_argument("--force", action="store_true", help="Re-process sites even if unchanged")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Tiles per inference call")
+    parser.add_argument("--render-overlays", action="store_true", help="Draw audit overlays now instead of on first view")
+    parser.add_argument("--backend", default=INFERENCE_BACKEND, choices=backends.BACKENDS, help="Inference backend")
+    parser.add_argument("--cascade", action="store_true", help="Screen the centre buffer at low resolution before full detection")
+    parser.add_argument("--reclassify", action="store_true", help="Only re-run the decision tree on stored raw detections")
+    parser.add_argument("--reinfer", action="store_true", help="Ignore stored raw detections and run the model again")
+    args = parser.parse_args()
+    INFERENCE_BACKEND = args.backend
+    os.environ[settings.BACKEND_ENV] = args.backend
+    CASCADE = CASCADE or args.cascade
+    REUSE_RAW = REUSE_RAW and not args.reinfer
+    if args.reclassify: reclassify(args.sample_ids or None, force=args.force)
+    else: run_pipeline(args.sample_ids or None, force=args.force, batch_size=args.batch_size, render=args.render_overlays)
\ No newline at end of file
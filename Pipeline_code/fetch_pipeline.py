@@ -1,49 +1,236 @@
 import os
+import time
+import random
+import hashlib
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from PIL import Image
 from io import BytesIO
+from tile_cache import TileCache, materialize
+import tile_archive
 
-# ---  ENTER YOUR GOOGLE MAPS API KEY HERE  ---
-API_KEY = "api-key-goes-here" 
+# ---  ENTER YOUR GOOGLE MAPS API KEY HERE (or set GOOGLE_MAPS_API_KEY)  ---
+PLACEHOLDER_KEY = "api-key-goes-here"
+API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY", PLACEHOLDER_KEY)
 
 ZOOM_LEVEL = 20
 IMAGE_SIZE = "640x640"
 MAP_TYPE = "satellite"
 
-def fetch_satellite_image(lat, lon, sample_id, output_dir):
+BASE_URL = "https://maps.googleapis.com/maps/api/staticmap"
+REQUEST_TIMEOUT = (5, 30)   # connect, read (seconds)
+MAX_RETRIES = 4             # extra attempts on 429 / 5xx / connection errors
+BACKOFF_BASE = 0.5          # seconds, doubled per attempt (+ jitter)
+MAX_RETRY_AFTER_S = 60.0    # longest Retry-After we honour before retrying anyway
+MAX_WORKERS = 8             # concurrent downloads in fetch_many
+RATE_LIMIT_QPS = 10.0       # sustained requests/sec across all workers
+RETRY_STATUS = {429, 500, 502, 503, 504}
+USE_TILE_CACHE = True
+USE_TILE_ARCHIVE = True     # keep raw responses in tile_archive instead of one re-encoded PNG per site
+
+TILE_CACHE = TileCache()
+
+class FetchError(Exception):
+    pass
+
+def api_key_set():
+    return bool(API_KEY) and API_KEY != PLACEHOLDER_KEY
+
+class TokenBucket:
     """
-    Fetches image from Google Static Maps and saves to output_dir.
+    Thread-safe token bucket: `rate` tokens/sec, bursts up to `capacity`.
     """
-    if API_KEY == "YOUR_API_KEY_HERE" or not API_KEY:
-        print("   ❌ ERROR: API Key not set in fetch_pipeline.py")
-        return None
+    def __init__(self, rate, capacity=None):
+        if rate <= 0: raise ValueError(f"rate must be positive, got {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_local = threading.local()
+
+def get_session(pool_size=MAX_WORKERS):
+    """
+    One keep-alive Session per thread, sized for the worker pool.
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _local.session = session
+    return session
 
-    base_url = "https://maps.googleapis.com/maps/api/staticmap"
+def download_tile(lat, lon, session=None, base_url=BASE_URL, bucket=None, max_retries=MAX_RETRIES, zoom=ZOOM_LEVEL, scale=1):
+    """
+    Downloads the raw Static Maps response for one coordinate, retrying with
+    exponential backoff on 429/5xx and connection errors.
+    """
+    session = session or get_session()
     params = {
         "center": f"{lat},{lon}",
-        "zoom": ZOOM_LEVEL,
+        "zoom": zoom,
         "size": IMAGE_SIZE,
         "maptype": MAP_TYPE,
         "key": API_KEY
     }
-    
+    if scale != 1: params["scale"] = scale
+    last_error = None
+    for attempt in range(max_retries + 1):
+        if bucket is not None: bucket.acquire()
+        delay = None
+        try:
+            response = session.get(base_url, params=params, timeout=REQUEST_TIMEOUT)
+            if response.status_code in RETRY_STATUS:
+                last_error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit(): delay = min(float(retry_after), MAX_RETRY_AFTER_S)
+            else:
+                response.raise_for_status()
+                if b"error_message" in response.content:
+                    raise FetchError(f"Google API Error: {response.content[:200]!r}")
+                return response.content
+        except (requests.ConnectionError, requests.Timeout) as e:
+            last_error = str(e)
+        except requests.HTTPError as e:
+            raise FetchError(str(e))
+        if attempt < max_retries:
+            time.sleep(delay if delay is not None else BACKOFF_BASE * (2 ** attempt) * (1 + random.random() * 0.25))
+    raise FetchError(f"Gave up after {max_retries + 1} attempts: {last_error}")
+
+def save_tile(content, sample_id, output_dir):
+    img = Image.open(BytesIO(content))
+    os.makedirs(output_dir, exist_ok=True)
+    save_path = os.path.join(output_dir, f"{sample_id}.png")
+    # The old file may be a hardlink into the tile cache; never write through it
+    if os.path.exists(save_path): os.remove(save_path)
+    img.save(save_path)
+    return save_path
+
+def store_tile(content, sample_id, output_dir):
+    """
+    Stores the response bytes as-is in the tile archive (or as a PNG in output_dir
+    when USE_TILE_ARCHIVE is off). Returns the tile reference / path.
+    """
+    if USE_TILE_ARCHIVE: return tile_archive.ARCHIVE.put(sample_id, content)
+    return save_tile(content, sample_id, output_dir)
+
+def tile_key(lat, lon):
+    return TILE_CACHE.key(lat, lon, ZOOM_LEVEL, IMAGE_SIZE, MAP_TYPE)
+
+def cache_archived(key, name, content):
+    """
+    Caches a tile that is already archived under `name` as a reference, not a second copy.
+    """
+    TILE_CACHE.put_ref(key, f"{name} {hashlib.sha256(content).hexdigest()}")
+
+def cached_archived(key, archive):
+    """
+    Bytes of a cached tile, read from `archive` for reference entries. None on a
+    miss or when the archived entry has since been replaced.
+    """
+    ref = TILE_CACHE.get_ref(key)
+    if ref is not None:
+        name, digest = ref.rsplit(" ", 1)
+        if archive.hashes([name]).get(name) != digest: return None
+        data = archive.get(name)
+        return bytes(data) if data is not None else None
+    # Entries cached as files before references existed
+    hit = TILE_CACHE.get(key)
+    if hit is None: return None
+    with open(hit, 'rb') as f: return f.read()
+
+def cached_tile(lat, lon, sample_id, output_dir):
+    """
+    Materializes a cached tile into output_dir without touching the network. None on a miss.
+    """
+    if USE_TILE_ARCHIVE:
+        # A no-op append when the cache entry points at this site's own archived tile
+        data = cached_archived(tile_key(lat, lon), tile_archive.ARCHIVE)
+        return tile_archive.ARCHIVE.put(sample_id, data) if data is not None else None
+    hit = TILE_CACHE.get(tile_key(lat, lon))
+    if hit is None: return None
+    return materialize(hit, os.path.join(output_dir, f"{sample_id}.png"))
+
+def fetch_tile(lat, lon, sample_id, output_dir, bucket=None, base_url=BASE_URL,
+               use_cache=USE_TILE_CACHE, check_cache=True, pool_size=MAX_WORKERS):
+    """
+    Cache-or-network fetch of one site into output_dir. Raises FetchError on failure.
+    """
+    if use_cache and check_cache:
+        path = cached_tile(lat, lon, sample_id, output_dir)
+        if path: return path
+    if not api_key_set():
+        raise FetchError("API Key not set in fetch_pipeline.py")
+    content = download_tile(lat, lon, get_session(pool_size), base_url, bucket)
+    path = store_tile(content, sample_id, output_dir)
+    if use_cache:
+        if USE_TILE_ARCHIVE: cache_archived(tile_key(lat, lon), sample_id, content)
+        else: TILE_CACHE.put(tile_key(lat, lon), path)
+    return path
+
+def fetch_satellite_image(lat, lon, sample_id, output_dir, use_cache=USE_TILE_CACHE):
+    """
+    Fetches image from Google Static Maps (or the tile cache) into the tile archive (or output_dir).
+    """
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-
-        if b"error_message" in response.content:
-            print(f"   ❌ Google API Error: {response.content}")
-            return None
-
-        img = Image.open(BytesIO(response.content))
-        
-        os.makedirs(output_dir, exist_ok=True)
-        filename = f"{sample_id}.png"
-        save_path = os.path.join(output_dir, filename)
-        img.save(save_path)
-        
-        return save_path
-        
+        return fetch_tile(lat, lon, sample_id, output_dir, use_cache=use_cache)
     except Exception as e:
         print(f"   ❌ Fetch Failed for {sample_id}: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def fetch_many(sites, output_dir, max_workers=MAX_WORKERS, rate=RATE_LIMIT_QPS,
+               base_url=BASE_URL, progress=None, use_cache=USE_TILE_CACHE):
+    """
+    Fetches many (lat, lon, sample_id) tuples concurrently over pooled connections,
+    rate-limited to `rate` requests/sec. Cache hits never reach the network.
+    `progress(done, total)` is called from the calling thread as sites finish.
+    Returns {sample_id: {"path": str or None, "error": str or None, "cached": bool}}, where
+    path is a tile_archive reference when USE_TILE_ARCHIVE is on.
+    """
+    sites = [(lat, lon, str(sid)) for lat, lon, sid in sites]
+    results = {}
+    if not sites: return results
+
+    to_fetch = []
+    for lat, lon, sid in sites:
+        path = cached_tile(lat, lon, sid, output_dir) if use_cache else None
+        if path: results[sid] = {"path": path, "error": None, "cached": True}
+        else: to_fetch.append((lat, lon, sid))
+    if progress and results: progress(len(results), len(sites))
+    if not to_fetch: return results
+
+    if not api_key_set():
+        results.update({sid: {"path": None, "error": "API Key not set", "cached": False} for _, _, sid in to_fetch})
+        return results
+
+    bucket = TokenBucket(rate)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fetch_tile, lat, lon, sid, output_dir, bucket, base_url, use_cache, False, max_workers): sid
+                   for lat, lon, sid in to_fetch}
+        for fut in as_completed(futures):
+            sid = futures[fut]
+            try:
+                results[sid] = {"path": fut.result(), "error": None, "cached": False}
+            except Exception as e:
+                results[sid] = {"path": None, "error": str(e), "cached": False}
+                print(f"   ❌ Fetch Failed for {sid}: {e}")
+            if progress: progress(len(results), len(sites))
+    return results
@@ -0,0 +1,237 @@
+import os
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+import fetch_pipeline
+import sqlite_journal
+import tile_archive
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAN_PATH = os.path.join(BASE_DIR, "output", "fetch_plan.db")
+ZOOM_LEVEL = fetch_pipeline.ZOOM_LEVEL
+CROP_PX = 640             # per-site tile, same footprint as fetch_satellite_image
+SHARED_SCALE = 2          # one zoom-19 request at scale=2 has zoom-20 ground resolution ...
+SHARED_ZOOM = ZOOM_LEVEL - 1
+SHARED_PX = 640 * SHARED_SCALE   # ... and covers 1280x1280 zoom-20 pixels
+SHARED_FOOTER_PX = 100    # bottom band of a shared tile with the Google logo / attribution; crops stay above it
+MIN_GROUP = 2             # clusters smaller than this are fetched per site as before
+
+SHARED_ARCHIVE = tile_archive.TileArchive(os.path.join(tile_archive.ARCHIVE_DIR, "shared"))
+
+# Which sites were cropped out of which shared tile. crop_sha256 is the hash of
+# the stored crop, so a site re-fetched on its own later no longer matches.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_tiles (
+    tile_id TEXT PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    sites INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS site_crops (
+    sample_id TEXT PRIMARY KEY,
+    tile_id TEXT NOT NULL,
+    dx INTEGER NOT NULL,
+    dy INTEGER NOT NULL,
+    crop_sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_site_crops_tile ON site_crops(tile_id);
+"""
+
+_local = threading.local()
+
+def connect(db_path=None):
+    db_path = db_path or PLAN_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None: conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        sqlite_journal.apply(conn, db_path)
+        conn.executescript(SCHEMA)
+        conns[db_path] = conn
+    return conn
+
+# --- WEB MERCATOR ---
+# Global pixel coordinates of 256px tiles at `zoom`; one pixel spans
+# detect.get_meters_per_pixel(lat, zoom) metres on the ground.
+def to_pixel(lat, lon, zoom=ZOOM_LEVEL):
+    world = 256 * 2 ** zoom
+    s = math.sin(math.radians(lat))
+    return (lon + 180.0) / 360.0 * world, (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * world
+
+def to_latlon(x, y, zoom=ZOOM_LEVEL):
+    world = 256 * 2 ** zoom
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world)))), x / world * 360.0 - 180.0
+
+# --- PLANNING ---
+def plan(sites, min_group=MIN_GROUP):
+    """
+    Groups (lat, lon, sample_id) sites into shared tiles. Each site's centred
+    CROP_PX window must fit inside its shared tile (above the footer band).
+    Strips of sites are taken top to bottom and covered left to right, which
+    is optimal along each strip. Returns (groups, singles): groups are dicts
+    with the tile centre and [(sid, dx, dy)] crop offsets, singles are the
+    (lat, lon, sid) sites still fetched one by one.
+    """
+    half = CROP_PX // 2
+    # One pixel of slack for rounding the crop offsets
+    span_x = SHARED_PX - CROP_PX - 1
+    span_y = SHARED_PX - SHARED_FOOTER_PX - CROP_PX - 1
+    pts = sorted((*to_pixel(lat, lon)[::-1], lat, lon, str(sid)) for lat, lon, sid in sites)
+    groups, singles, i = [], [], 0
+    while i < len(pts):
+        j = i
+        while j < len(pts) and pts[j][0] <= pts[i][0] + span_y: j += 1
+        top = int(math.floor(pts[i][0])) - half
+        strip = sorted(pts[i:j], key=lambda p: p[1])
+        k = 0
+        while k < len(strip):
+            m = k
+            while m < len(strip) and strip[m][1] <= strip[k][1] + span_x: m += 1
+            members, left = strip[k:m], int(math.floor(strip[k][1])) - half
+            if len(members) < min_group:
+                singles.extend((lat, lon, sid) for _, _, lat, lon, sid in members)
+            else:
+                lat, lon = to_latlon(left + SHARED_PX // 2, top + SHARED_PX // 2)
+                crops = [(sid, int(round(x - half - left)), int(round(y - half - top))) for y, x, _, _, sid in members]
+                groups.append({"tile_id": f"z{ZOOM_LEVEL}_{left}_{top}", "lat": lat, "lon": lon, "sites": crops})
+            k = m
+        i = j
+    return groups, singles
+
+def summarize(groups, singles):
+    n_sites = sum(len(g["sites"]) for g in groups) + len(singles)
+    calls = len(groups) + len(singles)
+    return {"sites": n_sites, "shared_tiles": len(groups), "single_tiles": len(singles),
+            "api_calls": calls, "api_calls_saved": n_sites - calls}
+
+# --- FETCHING ---
+def shared_key(lat, lon):
+    return fetch_pipeline.TILE_CACHE.key(lat, lon, SHARED_ZOOM, f"{fetch_pipeline.IMAGE_SIZE}@{SHARED_SCALE}x", fetch_pipeline.MAP_TYPE)
+
+def _decode(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def fetch_group(group, output_dir, bucket=None, base_url=fetch_pipeline.BASE_URL, use_cache=fetch_pipeline.USE_TILE_CACHE,
+                pool_size=fetch_pipeline.MAX_WORKERS, db_path=None):
+    """
+    Fetches one shared tile (cache first), then writes each member site's
+    centred crop through fetch_pipeline.store_tile and records where it came from.
+    Returns ({sample_id: path}, cached).
+    """
+    key = shared_key(group["lat"], group["lon"])
+    content = fetch_pipeline.cached_archived(key, SHARED_ARCHIVE) if use_cache else None
+    cached = content is not None
+    if not cached:
+        if not fetch_pipeline.api_key_set():
+            raise fetch_pipeline.FetchError("API Key not set")
+        content = fetch_pipeline.download_tile(group["lat"], group["lon"], fetch_pipeline.get_session(pool_size), base_url,
+                                               bucket, zoom=SHARED_ZOOM, scale=SHARED_SCALE)
+    img = _decode(content)
+    if img is None or img.shape[:2] != (SHARED_PX, SHARED_PX):
+        raise fetch_pipeline.FetchError(f"unexpected shared tile for {group['tile_id']}")
+    SHARED_ARCHIVE.put(group["tile_id"], content)
+    # The cache only points at the archived shared tile
+    if use_cache and not cached: fetch_pipeline.cache_archived(key, group["tile_id"], content)
+
+    paths, rows = {}, []
+    for sid, dx, dy in group["sites"]:
+        ok, buf = cv2.imencode(".png", img[dy:dy + CROP_PX, dx:dx + CROP_PX])
+        if not ok: raise fetch_pipeline.FetchError(f"could not encode crop for {sid}")
+        path = fetch_pipeline.store_tile(buf.tobytes(), sid, output_dir)
+        # Hash what was actually stored (store_tile may re-encode when the archive is off)
+        rows.append((sid, group["tile_id"], dx, dy, hashlib.sha256(bytes(tile_archive.read_bytes(path))).hexdigest()))
+        paths[sid] = path
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO shared_tiles VALUES (?, ?, ?, ?, ?)",
+                     (group["tile_id"], group["lat"], group["lon"], len(group["sites"]), time.time()))
+        conn.executemany("INSERT OR REPLACE INTO site_crops VALUES (?, ?, ?, ?, ?)", rows)
+    return paths, cached
+
+def fetch_planned(sites, output_dir, max_workers=fetch_pipeline.MAX_WORKERS, rate=fetch_pipeline.RATE_LIMIT_QPS,
+                  base_url=fetch_pipeline.BASE_URL, progress=None, use_cache=fetch_pipeline.USE_TILE_CACHE, min_group=MIN_GROUP):
+    """
+    fetch_many for clustered sites: shared tiles for groups, per-site tiles for the rest.
+    Returns (results, report) with results shaped like fetch_many's and report
+    counting the API calls made and saved.
+    """
+    groups, singles = plan(sites, min_group)
+    report = summarize(groups, singles)
+    total = report["sites"]
+    results = fetch_pipeline.fetch_many(singles, output_dir, max_workers, rate, base_url,
+                                        (lambda d, _: progress(d, total)) if progress else None, use_cache)
+    calls = sum(1 for r in results.values() if r["path"] and not r["cached"])
+    if groups:
+        bucket = fetch_pipeline.TokenBucket(rate)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch_group, g, output_dir, bucket, base_url, use_cache, max_workers): g
+                       for g in groups}
+            for fut in as_completed(futures):
+                g = futures[fut]
+                try:
+                    paths, cached = fut.result()
+                    results.update({sid: {"path": p, "error": None, "cached": cached} for sid, p in paths.items()})
+                    calls += 0 if cached else 1
+                except Exception as e:
+                    results.update({sid: {"path": None, "error": str(e), "cached": False} for sid, _, _ in g["sites"]})
+                    print(f"   ❌ Shared tile {g['tile_id']} failed ({len(g['sites'])} sites): {e}")
+                if progress: progress(len(results), total)
+    report["api_calls_made"] = calls
+    return results, report
+
+# --- DETECTION SUPPORT ---
+def crops_for(sample_ids, db_path=None):
+    """
+    {sample_id: (tile_id, dx, dy, crop_sha256)} for the given sites that came from a shared tile.
+    """
+    conn, out, ids = connect(db_path), {}, [str(s) for s in sample_ids]
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        q = f"SELECT sample_id, tile_id, dx, dy, crop_sha256 FROM site_crops WHERE sample_id IN ({','.join('?' * len(chunk))})"
+        out.update({sid: (tid, dx, dy, h) for sid, tid, dx, dy, h in conn.execute(q, chunk)})
+    return out
+
+def load_shared(tile_id):
+    """
+    Decoded shared tile, or None if it is not archived.
+    """
+    data = SHARED_ARCHIVE.get(tile_id)
+    return None if data is None else _decode(data)
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import coord_store
+    parser = argparse.ArgumentParser(description="Fetch clustered sites through shared tiles")
+    parser.add_argument("coord_file", nargs="?", default=None, help="CSV / Parquet / xlsx to ingest first")
+    parser.add_argument("--out", default=os.path.join(BASE_DIR, "output", "images"))
+    parser.add_argument("--min-group", type=int, default=MIN_GROUP)
+    parser.add_argument("--plan-only", action="store_true", help="Only report how many API calls the plan saves")
+    parser.add_argument("--detect", action="store_true", help="Run detection over the fetched sites afterwards")
+    args = parser.parse_args()
+
+    source = None
+    if args.coord_file:
+        coord_store.ingest(args.coord_file)
+        source = os.path.abspath(args.coord_file)
+    sites = list(coord_store.iter_sites(source))
+    if args.plan_only:
+        print(json.dumps(summarize(*plan(sites, args.min_group)), indent=1))
+    else:
+        results, report = fetch_planned(sites, args.out, min_group=args.min_group)
+        print(json.dumps(report, indent=1))
+        ok = [sid for sid, r in results.items() if r["path"]]
+        print(f"✅ {len(ok)}/{len(results)} site(s) fetched, {report['api_calls_saved']} API call(s) saved by sharing")
+        if args.detect and ok:
+            import detect
+            detect.run_pipeline(ok)
@@ -0,0 +1,63 @@
+import numpy as np
+
+# Buffer zone radii (metres) around the site centre
+R_1200_M = 5.96
+R_2400_M = 8.42
+
+def filter_mask(xyxy, w, h, footer_px, edge_px, max_aspect):
+    """
+    Boolean mask over an (N,4) xyxy array: drops boxes in the Google footer,
+    touching the tile edges, degenerate, or more elongated than max_aspect.
+    """
+    x1, y1, x2, y2 = xyxy[:, 0], xyxy[:, 1], xyxy[:, 2], xyxy[:, 3]
+    bw, bh = x2 - x1, y2 - y1
+    short, long = np.minimum(bw, bh), np.maximum(bw, bh)
+    mask = (y2 <= h - footer_px) & (x1 >= edge_px) & (y1 >= edge_px) & (x2 <= w - edge_px) & (short != 0)
+    return mask & (long <= max_aspect * np.where(short == 0, 1, short))
+
+def box_areas_sqm(xyxy, scale):
+    return np.round((xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1]) * (scale ** 2), 2)
+
+def centre_distances(xyxy, w, h):
+    """
+    Distance (px) from the tile centre to the closest point of each box (0 if it contains the centre).
+    """
+    cx, cy = w // 2, h // 2
+    dx = cx - np.clip(cx, xyxy[:, 0], xyxy[:, 2])
+    dy = cy - np.clip(cy, xyxy[:, 1], xyxy[:, 3])
+    return np.hypot(dx, dy)
+
+def box_zones(distances, scale):
+    """
+    Per-box zone membership: 1200, 2400 or 0 (outside both buffers).
+    """
+    scale = float(scale)
+    return np.where(distances <= R_1200_M / scale, 1200, np.where(distances <= R_2400_M / scale, 2400, 0))
+
+def buffer_zone(zones):
+    """
+    Aggregate zone for a site: any box touching the 1200 buffer wins, then 2400.
+    """
+    if np.any(zones == 1200): return 1200
+    if np.any(zones == 2400): return 2400
+    return 0
+
+def analyze_boxes(xyxy, confs, w, h, scale, footer_px, edge_px, max_aspect):
+    """
+    One pass over the raw detections. Returns the kept boxes with their
+    confidences, areas, centre distances and zones, plus site-level aggregates.
+    """
+    xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+    confs = np.asarray(confs, dtype=np.float64).reshape(-1)
+    keep = filter_mask(xyxy, w, h, footer_px, edge_px, max_aspect)
+    boxes, kept_confs = xyxy[keep], confs[keep]
+    areas = box_areas_sqm(boxes, scale)
+    distances = centre_distances(boxes, w, h)
+    zones = box_zones(distances, scale)
+    return {
+        "keep": keep, "boxes": boxes, "confs": kept_confs,
+        "areas": areas, "distances": distances, "zones": zones,
+        "total_area": float(areas.sum()),
+        "max_conf": float(kept_confs.max()) if len(kept_confs) else 0.0,
+        "buffer_zone": buffer_zone(zones),
+    }
@@ -0,0 +1,259 @@
+import os
+import sys
+import time
+import pickle
+import secrets
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import backends
+import detect
+import metrics
+from metrics import METRICS
+
+# --- SERVICE CONFIG ---
+HOST = "127.0.0.1"
+PORT = int(os.environ.get("SURYANETRA_INFER_PORT", 6060))
+KEY_PATH = os.environ.get("SURYANETRA_INFER_KEY_FILE", os.path.join(detect.BASE_DIR, "output", "inference.key"))
+NUM_WORKERS = int(os.environ.get("SURYANETRA_INFER_WORKERS", 1))
+WARMUP_TIMEOUT_S = 300    # give up (and report it in health) if the workers haven't loaded the model by then
+
+def auth_key(path=None):
+    """
+    Per-install secret for the service socket, created on first use in a file
+    only this user can read. The connection carries pickles, so it must never
+    be a shared constant.
+    """
+    path = path or KEY_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Existing key, or another process is writing it right now
+        for _ in range(50):
+            with open(path, "rb") as f: key = f.read().strip()
+            if key: return key
+            time.sleep(0.1)
+        raise RuntimeError(f"inference key file {path} is empty")
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, "wb") as f: f.write(key)
+    return key
+
+# Per-process model handle, filled in by _init_worker
+_MODEL = None
+
+def _init_worker(num_workers, backend):
+    """
+    Loads the model once per worker process and warms it up on a blank tile.
+    """
+    global _MODEL
+    detect.INFERENCE_BACKEND = backend
+    _MODEL = detect.load_model(threads=max(1, (os.cpu_count() or 1) // num_workers))
+    detect.predict_batch(_MODEL, [np.zeros((640, 640, 3), dtype=np.uint8)])
+
+def _worker_ping(_):
+    return os.getpid(), _MODEL is not None
+
+def _worker_run(batch):
+    # Spans and counters recorded in this worker travel back with the results
+    done = detect.run_batch(_MODEL, batch)
+    return done, METRICS.drain()
+
+class InferenceServer:
+    """
+    Holds a pool of worker processes with the model resident and serves jobs
+    over a local authenticated socket.
+    """
+    def __init__(self, num_workers=NUM_WORKERS, host=HOST, port=PORT, authkey=None):
+        self.num_workers = max(1, int(num_workers))
+        self.address = (host, port)
+        self.authkey = authkey or auth_key()
+        self.pool = None
+        self.ready = False
+        self.error = None
+        self.started_at = time.time()
+        self.jobs_done = 0
+        self.sites_done = 0
+        self.manifest_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def warm_up(self, timeout=WARMUP_TIMEOUT_S):
+        """
+        Starts the worker pool. A worker whose initializer fails is respawned
+        by the pool forever, so the ping is bounded by `timeout` and a failure
+        is reported through health() instead of hanging.
+        """
+        t0 = time.time()
+        try:
+            if not os.path.exists(detect.weights_path()): raise FileNotFoundError(f"no model at {detect.weights_path()}")
+            self.pool = mp.Pool(self.num_workers, initializer=_init_worker, initargs=(self.num_workers, detect.INFERENCE_BACKEND))
+            pings = self.pool.map_async(_worker_ping, range(self.num_workers * 2)).get(timeout)
+            pids = {pid for pid, ok in pings if ok}
+        except Exception as e:
+            if isinstance(e, mp.TimeoutError): e = f"workers not ready after {timeout}s (model failed to load?)"
+            self.error = str(e)
+            print(f"❌ Warm-up failed: {e}")
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            return
+        self.ready = True
+        METRICS.set_gauge("warmup_seconds", round(time.time() - t0, 3))
+        METRICS.set_gauge("workers", self.num_workers)
+        print(f"✅ Model warm in {len(pids)} worker(s) after {time.time() - t0:.1f}s")
+
+    def health(self):
+        return {"ready": self.ready, "error": self.error, "workers": self.num_workers, "pid": os.getpid(),
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "jobs_done": self.jobs_done, "sites_done": self.sites_done}
+
+    def run_job(self, sample_ids=None, force=False, batch_size=detect.BATCH_SIZE):
+        # Planning and manifest writes stay in this process; workers only infer and write outputs
+        with self.manifest_lock:
+            pending, _ = detect.plan_pipeline(sample_ids, force)
+        batch_size = max(1, int(batch_size))
+        chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        processed, entries = [], {}
+        t0 = time.perf_counter()
+        saved = time.monotonic()
+        for done, worker_metrics in self.pool.imap_unordered(_worker_run, chunks):
+            METRICS.merge(worker_metrics)
+            entries.update(done)
+            processed += [sid for sid, _ in done]
+            if time.monotonic() - saved >= detect.MANIFEST_SAVE_S:
+                self._save_entries(entries)
+                entries, saved = {}, time.monotonic()
+        self._save_entries(entries)
+        elapsed = time.perf_counter() - t0
+        self.jobs_done += 1
+        self.sites_done += len(processed)
+        METRICS.observe("job", elapsed)
+        METRICS.inc("jobs")
+        METRICS.inc("sites_processed", len(processed))
+        if processed: METRICS.set_gauge("images_per_second", round(len(processed) / elapsed, 3))
+        return processed
+
+    def _save_entries(self, entries):
+        # Re-read under the lock so concurrent jobs don't drop each other's entries
+        if not entries: return
+        with self.manifest_lock:
+            manifest = detect.load_manifest()
+            manifest["sites"].update(entries)
+            detect.save_manifest(manifest)
+
+    def handle(self, conn):
+        try:
+            while True:
+                try: req = conn.recv()
+                except EOFError: break
+                op = req.get("op")
+                try:
+                    if op == "health":
+                        resp = {"ok": True, "result": self.health()}
+                    elif op == "run":
+                        if not self.ready:
+                            resp = {"ok": False, "error": self.error or "warming up"}
+                        else:
+                            result = self.run_job(req.get("sample_ids"), req.get("force", False),
+                                                  req.get("batch_size", detect.BATCH_SIZE))
+                            resp = {"ok": True, "result": result}
+                    elif op == "shutdown":
+                        resp = {"ok": True, "result": None}
+                        self.stop_event.set()
+                        # Wake the accept() loop so serve_forever can exit
+                        threading.Thread(target=lambda: Client(self.address, authkey=self.authkey).close(), daemon=True).start()
+                    else:
+                        resp = {"ok": False, "error": f"unknown op {op!r}"}
+                except Exception as e:
+                    METRICS.inc("errors_job")
+                    resp = {"ok": False, "error": str(e)}
+                conn.send(resp)
+                if self.stop_event.is_set(): break
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        listener = Listener(self.address, authkey=self.authkey)
+        print(f"🛰️ Inference service listening on {self.address[0]}:{self.address[1]}")
+        threading.Thread(target=self.warm_up, daemon=True).start()
+        try:
+            while not self.stop_event.is_set():
+                try: conn = listener.accept()
+                except Exception as e:
+                    print(f"   ❌ Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+
+# --- CLIENT ---
+def _request(payload, address=(HOST, PORT), authkey=None):
+    conn = Client(address, authkey=authkey or auth_key())
+    try:
+        conn.send(payload)
+        resp = conn.recv()
+    finally:
+        conn.close()
+    if not resp.get("ok"): raise RuntimeError(resp.get("error", "inference service error"))
+    return resp["result"]
+
+def health(address=(HOST, PORT)):
+    """
+    Returns the service health dict, or None if nothing (or something other
+    than our service, e.g. one started with another key file) is listening.
+    """
+    # The handshake asserts when the listener isn't a multiprocessing one at all
+    try: return _request({"op": "health"}, address)
+    except (OSError, EOFError, mp.AuthenticationError, AssertionError, ValueError, pickle.UnpicklingError): return None
+
+def submit(sample_ids=None, force=False, batch_size=detect.BATCH_SIZE, address=(HOST, PORT)):
+    """
+    Runs a detection job on the service and returns the processed sample_ids.
+    """
+    return _request({"op": "run", "sample_ids": sample_ids, "force": force, "batch_size": batch_size}, address)
+
+def run_detection(sample_ids=None, force=False):
+    """
+    Uses the warm service if it is up, otherwise falls back to an in-process run.
+    """
+    status = health()
+    if status and status.get("ready"):
+        try: return submit(sample_ids, force)
+        except (OSError, EOFError, RuntimeError, mp.AuthenticationError) as e:
+            print(f"   ⚠️ Inference service failed ({e}), running in-process")
+    return detect.run_pipeline(sample_ids, force=force)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SūryaNetra persistent inference service")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_serve = sub.add_parser("serve", help="Start the service")
+    p_serve.add_argument("--workers", type=int, default=NUM_WORKERS)
+    p_serve.add_argument("--port", type=int, default=PORT)
+    p_serve.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus /metrics on this port")
+    p_serve.add_argument("--backend", default=detect.INFERENCE_BACKEND, choices=backends.BACKENDS, help="Inference backend")
+    sub.add_parser("health", help="Print service health")
+    p_run = sub.add_parser("run", help="Submit a detection job")
+    p_run.add_argument("sample_ids", nargs="*")
+    p_run.add_argument("--force", action="store_true")
+    sub.add_parser("stop", help="Shut the service down")
+    args = parser.parse_args()
+
+    if args.cmd == "serve":
+        if args.metrics_port: metrics.serve(args.metrics_port)
+        detect.INFERENCE_BACKEND = args.backend
+        InferenceServer(args.workers, port=args.port).serve_forever()
+    elif args.cmd == "health":
+        print(health() or "❌ Service not running")
+    elif args.cmd == "run":
+        done = submit(args.sample_ids or None, force=args.force)
+        print(f"✅ Processed {len(done)} site(s)")
+    elif args.cmd == "stop":
+        _request({"op": "shutdown"})
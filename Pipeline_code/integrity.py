@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST_PATH = os.path.join(BASE_DIR, "output", "integrity_manifest.json")
+VERIFY_CHUNK = 2000       # records hashed per worker task in the bulk verifiers
+
+# Merkle tree over per-record hashes, stored next to the records in the results
+# store. Leaves are numbered in the order sites first reached the store; a node
+# without a right sibling is carried up unchanged.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS merkle_leaves (
+    sample_id TEXT PRIMARY KEY,
+    pos INTEGER NOT NULL UNIQUE,
+    record_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS merkle_nodes (
+    level INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (level, idx)
+);
+"""
+
+LEAF, NODE = b"\x00", b"\x01"   # domain separation so a leaf can never pass for an inner node
+
+def record_hash(rec):
+    """
+    sha256 of a record's content without its integrity_hash (same as detect.generate_trust_hash at creation).
+    """
+    body = {k: v for k, v in rec.items() if k != 'integrity_hash'}
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+def leaf_node(rec_hash):
+    return hashlib.sha256(LEAF + bytes.fromhex(rec_hash)).digest()
+
+def parent_node(left, right):
+    return left if right is None else hashlib.sha256(NODE + left + right).digest()
+
+def build_levels(leaves):
+    """
+    All levels of the tree (leaf nodes first) for a list of leaf node hashes.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        prev = levels[-1]
+        levels.append([parent_node(prev[i], prev[i + 1] if i + 1 < len(prev) else None) for i in range(0, len(prev), 2)])
+    return levels
+
+def init(conn):
+    conn.executescript(SCHEMA)
+
+def size(conn):
+    return conn.execute("SELECT COALESCE(MAX(pos) + 1, 0) FROM merkle_leaves").fetchone()[0]
+
+def _node(conn, level, idx):
+    row = conn.execute("SELECT hash FROM merkle_nodes WHERE level = ? AND idx = ?", (level, idx)).fetchone()
+    return row[0] if row else None
+
+def rebuild(conn):
+    """
+    Recomputes every leaf and node from the records table. Call inside the caller's transaction.
+    Returns the number of leaves.
+    """
+    # Sites keep their existing positions; new ones follow in revision order
+    rows = conn.execute("SELECT r.sample_id, r.record FROM records r LEFT JOIN merkle_leaves l USING (sample_id) "
+                        "ORDER BY l.pos IS NULL, l.pos, r.rev, r.sample_id").fetchall()
+    rows = [(sid, record_hash(json.loads(raw))) for sid, raw in rows]
+    conn.execute("DELETE FROM merkle_leaves")
+    conn.execute("DELETE FROM merkle_nodes")
+    conn.executemany("INSERT INTO merkle_leaves VALUES (?, ?, ?)", [(sid, pos, h) for pos, (sid, h) in enumerate(rows)])
+    levels = build_levels([leaf_node(h) for _, h in rows])
+    conn.executemany("INSERT INTO merkle_nodes VALUES (?, ?, ?)",
+                     [(level, idx, node) for level, nodes in enumerate(levels) for idx, node in enumerate(nodes)])
+    return len(rows)
+
+def ensure(conn):
+    """
+    Builds the tree for a store that predates it (records present, no leaves yet).
+    """
+    if conn.execute("SELECT 1 FROM merkle_leaves LIMIT 1").fetchone(): return
+    if conn.execute("SELECT 1 FROM records LIMIT 1").fetchone(): rebuild(conn)
+
+def update_many(conn, items):
+    """
+    Sets the leaves for [(sample_id, record_hash)] and rehashes only their paths
+    to the root: O(k log N) for k changed sites. Call inside the caller's transaction.
+    """
+    if not items: return
+    n = size(conn)
+    dirty = set()
+    for sid, h in items:
+        row = conn.execute("SELECT pos FROM merkle_leaves WHERE sample_id = ?", (sid,)).fetchone()
+        if row: pos = row[0]
+        else: pos, n = n, n + 1
+        conn.execute("INSERT OR REPLACE INTO merkle_leaves VALUES (?, ?, ?)", (sid, pos, h))
+        conn.execute("INSERT OR REPLACE INTO merkle_nodes VALUES (0, ?, ?)", (pos, leaf_node(h)))
+        dirty.add(pos)
+    level, width = 0, n
+    while width > 1:
+        parents = {i // 2 for i in dirty}
+        for p in sorted(parents):
+            right = _node(conn, level, 2 * p + 1) if 2 * p + 1 < width else None
+            conn.execute("INSERT OR REPLACE INTO merkle_nodes VALUES (?, ?, ?)",
+                         (level + 1, p, parent_node(_node(conn, level, 2 * p), right)))
+        dirty, width, level = parents, (width + 1) // 2, level + 1
+
+def root(conn):
+    n, level = size(conn), 0
+    if n == 0: return None
+    while n > 1: n, level = (n + 1) // 2, level + 1
+    return _node(conn, level, 0).hex()
+
+def proof(conn, sample_id):
+    """
+    Inclusion proof for one site: its record hash, position and the O(log N)
+    sibling hashes up to the root. None if the site is not in the tree.
+    """
+    row = conn.execute("SELECT pos, record_hash FROM merkle_leaves WHERE sample_id = ?", (str(sample_id),)).fetchone()
+    if row is None: return None
+    pos, rec_hash = row
+    n = size(conn)
+    path, idx, width, level = [], pos, n, 0
+    while width > 1:
+        sib = idx ^ 1
+        if sib < width: path.append(["L" if sib < idx else "R", _node(conn, level, sib).hex()])
+        idx, width, level = idx // 2, (width + 1) // 2, level + 1
+    return {"sample_id": str(sample_id), "record_hash": rec_hash, "pos": pos, "leaves": n,
+            "path": path, "root": root(conn)}
+
+def verify_proof(rec, prf, expected_root=None):
+    """
+    Checks a record (dict) or record hash against an inclusion proof and the root
+    (the proof's own root unless expected_root is given, e.g. a published manifest).
+    """
+    h = record_hash(rec) if isinstance(rec, dict) else rec
+    if h != prf["record_hash"]: return False
+    node = leaf_node(h)
+    for side, sib in prf["path"]:
+        node = hashlib.sha256(NODE + bytes.fromhex(sib) + node).digest() if side == "L" else hashlib.sha256(NODE + node + bytes.fromhex(sib)).digest()
+    return node.hex() == (expected_root or prf["root"])
+
+# --- BULK VERIFICATION ---
+def _hash_raw(chunk):
+    return [(sid, record_hash(json.loads(raw))) for sid, raw in chunk]
+
+def _hash_files(paths):
+    out = []
+    for path in paths:
+        try:
+            with open(path) as f: rec = json.load(f)
+            out.append((str(rec.get('sample_id', os.path.splitext(os.path.basename(path))[0])), record_hash(rec)))
+        except (OSError, ValueError): out.append((os.path.splitext(os.path.basename(path))[0], None))
+    return out
+
+def _chunks(it, n):
+    buf = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= n: yield buf; buf = []
+    if buf: yield buf
+
+def _tally(results, leaves, mismatched, untracked):
+    for sid, h in results:
+        if sid not in leaves: untracked.append(sid)
+        elif h != leaves[sid]: mismatched.append(sid)
+    return len(results)
+
+def _compare(conn, hash_fn, chunks, workers, expected_root):
+    leaves = dict(conn.execute("SELECT sample_id, record_hash FROM merkle_leaves"))
+    checked, mismatched, untracked = 0, [], []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # A bounded window of chunks in flight keeps memory flat on large stores
+        window = deque()
+        for chunk in chunks:
+            window.append(pool.submit(hash_fn, chunk))
+            if len(window) < pool._max_workers * 2: continue
+            checked += _tally(window.popleft().result(), leaves, mismatched, untracked)
+        while window: checked += _tally(window.popleft().result(), leaves, mismatched, untracked)
+    # The root is recomputed from the leaf hashes, so a tampered node table is caught too
+    ordered = [h for _, h in sorted((pos, h) for pos, h in conn.execute("SELECT pos, record_hash FROM merkle_leaves"))]
+    computed = build_levels([leaf_node(h) for h in ordered])[-1][0].hex() if ordered else None
+    stored = root(conn)
+    return {"checked": checked, "mismatched": mismatched, "untracked": untracked,
+            "root": computed, "root_ok": computed == stored and (expected_root is None or computed == expected_root)}
+
+def verify_store(db_path=None, workers=None, expected_root=None):
+    """
+    Re-hashes every record in the store in parallel and checks it against its leaf and the root.
+    """
+    import results_store
+    conn = results_store.connect(db_path)
+    rows = conn.execute("SELECT sample_id, record FROM records")
+    return _compare(conn, _hash_raw, _chunks(rows, VERIFY_CHUNK), workers, expected_root)
+
+def verify_dir(json_dir=None, db_path=None, workers=None, expected_root=None):
+    """
+    Same check for a directory of per-site JSON files (e.g. Prediction_files or a copy handed to an auditor).
+    """
+    import results_store
+    json_dir = json_dir or results_store.JSON_DIR
+    paths = (e.path for e in os.scandir(json_dir) if e.name.endswith('.json'))
+    return _compare(results_store.connect(db_path), _hash_files, _chunks(paths, VERIFY_CHUNK), workers, expected_root)
+
+def write_manifest(db_path=None, path=MANIFEST_PATH):
+    """
+    Publishes the current root and leaf count; keep a copy off-box to detect rewrites of the store itself.
+    """
+    import results_store
+    conn = results_store.connect(db_path)
+    manifest = {"root": root(conn), "leaves": size(conn), "generated_at": time.time()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f: json.dump(manifest, f, indent=1)
+    return manifest
+
+if __name__ == "__main__":
+    import argparse
+    import results_store
+    parser = argparse.ArgumentParser(description="SūryaNetra Merkle integrity manifest")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("rebuild", help="Recompute the tree from the stored records")
+    sub.add_parser("manifest", help="Write output/integrity_manifest.json with the current root")
+    p_proof = sub.add_parser("proof", help="Print the inclusion proof for one site")
+    p_proof.add_argument("sample_id")
+    p_ver = sub.add_parser("verify", help="Bulk-verify the store (or a JSON directory) in parallel")
+    p_ver.add_argument("--dir", default=None, help="Verify per-site JSON files in this directory instead")
+    p_ver.add_argument("--workers", type=int, default=None)
+    p_ver.add_argument("--manifest", default=None, help="Also require the root published in this manifest")
+    args = parser.parse_args()
+
+    conn = results_store.connect()
+    if args.cmd == "rebuild":
+        with conn: n = rebuild(conn)
+        print(f"✅ {n} leaves, root {root(conn)}")
+    elif args.cmd == "manifest": print(json.dumps(write_manifest(), indent=1))
+    elif args.cmd == "proof": print(json.dumps(proof(conn, args.sample_id), indent=1))
+    elif args.cmd == "verify":
+        expected = None
+        if args.manifest:
+            with open(args.manifest) as f: expected = json.load(f)["root"]
+        t0 = time.time()
+        res = verify_dir(args.dir, workers=args.workers, expected_root=expected) if args.dir else verify_store(workers=args.workers, expected_root=expected)
+        ok = res["root_ok"] and not res["mismatched"]
+        print(f"{'✅' if ok else '❌'} {res['checked']} record(s) in {time.time() - t0:.1f}s: "
+              f"{len(res['mismatched'])} mismatched, {len(res['untracked'])} untracked, root {'ok' if res['root_ok'] else 'MISMATCH'}")
+        for sid in res["mismatched"][:20]: print(f"   ❌ {sid}")
@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+import subprocess
+
+import settings
+import sqlite_journal
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(BASE_DIR, "output", "jobs.db")
+LOG_PATH = os.path.join(BASE_DIR, "output", "jobs_worker.log")
+HEARTBEAT_S = 2.0         # worker heartbeat / progress flush / cancel check interval
+STALE_S = 60.0            # a worker silent for this long is treated as dead and its job requeued
+IDLE_EXIT_S = 5.0         # a worker with nothing queued for this long exits
+
+# Job state and per-site progress, written by the worker process and polled by
+# the dashboard. Jobs carry their own site list so a worker needs nothing else
+# to resume one.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    source TEXT,
+    fetch INTEGER NOT NULL DEFAULT 1,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    worker_pid INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    heartbeat REAL,
+    error TEXT,
+    summary TEXT,
+    backend TEXT
+);
+CREATE TABLE IF NOT EXISTS job_sites (
+    job_id TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (job_id, sample_id)
+);
+CREATE INDEX IF NOT EXISTS idx_job_sites_status ON job_sites(job_id, status);
+CREATE TABLE IF NOT EXISTS workers (
+    pid INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    started REAL NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+ACTIVE = ("queued", "running", "cancelling")
+SITE_STATES = ("pending", "done", "skipped", "failed")
+
+_local = threading.local()
+
+def connect(db_path=None):
+    db_path = db_path or DB_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None: conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        sqlite_journal.apply(conn, db_path)
+        conn.executescript(SCHEMA)
+        # Queues created before jobs carried their backend
+        if "backend" not in [r[1] for r in conn.execute("PRAGMA table_info(jobs)")]:
+            conn.execute("ALTER TABLE jobs ADD COLUMN backend TEXT")
+        conns[db_path] = conn
+    return conn
+
+# --- DASHBOARD SIDE ---
+def submit(sites, source=None, fetch=True, kind="batch", db_path=None, start=True, backend=None):
+    """
+    Queues a batch of (lat, lon, sample_id) sites and makes sure a worker is running.
+    The job runs on `backend` (default: the submitting process's backend).
+    Returns the job id.
+    """
+    job_id = f"{kind}_{time.strftime('%Y%m%d_%H%M%S')}_{os.urandom(2).hex()}"
+    rows = [(job_id, str(sid), float(lat), float(lon)) for lat, lon, sid in sites]
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT INTO jobs (job_id, kind, source, fetch, status, total, created, backend) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                     (job_id, kind, source, int(bool(fetch)), len(rows), time.time(), backend or os.environ.get(settings.BACKEND_ENV)))
+        conn.executemany("INSERT OR IGNORE INTO job_sites (job_id, sample_id, lat, lon) VALUES (?, ?, ?, ?)", rows)
+    if start: ensure_worker(db_path)
+    return job_id
+
+def cancel(job_id, db_path=None):
+    """
+    Queued jobs are cancelled at once; running ones stop feeding new sites at the worker's next heartbeat.
+    """
+    conn = connect(db_path)
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE job_id = ? AND status = 'queued'", (time.time(), job_id))
+        conn.execute("UPDATE jobs SET status = 'cancelling' WHERE job_id = ? AND status = 'running'", (job_id,))
+
+def _counts(conn, job_id):
+    counts = dict.fromkeys(SITE_STATES, 0)
+    counts.update(conn.execute("SELECT status, COUNT(*) FROM job_sites WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+    return counts
+
+def status(job_id, db_path=None):
+    """
+    Job row plus per-state site counts; two indexed queries, cheap enough to poll.
+    """
+    conn = connect(db_path)
+    cols = ("job_id", "kind", "source", "status", "total", "created", "started", "finished", "heartbeat", "error", "summary")
+    row = conn.execute(f"SELECT {', '.join(cols)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None: return None
+    job = dict(zip(cols, row))
+    job["summary"] = json.loads(job["summary"]) if job["summary"] else None
+    job["sites"] = _counts(conn, job_id)
+    job["finished_sites"] = job["total"] - job["sites"]["pending"]
+    return job
+
+def recent(limit=10, db_path=None):
+    ids = [r[0] for r in connect(db_path).execute("SELECT job_id FROM jobs ORDER BY created DESC LIMIT ?", (limit,))]
+    return [status(j, db_path) for j in ids]
+
+def sites_in(job_id, state="failed", limit=50, db_path=None):
+    """
+    [(sample_id, error)] of the job's sites in the given state.
+    """
+    return connect(db_path).execute("SELECT sample_id, error FROM job_sites WHERE job_id = ? AND status = ? LIMIT ?",
+                                    (job_id, state, limit)).fetchall()
+
+def recover(db_path=None):
+    """
+    Requeues jobs whose worker stopped heartbeating (crash, reboot) and forgets dead workers.
+    Sites already finished keep their state, so the job resumes where it stopped.
+    """
+    conn, cutoff = connect(db_path), time.time() - STALE_S
+    with conn:
+        conn.execute("DELETE FROM workers WHERE heartbeat < ?", (cutoff,))
+        conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE status = 'cancelling' AND heartbeat < ?", (time.time(), cutoff))
+        conn.execute("UPDATE jobs SET status = 'queued', worker_pid = NULL WHERE status = 'running' AND heartbeat < ?", (cutoff,))
+
+def ensure_worker(db_path=None):
+    """
+    Starts a detached worker process when jobs are queued and no live worker exists.
+    Returns the pid of the new worker, or None.
+    """
+    recover(db_path)
+    conn = connect(db_path)
+    if not conn.execute("SELECT 1 FROM jobs WHERE status = 'queued' LIMIT 1").fetchone(): return None
+    if conn.execute("SELECT 1 FROM workers WHERE heartbeat >= ?", (time.time() - STALE_S,)).fetchone(): return None
+    cmd = [sys.executable, os.path.abspath(__file__), "worker"]
+    if db_path: cmd += ["--db", db_path]
+    os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+    kwargs = {"start_new_session": True} if os.name == "posix" else {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    with open(LOG_PATH, "a") as log:
+        proc = subprocess.Popen(cmd, cwd=BASE_DIR, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, close_fds=True, **kwargs)
+    # Registered straight away so a quick rerun of the dashboard doesn't start a second one
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)", (proc.pid, socket.gethostname(), time.time(), time.time()))
+    return proc.pid
+
+# --- WORKER SIDE ---
+def claim(conn, retire=False):
+    """
+    Atomically takes the oldest queued job. Returns its id or None.
+    With retire=True an empty queue also deregisters this worker in the same
+    transaction, so a job submitted meanwhile is either claimed here or sees
+    no live worker and gets a new one from ensure_worker.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+        if row:
+            now = time.time()
+            conn.execute("UPDATE jobs SET status = 'running', worker_pid = ?, started = COALESCE(started, ?), heartbeat = ? WHERE job_id = ?",
+                         (os.getpid(), now, now, row[0]))
+        elif retire:
+            conn.execute("DELETE FROM workers WHERE pid = ?", (os.getpid(),))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row[0] if row else None
+
+class _Progress:
+    """
+    Buffers per-site results from the pipeline threads and, on a background
+    thread, flushes them every HEARTBEAT_S along with the job heartbeat,
+    setting `cancel` once the job is marked cancelling.
+    """
+    def __init__(self, job_id, cancel, db_path=None):
+        self.job_id, self.cancel, self.db_path = job_id, cancel, db_path
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def on_site(self, sid, state, error=None):
+        with self.lock: self.buffer.append((state, error, time.time(), self.job_id, str(sid)))
+
+    def flush(self):
+        with self.lock: rows, self.buffer = self.buffer, []
+        conn, now = connect(self.db_path), time.time()
+        with conn:
+            if rows: conn.executemany("UPDATE job_sites SET status = ?, error = ?, updated = ? WHERE job_id = ? AND sample_id = ?", rows)
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ?", (now, self.job_id))
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE pid = ?", (now, os.getpid()))
+        state = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (self.job_id,)).fetchone()
+        if state and state[0] == "cancelling": self.cancel.set()
+
+    def _loop(self):
+        while not self.stop.wait(HEARTBEAT_S): self.flush()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+
+def run_job(job_id, db_path=None):
+    """
+    Runs the job's still-pending sites through the streaming pipeline.
+    """
+    import stream_pipeline
+    conn = connect(db_path)
+    fetch, backend = conn.execute("SELECT fetch, backend FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    sites = conn.execute("SELECT lat, lon, sample_id FROM job_sites WHERE job_id = ? AND status = 'pending'", (job_id,)).fetchall()
+    cancel = threading.Event()
+    print(f"🚀 {job_id}: {len(sites)} site(s) pending", flush=True)
+    try:
+        with _Progress(job_id, cancel, db_path) as progress:
+            summary = stream_pipeline.run_stream(sites, fetch=bool(fetch), cancel=cancel, on_site=progress.on_site, backend=backend)
+        if not summary: raise RuntimeError("no model weights")
+        final, error = ("cancelled" if cancel.is_set() else "done"), None
+        summary = {k: v for k, v in summary.items() if k not in ("processed", "skipped", "errors")}
+    except Exception as e:
+        final, error, summary = "failed", str(e), None
+        print(f"❌ {job_id}: {e}", flush=True)
+    with conn:
+        conn.execute("UPDATE jobs SET status = ?, finished = ?, error = ?, summary = ? WHERE job_id = ?",
+                     (final, time.time(), error, json.dumps(summary) if summary else None, job_id))
+    print(f"✅ {job_id}: {final}", flush=True)
+    return final
+
+def run_worker(db_path=None):
+    """
+    Worker process main loop: runs queued jobs one at a time, exits once idle.
+    """
+    conn = connect(db_path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)", (os.getpid(), socket.gethostname(), time.time(), time.time()))
+    idle_since = time.time()
+    try:
+        while True:
+            idle = time.time() - idle_since > IDLE_EXIT_S
+            job_id = claim(conn, retire=idle)
+            if job_id:
+                run_job(job_id, db_path)
+                idle_since = time.time()
+                continue
+            if idle: break
+            with conn: conn.execute("UPDATE workers SET heartbeat = ? WHERE pid = ?", (time.time(), os.getpid()))
+            time.sleep(1.0)
+    finally:
+        with conn: conn.execute("DELETE FROM workers WHERE pid = ?", (os.getpid(),))
+
+if __name__ == "__main__":
+    import argparse
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="SūryaNetra background batch jobs")
+    parser.add_argument("--db", default=None)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("worker", help="Run queued jobs (started automatically by the dashboard)")
+    p_sub = sub.add_parser("submit", help="Queue a coordinate file as a batch job")
+    p_sub.add_argument("coords")
+    p_sub.add_argument("--no-fetch", action="store_true")
+    p_can = sub.add_parser("cancel")
+    p_can.add_argument("job_id")
+    sub.add_parser("list")
+    args = parser.parse_args()
+
+    if args.cmd == "worker": run_worker(args.db)
+    elif args.cmd == "submit":
+        import coord_store
+        coord_store.ingest(args.coords)
+        job_id = submit(coord_store.iter_sites(source=args.coords), os.path.abspath(args.coords), not args.no_fetch, db_path=args.db)
+        print(f"✅ Queued {job_id}")
+    elif args.cmd == "cancel": cancel(args.job_id, args.db)
+    elif args.cmd == "list":
+        for job in recent(20, args.db):
+            print(f"   {job['job_id']}: {job['status']:<10} {job['finished_sites']}/{job['total']} {job['sites']}")
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METRICS_DIR = os.path.join(BASE_DIR, "output", "metrics")
+
+# Prometheus histogram bucket upper bounds (seconds)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PER_SITE_LIMIT = 10000   # most recent sites kept with their per-stage timings
+PREFIX = "suryanetra"
+
+class Metrics:
+    """
+    Span timings, counters and gauges for the pipeline hot path. Each observation
+    is a perf_counter delta plus a dict update under one lock, cheap enough to
+    leave on in production.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}       # stage -> [count, total_s, max_s, bucket_counts]
+            self.counters = {}
+            self.gauges = {}
+            self.sites = {}       # sid -> {stage: seconds}
+            self.site_order = deque()
+            self.started = time.time()
+
+    def observe(self, stage, seconds, sid=None):
+        with self.lock:
+            s = self.spans.get(stage)
+            if s is None: s = self.spans[stage] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+            s[0] += 1
+            s[1] += seconds
+            if seconds > s[2]: s[2] = seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    s[3][i] += 1
+                    break
+            if sid is not None:
+                site = self.sites.get(sid)
+                if site is None:
+                    site = self.sites[sid] = {}
+                    self.site_order.append(sid)
+                    if len(self.site_order) > PER_SITE_LIMIT: self.sites.pop(self.site_order.popleft(), None)
+                site[stage] = site.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage, sid=None):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(stage, time.perf_counter() - t0, sid)
+
+    def inc(self, name, n=1):
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self.lock: self.gauges[name] = value
+
+    def drain(self):
+        """
+        Hands over everything recorded since the last drain (raw spans with their
+        buckets, counters, gauges and per-site timings) and starts afresh, so a
+        worker process can ship its metrics to the parent for merge().
+        """
+        with self.lock:
+            state = {"spans": self.spans, "counters": self.counters, "gauges": self.gauges, "sites": self.sites}
+            self.spans, self.counters, self.gauges, self.sites = {}, {}, {}, {}
+            self.site_order = deque()
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for stage, (count, total, peak, buckets) in state["spans"].items():
+                s = self.spans.get(stage)
+                if s is None: s = self.spans[stage] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+                s[0] += count
+                s[1] += total
+                if peak > s[2]: s[2] = peak
+                s[3] = [a + b for a, b in zip(s[3], buckets)]
+            for name, n in state["counters"].items(): self.counters[name] = self.counters.get(name, 0) + n
+            self.gauges.update(state["gauges"])
+            for sid, stages in state["sites"].items():
+                site = self.sites.get(sid)
+                if site is None:
+                    site = self.sites[sid] = {}
+                    self.site_order.append(sid)
+                    if len(self.site_order) > PER_SITE_LIMIT: self.sites.pop(self.site_order.popleft(), None)
+                for stage, seconds in stages.items(): site[stage] = site.get(stage, 0.0) + seconds
+
+    def snapshot(self, include_sites=False):
+        with self.lock:
+            snap = {
+                "started": self.started, "uptime_s": round(time.time() - self.started, 3),
+                "spans": {k: {"count": c, "total_s": round(t, 6), "mean_ms": round(t / c * 1000, 3) if c else 0.0,
+                              "max_ms": round(m * 1000, 3)} for k, (c, t, m, _) in self.spans.items()},
+                "counters": dict(self.counters), "gauges": dict(self.gauges),
+            }
+            if include_sites: snap["sites"] = {k: dict(v) for k, v in self.sites.items()}
+        return snap
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+            for stage, (count, total, _, buckets) in sorted(self.spans.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                lines.append(f"{PREFIX}_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                lines.append(f"{PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, name="detect", out_dir=None):
+        """
+        Writes <name>_metrics.json (with per-site timings) and <name>.prom for a textfile collector.
+        """
+        out_dir = out_dir or METRICS_DIR
+        os.makedirs(out_dir, exist_ok=True)
+        json_path = os.path.join(out_dir, f"{name}_metrics.json")
+        with open(json_path + ".tmp", "w") as f: json.dump(self.snapshot(include_sites=True), f, indent=1)
+        os.replace(json_path + ".tmp", json_path)
+        prom_path = os.path.join(out_dir, f"{name}.prom")
+        with open(prom_path + ".tmp", "w") as f: f.write(self.to_prometheus())
+        os.replace(prom_path + ".tmp", prom_path)
+        return json_path
+
+METRICS = Metrics()
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, or None where it can't be read.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 2 ** 20, 1)
+        except Exception: return None
+
+def serve(port, host="127.0.0.1", metrics=METRICS):
+    """
+    Exposes /metrics (Prometheus text) and /metrics.json on a background thread.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, ctype = json.dumps(metrics.snapshot()).encode(), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, ctype = metrics.to_prometheus().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_response(404); self.end_headers(); return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
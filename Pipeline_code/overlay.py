@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+
+import geometry
+import results_store
+import tile_archive
+from metrics import METRICS
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUDIT_DIR = os.path.join(BASE_DIR, "output", "audits")
+THUMB_DIR = os.path.join(AUDIT_DIR, "thumbs")
+THUMB_SIZE = 160          # longest side of list-view thumbnails (px)
+JPEG_QUALITY = 90
+THUMB_QUALITY = 80
+RENDER_VERSION = 1        # bump when the drawing code changes so cached overlays are redrawn
+
+def render(img, det):
+    """
+    Draws the buffer rings, candidate boxes and the site verdict onto a copy of img.
+    det is the detection row stored by detect.process_site.
+    """
+    import cv2    # imported where drawing happens so serving cached overlays doesn't load OpenCV
+    h, w = img.shape[:2]
+    scale, verify_conf = det['scale'], det['verify_conf']
+    has_solar, buffer_val = det['has_solar'], det['buffer_radius_sqft']
+    plot = img.copy()
+
+    # Draw 1200 Ring (Yellow)
+    cv2.circle(plot, (w//2, h//2), int(geometry.R_1200_M/scale), (0, 255, 255), 1)
+    # Draw 2400 Ring (Cyan)
+    cv2.circle(plot, (w//2, h//2), int(geometry.R_2400_M/scale), (255, 255, 0), 1)
+
+    for c in det['candidates']:
+        x1, y1, x2, y2 = map(int, c['box'])
+
+        b_color = (0, 0, 255)
+
+        if (c['conf'] >= verify_conf):
+            if c['zone'] == 1200: b_color = (0, 255, 0)      # Green (1200)
+            elif c['zone'] == 2400: b_color = (255, 165, 0)  # Orange/Cyan (2400)
+
+        cv2.rectangle(plot, (x1, y1), (x2, y2), b_color, 2)
+        cv2.putText(plot, f"{c['conf']:.2f}", (x1, y1-5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, b_color, 1)
+
+    status_text = f"SOLAR: {buffer_val}" if has_solar else "NO SOLAR"
+    cv2.putText(plot, status_text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0) if has_solar else (0, 0, 255), 2)
+    return plot
+
+def render_key(det, size=None):
+    """
+    Cache key over the detection result and the render settings.
+    """
+    settings = {"version": RENDER_VERSION, "quality": THUMB_QUALITY if size else JPEG_QUALITY, "size": size}
+    payload = json.dumps({"detection": det, "settings": settings}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def overlay_path(sid):
+    return os.path.join(AUDIT_DIR, f"{sid}_audit.jpg")
+
+def thumbnail_path(sid, size=THUMB_SIZE):
+    return os.path.join(THUMB_DIR, f"{sid}_{size}.jpg")
+
+def _is_current(path, key):
+    try:
+        with open(path + ".key") as f: return os.path.exists(path) and f.read().strip() == key
+    except OSError: return False
+
+def _write(path, img, key, quality):
+    import cv2
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok: raise RuntimeError(f"could not encode {path}")
+    with open(path, "wb") as f: f.write(buf.tobytes())
+    with open(path + ".key", "w") as f: f.write(key)
+    return path
+
+def write_overlay(sid, img, det):
+    """
+    Renders and writes the overlay for an already decoded tile (used when a batch run asks for overlays).
+    """
+    with METRICS.span("overlay_render", sid):
+        plot = render(img, det)
+    with METRICS.span("overlay_write", sid):
+        return _write(overlay_path(sid), plot, render_key(det), JPEG_QUALITY)
+
+def ensure_overlay(sid, db_path=None):
+    """
+    Path to an up-to-date overlay for sid, rendering it from the stored
+    detections on first use. Sites without stored detections (older runs)
+    fall back to whatever overlay file already exists. Returns None when
+    nothing can be shown.
+    """
+    path = overlay_path(sid)
+    det = results_store.get_detections(sid, db_path)
+    if det is None: return path if os.path.exists(path) else None
+    if _is_current(path, render_key(det)):
+        METRICS.inc("overlay_cache_hits")
+        return path
+    img = tile_archive.imread(det['image']) if det.get('image') else None
+    if img is None: return path if os.path.exists(path) else None
+    METRICS.inc("overlay_cache_misses")
+    return write_overlay(sid, img, det)
+
+def ensure_thumbnail(sid, size=THUMB_SIZE, db_path=None):
+    """
+    Small JPEG of the overlay for list views, cached like the overlay itself.
+    """
+    src = ensure_overlay(sid, db_path)
+    if src is None: return None
+    det = results_store.get_detections(sid, db_path)
+    key = render_key(det, size) if det is not None else f"mtime:{os.path.getmtime(src)}:{size}"
+    path = thumbnail_path(sid, size)
+    if _is_current(path, key): return path
+    import cv2
+    img = cv2.imread(src)
+    if img is None: return None
+    h, w = img.shape[:2]
+    ratio = size / max(h, w)
+    thumb = cv2.resize(img, (max(1, int(w * ratio)), max(1, int(h * ratio))), interpolation=cv2.INTER_AREA)
+    return _write(path, thumb, key, THUMB_QUALITY)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Render cached audit overlays and thumbnails")
+    parser.add_argument("sample_ids", nargs="*", help="Sites to render (default: all stored detections)")
+    parser.add_argument("--thumbs", action="store_true", help="Also build list-view thumbnails")
+    args = parser.parse_args()
+    sids = args.sample_ids or [r[0] for r in results_store.connect().execute("SELECT sample_id FROM detections")]
+    n = 0
+    for sid in sids:
+        path = ensure_thumbnail(sid) if args.thumbs else ensure_overlay(sid)
+        if path: n += 1
+        else: print(f"   ⚠️ {sid}: no detections or tile")
+    print(f"✅ {n}/{len(sids)} overlay(s) ready in {AUDIT_DIR}")
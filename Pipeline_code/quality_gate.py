@@ -0,0 +1,98 @@
+import os
+import json
+
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(BASE_DIR, "input", "quality_gate.json")   # optional overrides for THRESHOLDS
+GATE_SIZE = 256           # tiles are downsampled to this square before any signal is computed
+
+THRESHOLDS = {
+    "dark_mean": 50.0,            # centre-crop mean grey below this -> shadow / night tile
+    "blur_var": 20.0,             # Laplacian variance (on the GATE_SIZE tile) below this -> blurred
+    "haze_mean": 165.0,           # haze needs a bright tile ...
+    "haze_std": 22.0,             # ... with low contrast ...
+    "haze_saturation": 30.0,      # ... and washed-out colour
+    "placeholder_frac": 0.90,     # share of pixels within placeholder_tol of the median grey
+    "placeholder_tol": 6.0,
+    "footer_row_std": 2.0,        # a row flatter than this counts as footer / banner
+    "footer_max_frac": 0.20,      # reject when flat rows cover more of the tile bottom than this
+}
+
+# Checked in this order; a tile is attributed to the first reason it fails
+REASONS = ("placeholder", "dark", "footer", "haze", "blur")
+
+def load_thresholds(path=CONFIG_PATH):
+    """
+    THRESHOLDS with any overrides from input/quality_gate.json applied.
+    """
+    thresholds = dict(THRESHOLDS)
+    if os.path.exists(path):
+        with open(path) as f: thresholds.update({k: float(v) for k, v in json.load(f).items() if k in THRESHOLDS})
+    return thresholds
+
+def measure(img, size=GATE_SIZE, footer_row_std=THRESHOLDS["footer_row_std"], placeholder_tol=THRESHOLDS["placeholder_tol"]):
+    """
+    Every gate signal from a single downsampled copy of the tile.
+    """
+    small = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    sat = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)[:, :, 1]
+    lo, hi = int(size * 0.3), int(size * 0.7)
+    median = float(np.median(gray))
+    # Run of flat rows counted up from the bottom edge
+    flat = gray.std(axis=1)[::-1] < footer_row_std
+    footer_rows = int(np.argmin(flat)) if not flat.all() else size
+    return {
+        "centre_mean": float(gray[lo:hi, lo:hi].mean()),
+        "mean": float(gray.mean()),
+        "std": float(gray.std()),
+        "saturation": float(sat.mean()),
+        "sharpness": float(cv2.Laplacian(gray, cv2.CV_32F).var()),
+        "uniform_frac": float(np.mean(np.abs(gray - median) <= placeholder_tol)),
+        "footer_frac": footer_rows / size,
+    }
+
+def assess(img, thresholds=None):
+    """
+    Returns (usable, reason, note, signals). reason is None for usable tiles,
+    otherwise one of REASONS; note is the human-readable qc note.
+    """
+    t = thresholds or THRESHOLDS
+    s = measure(img, footer_row_std=t["footer_row_std"], placeholder_tol=t["placeholder_tol"])
+    if s["uniform_frac"] >= t["placeholder_frac"] and s["saturation"] < t["haze_saturation"] and s["mean"] >= t["dark_mean"]:
+        return False, "placeholder", "No Imagery Available (Placeholder Tile)", s
+    if s["centre_mean"] < t["dark_mean"]:
+        return False, "dark", f"Severe Shadow (Level: {s['centre_mean']:.1f})", s
+    if s["footer_frac"] > t["footer_max_frac"]:
+        return False, "footer", f"Footer Occlusion ({s['footer_frac'] * 100:.0f}% of tile)", s
+    if s["mean"] > t["haze_mean"] and s["std"] < t["haze_std"] and s["saturation"] < t["haze_saturation"]:
+        return False, "haze", f"Cloud/Haze (Contrast: {s['std']:.1f})", s
+    if s["sharpness"] < t["blur_var"]:
+        return False, "blur", f"Blurred Imagery (Sharpness: {s['sharpness']:.1f})", s
+    return True, None, "Clear", s
+
+if __name__ == "__main__":
+    import argparse
+    import tile_archive
+    parser = argparse.ArgumentParser(description="Run the quality gate over tiles to check thresholds")
+    parser.add_argument("img_dir", nargs="?", default=os.path.join(BASE_DIR, "output", "images"))
+    parser.add_argument("--archive", action="store_true", help="Read tiles from the tile archive instead")
+    args = parser.parse_args()
+    thresholds = load_thresholds()
+    if args.archive: refs = [tile_archive.ref_for(sid) for sid in sorted(tile_archive.ARCHIVE.ids())]
+    else: refs = [os.path.join(args.img_dir, f) for f in sorted(os.listdir(args.img_dir)) if f.lower().endswith(('.png', '.jpg'))]
+    counts, values = {r: 0 for r in REASONS}, {}
+    for ref in refs:
+        img = tile_archive.imread(ref)
+        if img is None: continue
+        usable, reason, note, s = assess(img, thresholds)
+        if not usable:
+            counts[reason] += 1
+            print(f"   ⏭️ {os.path.basename(ref)}: {note}")
+        for k, v in s.items(): values.setdefault(k, []).append(v)
+    print(f"✅ {sum(counts.values())}/{len(refs)} rejected: {counts}")
+    for k, v in values.items():
+        p5, p50, p95 = np.percentile(v, [5, 50, 95])
+        print(f"   {k:>13}: p5 {p5:8.2f}  p50 {p50:8.2f}  p95 {p95:8.2f}")
@@ -2,18 +2,48 @@ from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from datetime import date
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import os
+import json
+import hashlib
+import zipfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPORT_DIR = os.path.join(BASE_DIR, "output", "reports")
+HEADER_COLOR = colors.HexColor("#0E1117")
+
+def report_hash(data):
+    """
+    Content hash of a record plus the integrity_hash printed on the certificate
+    (records written before the Merkle manifest can carry a stale one).
+    """
+    body = {k: v for k, v in data.items() if k != 'integrity_hash'}
+    body['_integrity_hash'] = data.get('integrity_hash')
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+def _hash_path(output_path):
+    return output_path + ".sha256"
+
+def is_current(data, output_path):
+    try:
+        with open(_hash_path(output_path)) as f: return f.read().strip() == report_hash(data)
+    except OSError:
+        return False
+
+def _draw_header(c, width, height):
+    c.setFillColor(HEADER_COLOR)
+    c.rect(0, height - 100, width, 100, fill=True, stroke=False)
+    c.setFillColor(colors.white)
+    c.setFont("Helvetica-Bold", 24)
+    c.drawString(50, height - 60, "SOLAR AUDIT REPORT")
 
 def generate_pdf(data, output_path):
     c = canvas.Canvas(output_path, pagesize=A4)
     width, height = A4
 
-    c.setFillColor(colors.HexColor("#0E1117"))
-    c.rect(0, height - 100, width, 100, fill=True, stroke=False)
+    _draw_header(c, width, height)
     
     c.setFillColor(colors.white)
-    c.setFont("Helvetica-Bold", 24)
-    c.drawString(50, height - 60, "SOLAR AUDIT REPORT")
     c.setFont("Helvetica", 12)
     c.drawString(50, height - 85, f"SuryaNetra | ID: {data.get('sample_id')} | Date: {date.today()}")
     
@@ -82,4 +112,76 @@ def generate_pdf(data, output_path):
     c.setFillColor(colors.gray)
     c.drawString(50, 50, f"Integrity Hash: {data.get('integrity_hash', 'N/A')}")
     
-    c.save()
\ No newline at end of file
+    c.save()
+    with open(_hash_path(output_path), 'w') as f: f.write(report_hash(data))
+    return output_path
+
+def ensure_pdf(data, output_path):
+    """
+    Renders the report only if the record changed since the last render.
+    """
+    if os.path.exists(output_path) and is_current(data, output_path): return output_path
+    return generate_pdf(data, output_path)
+
+def _render(data, output_path):
+    return generate_pdf(data, output_path)
+
+def export_reports(records, zip_path, out_dir=REPORT_DIR, workers=None, progress=None):
+    """
+    Renders reports for many records in a process pool and streams them into a zip.
+    Records whose content hash matches the last render are reused from out_dir.
+    Returns {"rendered": n, "reused": n, "failed": [(sample_id, error)]}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    stats = {"rendered": 0, "reused": 0, "failed": []}
+    max_in_flight = 4 * (workers or os.cpu_count() or 1)
+    done = 0
+
+    # PDFs are already compressed internally, so store them as-is
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zf, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = {}
+
+        def collect(futures):
+            nonlocal done
+            for fut in futures:
+                sid = in_flight.pop(fut)
+                try:
+                    zf.write(fut.result(), f"{sid}_certificate.pdf")
+                    stats["rendered"] += 1
+                except Exception as e:
+                    stats["failed"].append((sid, str(e)))
+                done += 1
+                if progress: progress(done)
+
+        for data in records:
+            sid = str(data.get('sample_id'))
+            pdf_path = os.path.join(out_dir, f"{sid}_audit.pdf")
+            if os.path.exists(pdf_path) and is_current(data, pdf_path):
+                zf.write(pdf_path, f"{sid}_certificate.pdf")
+                stats["reused"] += 1
+                done += 1
+                if progress: progress(done)
+                continue
+            in_flight[pool.submit(_render, data, pdf_path)] = sid
+            # Bound the number of queued records so memory stays flat for large districts
+            if len(in_flight) >= max_in_flight:
+                finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(as_completed(list(in_flight)))
+    return stats
+
+if __name__ == "__main__":
+    import argparse
+    import results_store
+    parser = argparse.ArgumentParser(description="Bulk PDF report export")
+    parser.add_argument("zip_path", help="Output .zip")
+    parser.add_argument("--status", default=None, help="Only export records with this qc_status")
+    parser.add_argument("--solar-only", action="store_true", help="Only sites with has_solar")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    records = (r for r in results_store.iter_records()
+               if (args.status is None or r.get('qc_status') == args.status)
+               and (not args.solar_only or r.get('has_solar')))
+    stats = export_reports(records, args.zip_path, workers=args.workers)
+    print(f"✅ {stats['rendered']} rendered, {stats['reused']} reused, {len(stats['failed'])} failed -> {args.zip_path}")
\ No newline at end of file
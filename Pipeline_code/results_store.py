@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import integrity
+import spatial_index
+import sqlite_journal
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(BASE_DIR, "output", "results.db")
+JSON_DIR = os.path.join(BASE_DIR, "Prediction_files")
+
+# Columns mirrored out of the record JSON so the dashboard never has to parse it
+SUMMARY_COLUMNS = ["sample_id", "lat", "lon", "has_solar", "confidence", "pv_area_sqm_est",
+                   "buffer_radius_sqft", "qc_status", "integrity_hash"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    sample_id TEXT PRIMARY KEY,
+    lat REAL, lon REAL,
+    has_solar INTEGER, confidence REAL, pv_area_sqm_est REAL,
+    buffer_radius_sqft INTEGER, qc_status TEXT, integrity_hash TEXT,
+    record TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    rev INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_records_status ON records(qc_status);
+CREATE TABLE IF NOT EXISTS detections (
+    sample_id TEXT PRIMARY KEY,
+    detection TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS raw_detections (
+    sample_id TEXT PRIMARY KEY,
+    image_hash TEXT NOT NULL,
+    model_hash TEXT NOT NULL,
+    quality_hash TEXT NOT NULL,
+    min_conf REAL NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    usable INTEGER NOT NULL,
+    quality_note TEXT,
+    screen_score REAL,
+    cascade_hash TEXT,
+    boxes BLOB NOT NULL,
+    confs BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+RAW_COLUMNS = ["sample_id", "image_hash", "model_hash", "quality_hash", "min_conf", "width", "height",
+               "usable", "quality_note", "screen_score", "cascade_hash", "boxes", "confs"]
+# Every upsert stamps its rows with a new, store-wide increasing revision so
+# readers can fetch just the rows changed since the revision they last saw.
+REV_INDEX = "CREATE INDEX IF NOT EXISTS idx_records_rev ON records(rev)"
+
+_local = threading.local()
+
+def connect(db_path=None):
+    """
+    Per-thread cached connection in WAL mode, so readers never block the writer
+    (rollback journal when output/ is shared between machines, see sqlite_journal).
+    """
+    db_path = db_path or DB_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None: conns = _local.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        sqlite_journal.apply(conn, db_path)
+        conn.executescript(SCHEMA)
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(records)")}
+        if "rev" not in cols:
+            conn.execute("ALTER TABLE records ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        conn.execute(REV_INDEX)
+        integrity.init(conn)
+        spatial_index.init(conn)
+        conn.commit()
+        conns[db_path] = conn
+    return conn
+
+def _row(rec, rev):
+    return (str(rec['sample_id']), rec.get('lat'), rec.get('lon'),
+            int(bool(rec.get('has_solar'))), rec.get('confidence'), rec.get('pv_area_sqm_est'),
+            rec.get('buffer_radius_sqft'), rec.get('qc_status'), rec.get('integrity_hash'),
+            json.dumps(rec), time.time(), rev)
+
+def upsert_many(records, db_path=None):
+    """
+    Writes records and updates the Merkle integrity tree and spatial index in one transaction.
+    Each record's integrity_hash is refreshed in place, so edited records never
+    keep a stale hash.
+    """
+    records = list(records)
+    if not records: return
+    for r in records: r['integrity_hash'] = integrity.record_hash(r)
+    conn = connect(db_path)
+    # IMMEDIATE takes the write lock up front so concurrent writers never reuse a revision
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        integrity.ensure(conn)
+        spatial_index.ensure(conn)
+        base = conn.execute("SELECT COALESCE(MAX(rev), 0) FROM records").fetchone()[0]
+        conn.executemany(
+            f"INSERT OR REPLACE INTO records ({', '.join(SUMMARY_COLUMNS)}, record, updated_at, rev) "
+            f"VALUES ({', '.join('?' * (len(SUMMARY_COLUMNS) + 3))})",
+            [_row(r, base + i + 1) for i, r in enumerate(records)])
+        integrity.update_many(conn, [(str(r['sample_id']), r['integrity_hash']) for r in records])
+        spatial_index.update_many(conn, records)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def upsert(rec, db_path=None):
+    """
+    Writes one record and returns it with its refreshed integrity_hash.
+    """
+    upsert_many([rec], db_path)
+    return rec
+
+def get(sample_id, db_path=None):
+    """
+    Full record for one site, or None.
+    """
+    row = connect(db_path).execute("SELECT record FROM records WHERE sample_id = ?", (str(sample_id),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def ids(db_path=None):
+    return {r[0] for r in connect(db_path).execute("SELECT sample_id FROM records")}
+
+def count(db_path=None):
+    return connect(db_path).execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+def max_rev(db_path=None):
+    return connect(db_path).execute("SELECT COALESCE(MAX(rev), 0) FROM records").fetchone()[0]
+
+def load_frame(db_path=None, with_rev=False):
+    """
+    Summary columns for every site as a DataFrame (no per-record JSON parsing).
+    """
+    import pandas as pd
+    cols = SUMMARY_COLUMNS + (["rev"] if with_rev else [])
+    df = pd.read_sql_query(f"SELECT {', '.join(cols)} FROM records", connect(db_path))
+    df['has_solar'] = df['has_solar'].astype(bool)
+    return df
+
+def changes_since(rev, db_path=None):
+    """
+    Summary rows (as dicts, oldest first) written after revision `rev`.
+    """
+    cur = connect(db_path).execute(
+        f"SELECT {', '.join(SUMMARY_COLUMNS)}, rev FROM records WHERE rev > ? ORDER BY rev", (rev,))
+    rows = []
+    for r in cur:
+        row = dict(zip(SUMMARY_COLUMNS + ["rev"], r))
+        row['has_solar'] = bool(row['has_solar'])
+        rows.append(row)
+    return rows
+
+def iter_records(db_path=None, chunk=1000):
+    cur = connect(db_path).execute("SELECT record FROM records ORDER BY sample_id")
+    while True:
+        rows = cur.fetchmany(chunk)
+        if not rows: break
+        for (raw,) in rows: yield json.loads(raw)
+
+def upsert_detections(detections, db_path=None):
+    """
+    Stores the filtered detections behind each record so overlays can be rendered later.
+    """
+    detections = list(detections)
+    if not detections: return
+    conn = connect(db_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO detections VALUES (?, ?, ?)",
+                         [(str(d['sample_id']), json.dumps(d), time.time()) for d in detections])
+
+def get_detections(sample_id, db_path=None):
+    row = connect(db_path).execute("SELECT detection FROM detections WHERE sample_id = ?", (str(sample_id),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def upsert_raw_detections(rows, db_path=None):
+    """
+    Stores the unfiltered model output per site (float32 boxes / confs as raw
+    bytes) with the image, model and gate hashes it was produced under.
+    """
+    rows = list(rows)
+    if not rows: return
+    conn = connect(db_path)
+    now = time.time()
+    with conn:
+        conn.executemany(f"INSERT OR REPLACE INTO raw_detections VALUES ({', '.join('?' * (len(RAW_COLUMNS) + 1))})",
+                         [tuple(r[c] for c in RAW_COLUMNS) + (now,) for r in rows])
+
+def get_raw_detections(sample_ids=None, db_path=None):
+    """
+    {sample_id: row dict} for the given sites (all sites when sample_ids is None).
+    """
+    conn, cols = connect(db_path), ", ".join(RAW_COLUMNS)
+    if sample_ids is None: return {r[0]: dict(zip(RAW_COLUMNS, r)) for r in conn.execute(f"SELECT {cols} FROM raw_detections")}
+    ids, out = [str(s) for s in sample_ids], {}
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        q = f"SELECT {cols} FROM raw_detections WHERE sample_id IN ({','.join('?' * len(chunk))})"
+        out.update({r[0]: dict(zip(RAW_COLUMNS, r)) for r in conn.execute(q, chunk)})
+    return out
+
+def export_json(rec, out_dir=JSON_DIR):
+    """
+    Writes one record in the mandatory per-site JSON schema.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{rec['sample_id']}.json")
+    with open(path, 'w') as f: json.dump(rec, f, indent=4)
+    return path
+
+def export_all(out_dir=JSON_DIR, db_path=None):
+    n = 0
+    for rec in iter_records(db_path):
+        export_json(rec, out_dir)
+        n += 1
+    return n
+
+def import_json_dir(json_dir=JSON_DIR, db_path=None, chunk=1000):
+    """
+    One-off migration of an existing Prediction_files directory into the store.
+    """
+    if not os.path.isdir(json_dir): return 0
+    batch, n = [], 0
+    for f in os.listdir(json_dir):
+        if not f.endswith('.json'): continue
+        try:
+            with open(os.path.join(json_dir, f)) as fh: rec = json.load(fh)
+        except (OSError, ValueError): continue
+        if 'sample_id' not in rec: continue
+        batch.append(rec)
+        if len(batch) >= chunk:
+            upsert_many(batch, db_path); n += len(batch); batch = []
+    if batch: upsert_many(batch, db_path); n += len(batch)
+    return n
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SūryaNetra results store")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("import", help="Load Prediction_files/*.json into the store")
+    p_exp = sub.add_parser("export", help="Write per-site JSON files from the store")
+    p_exp.add_argument("--out", default=JSON_DIR)
+    args = parser.parse_args()
+    if args.cmd == "import": print(f"✅ Imported {import_json_dir()} record(s)")
+    elif args.cmd == "export": print(f"✅ Exported {export_all(args.out)} record(s) to {args.out}")
@@ -0,0 +1,4 @@
+# Settings shared by the portal and the pipeline processes. Dependency-free, so
+# the dashboard can read them without importing the ML stack.
+
+BACKEND_ENV = "SURYANETRA_BACKEND"   # default backend for every process, so spawned workers agree with their parent
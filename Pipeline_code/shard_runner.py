@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import multiprocessing as mp
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import backends
+import settings
+import detect
+import sqlite_journal
+import tile_archive
+from metrics import METRICS
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUEUE_PATH = os.path.join(BASE_DIR, "output", "work_queue.db")
+REPORT_DIR = os.path.join(BASE_DIR, "output", "metrics")
+CLAIM_SIZE = detect.BATCH_SIZE   # sites claimed (and inferred) per round trip
+LEASE_S = 600                    # a claim older than this is assumed dead and handed out again
+MAX_ATTEMPTS = 3
+
+# Rollback journal rather than WAL: WAL needs shared memory, which does not work
+# across machines mounting the same network filesystem. The multi-machine
+# commands (plan / work / merge) put the result, coordinate, tile and plan
+# stores that workers write through detect.run_batch in the same mode, see
+# sqlite_journal; every other process sharing output/ must set
+# SURYANETRA_SHARED_FS=1 as well.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, shards INTEGER NOT NULL, total INTEGER NOT NULL,
+    force INTEGER NOT NULL, created REAL NOT NULL, merged REAL
+);
+CREATE TABLE IF NOT EXISTS items (
+    run_id TEXT NOT NULL, sample_id TEXT NOT NULL, shard INTEGER NOT NULL,
+    image TEXT NOT NULL, site_data TEXT NOT NULL, entry TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0, error TEXT, finished REAL,
+    PRIMARY KEY (run_id, sample_id)
+);
+CREATE INDEX IF NOT EXISTS idx_items_claim ON items(run_id, status, shard);
+CREATE TABLE IF NOT EXISTS workers (
+    run_id TEXT NOT NULL, worker TEXT NOT NULL, shard INTEGER, host TEXT, pid INTEGER,
+    started REAL, finished REAL, sites INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+    busy_s REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, worker)
+);
+"""
+
+def connect(db_path=None):
+    db_path = db_path or QUEUE_PATH
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.executescript(SCHEMA)
+    return conn
+
+def shard_of(sid, shards):
+    return zlib.crc32(sid.encode()) % shards
+
+def create_run(run_id, sample_ids=None, force=False, shards=1, db_path=None):
+    """
+    Plans the run once and enqueues every pending site under its shard.
+    An existing run_id is left untouched, so calling this again resumes it.
+    Returns the number of sites in the run.
+    """
+    conn = connect(db_path)
+    row = conn.execute("SELECT total FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+    if row: return row[0]
+    pending, _ = detect.plan_pipeline(sample_ids, force)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO items (run_id, sample_id, shard, image, site_data, entry) VALUES (?, ?, ?, ?, ?, ?)",
+            [(run_id, sid, shard_of(sid, shards), img_path if tile_archive.is_ref(img_path) else os.path.basename(img_path),
+              json.dumps(site_data), json.dumps(entry))
+             for sid, img_path, site_data, entry in pending])
+        conn.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, NULL)", (run_id, shards, len(pending), int(force), time.time()))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(pending)
+
+def claim(conn, run_id, worker, shard=None, n=CLAIM_SIZE, steal=True):
+    """
+    Atomically leases up to n pending (or expired) sites, preferring the worker's own shard.
+    Once that shard is drained and steal is set, work is taken from any shard.
+    Returns a list of (sid, img_path, site_data, entry) as produced by plan_pipeline.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        claimable = "run_id = ? AND (status = 'pending' OR (status = 'claimed' AND lease_until < ?))"
+        rows = []
+        if shard is not None:
+            rows = conn.execute(f"SELECT sample_id, image, site_data, entry FROM items WHERE {claimable} AND shard = ? LIMIT ?",
+                                (run_id, now, shard, n)).fetchall()
+        if not rows and (shard is None or steal):
+            rows = conn.execute(f"SELECT sample_id, image, site_data, entry FROM items WHERE {claimable} LIMIT ?",
+                                (run_id, now, n)).fetchall()
+        conn.executemany("UPDATE items SET status = 'claimed', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                         "WHERE run_id = ? AND sample_id = ?", [(worker, now + LEASE_S, run_id, r[0]) for r in rows])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return [(sid, image if tile_archive.is_ref(image) else os.path.join(detect.IMG_DIR, image), json.loads(site_data), json.loads(entry))
+            for sid, image, site_data, entry in rows]
+
+def complete(conn, run_id, worker, batch, done, busy_s, errors=None):
+    """
+    Per-site checkpoint: processed sites become 'done'; the rest go back to the
+    queue with their error until they have used up MAX_ATTEMPTS.
+    """
+    done, errors = set(done), errors or {}
+    now = time.time()
+    failed = [sid for sid, _, _, _ in batch if sid not in done]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("UPDATE items SET status = 'done', finished = ?, lease_until = NULL WHERE run_id = ? AND sample_id = ?",
+                         [(now, run_id, sid) for sid in done])
+        conn.executemany("UPDATE items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "lease_until = NULL, error = ? WHERE run_id = ? AND sample_id = ?",
+                         [(MAX_ATTEMPTS, errors.get(sid, "not processed"), run_id, sid) for sid in failed])
+        conn.execute("UPDATE workers SET sites = sites + ?, failed = failed + ?, busy_s = busy_s + ?, finished = ? "
+                     "WHERE run_id = ? AND worker = ?", (len(done), len(failed), busy_s, now, run_id, worker))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def requeue(run_id, host=None, db_path=None):
+    """
+    Hands claimed sites straight back to the queue instead of waiting for their
+    lease to expire (e.g. after this host crashed). Returns the number requeued.
+    """
+    conn = connect(db_path)
+    query = "UPDATE items SET status = 'pending', lease_until = NULL WHERE run_id = ? AND status = 'claimed'"
+    params = (run_id,)
+    if host: query, params = query + " AND worker LIKE ?", (run_id, f"{host}:%")
+    return conn.execute(query, params).rowcount
+
+def run_worker(run_id, shard=None, worker=None, claim_size=CLAIM_SIZE, steal=True, db_path=None, model=None):
+    """
+    Drains the queue for one worker: claim a batch, infer it, checkpoint it.
+    Safe to start on any machine that sees the same output/ directory.
+    Returns the number of sites this worker processed.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(db_path)
+    conn.execute("INSERT OR REPLACE INTO workers (run_id, worker, shard, host, pid, started) VALUES (?, ?, ?, ?, ?, ?)",
+                 (run_id, worker, shard, socket.gethostname(), os.getpid(), time.time()))
+    if model is None: model = detect.load_model()
+    processed = 0
+    while True:
+        batch = claim(conn, run_id, worker, shard, claim_size, steal)
+        if not batch: break
+        t0 = time.perf_counter()
+        errors = {}
+        try:
+            done = [sid for sid, _ in detect.run_batch(model, batch, errors=errors)]
+        except Exception as e:
+            print(f"   ❌ {worker}: batch failed: {e}")
+            done, errors = [], {sid: f"batch: {e}" for sid, _, _, _ in batch}
+        complete(conn, run_id, worker, batch, done, time.perf_counter() - t0, errors)
+        processed += len(done)
+    METRICS.write(f"shard_{run_id}_{worker.replace(':', '_')}")
+    return processed
+
+def _worker_main(run_id, shard, claim_size, steal, db_path, backend):
+    # Spawned processes re-import detect, so the parent's backend is handed over explicitly
+    detect.INFERENCE_BACKEND = backend
+    # One thread per shard process; the shards themselves fill the cores
+    model = detect.load_model(threads=1)
+    run_worker(run_id, shard, f"{socket.gethostname()}:shard{shard}", claim_size, steal, db_path, model)
+
+def merge(run_id, db_path=None):
+    """
+    Folds the run's checkpointed sites into the manifest and returns the per-shard report.
+    """
+    conn = connect(db_path)
+    manifest = detect.load_manifest()
+    for sid, entry in conn.execute("SELECT sample_id, entry FROM items WHERE run_id = ? AND status = 'done'", (run_id,)):
+        manifest["sites"][sid] = json.loads(entry)
+    detect.save_manifest(manifest)
+    conn.execute("UPDATE runs SET merged = ? WHERE run_id = ?", (time.time(), run_id))
+    return report(run_id, db_path)
+
+def report(run_id, db_path=None):
+    conn = connect(db_path)
+    run = conn.execute("SELECT shards, total, created FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+    if run is None: raise KeyError(f"Unknown run {run_id}")
+    status = dict(conn.execute("SELECT status, COUNT(*) FROM items WHERE run_id = ? GROUP BY status", (run_id,)).fetchall())
+    workers = []
+    for worker, shard, host, started, finished, sites, failed, busy in conn.execute(
+            "SELECT worker, shard, host, started, finished, sites, failed, busy_s FROM workers WHERE run_id = ? ORDER BY worker", (run_id,)):
+        wall = (finished or time.time()) - started
+        workers.append({"worker": worker, "shard": shard, "host": host, "sites": sites, "failed": failed,
+                        "wall_s": round(wall, 2), "busy_s": round(busy, 2),
+                        "sites_per_second": round(sites / wall, 3) if wall > 0 else 0.0})
+    summary = {"run_id": run_id, "shards": run[0], "total": run[1], "status": status, "workers": workers,
+               "sites_per_second": round(sum(w["sites_per_second"] for w in workers), 3)}
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    with open(os.path.join(REPORT_DIR, f"shard_report_{run_id}.json"), "w") as f: json.dump(summary, f, indent=1)
+    return summary
+
+def run_sharded(sample_ids=None, shards=None, force=False, run_id=None, claim_size=CLAIM_SIZE, steal=True, db_path=None, backend=None):
+    """
+    Single-machine driver: plans (or resumes) run_id, runs one worker process per
+    shard, then merges. Re-running with the same run_id after a crash only
+    processes the sites that were not checkpointed.
+    """
+    shards = max(1, int(shards or os.cpu_count() or 1))
+    run_id = run_id or time.strftime("run_%Y%m%d_%H%M%S")
+    total = create_run(run_id, sample_ids, force, shards, db_path)
+    # Nothing else on this host is working on the run, so its old claims are dead
+    requeue(run_id, socket.gethostname(), db_path)
+    print(f"🚀 {run_id}: {total} site(s) across {shards} shard(s)")
+    ctx = mp.get_context("spawn")
+    backend = backend or detect.INFERENCE_BACKEND
+    procs = [ctx.Process(target=_worker_main, args=(run_id, s, claim_size, steal, db_path, backend)) for s in range(shards)]
+    for p in procs: p.start()
+    for p in procs: p.join()
+    summary = merge(run_id, db_path)
+    print(f"✅ {summary['status'].get('done', 0)}/{total} done, {summary['status'].get('failed', 0)} failed, "
+          f"{summary['sites_per_second']} sites/s")
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Sharded, resumable SūryaNetra detection")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_run = sub.add_parser("run", help="Plan, run one process per shard and merge (single machine)")
+    p_run.add_argument("sample_ids", nargs="*")
+    p_run.add_argument("--shards", type=int, default=None)
+    p_run.add_argument("--run-id", default=None, help="Resume this run if it exists")
+    p_run.add_argument("--force", action="store_true")
+    p_plan = sub.add_parser("plan", help="Enqueue a run for workers on several machines")
+    p_plan.add_argument("run_id")
+    p_plan.add_argument("sample_ids", nargs="*")
+    p_plan.add_argument("--shards", type=int, default=1)
+    p_plan.add_argument("--force", action="store_true")
+    p_work = sub.add_parser("work", help="Drain a planned run from this machine")
+    p_work.add_argument("run_id")
+    p_work.add_argument("--shard", type=int, default=None)
+    p_work.add_argument("--no-steal", action="store_true", help="Stop once this shard is drained")
+    for p in (p_run, p_plan, p_work):
+        p.add_argument("--backend", default=detect.INFERENCE_BACKEND, choices=backends.BACKENDS, help="Inference backend")
+    for name in ("merge", "status"):
+        sub.add_parser(name).add_argument("run_id")
+    args = parser.parse_args()
+
+    # Several machines may be sharing output/: keep every store off WAL
+    if args.cmd in ("plan", "work", "merge"): os.environ.setdefault(sqlite_journal.SHARED_FS_ENV, "1")
+    # The backend is part of the config hash, so planning and working must agree on it
+    if args.cmd in ("run", "plan", "work"): detect.INFERENCE_BACKEND = os.environ[settings.BACKEND_ENV] = args.backend
+    if args.cmd == "run": run_sharded(args.sample_ids or None, args.shards, args.force, args.run_id)
+    elif args.cmd == "plan": print(f"✅ {create_run(args.run_id, args.sample_ids or None, args.force, args.shards)} site(s) queued")
+    elif args.cmd == "work": print(f"✅ {run_worker(args.run_id, args.shard, steal=not args.no_steal)} site(s) processed")
+    elif args.cmd == "merge": print(json.dumps(merge(args.run_id), indent=2))
+    elif args.cmd == "status": print(json.dumps(report(args.run_id), indent=2))
@@ -0,0 +1,139 @@
+import math
+import sqlite3
+
+MAX_MAP_POINTS = 5000     # above this many sites in the viewport the map switches to grid bins
+GRID_CELLS_ACROSS = 60    # bins across the viewport width when aggregating
+VIEWPORT_PX = (800, 500)  # map size used to turn centre + zoom into a bounding box
+EARTH_RADIUS_M = 6371000.0
+
+# Site positions mirrored out of the records table into an R*Tree, kept in step
+# by results_store.upsert_many. Builds of SQLite without the R*Tree module fall
+# back to a plain (lat, lon) index.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites_geo (
+    id INTEGER PRIMARY KEY,
+    sample_id TEXT NOT NULL UNIQUE,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sites_geo_latlon ON sites_geo(lat, lon);
+"""
+RTREE = "CREATE VIRTUAL TABLE IF NOT EXISTS sites_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+
+HAS_RTREE = True
+
+def init(conn):
+    global HAS_RTREE
+    conn.executescript(SCHEMA)
+    try: conn.execute(RTREE)
+    except sqlite3.OperationalError: HAS_RTREE = False
+
+def _valid(lat, lon):
+    return lat is not None and lon is not None and lat == lat and lon == lon
+
+def update_many(conn, records):
+    """
+    Upserts the positions of the given records. Call inside the caller's transaction.
+    """
+    for r in records:
+        lat, lon = r.get('lat'), r.get('lon')
+        if not _valid(lat, lon): continue
+        sid, lat, lon = str(r['sample_id']), float(lat), float(lon)
+        conn.execute("INSERT INTO sites_geo (sample_id, lat, lon) VALUES (?, ?, ?) "
+                     "ON CONFLICT(sample_id) DO UPDATE SET lat = excluded.lat, lon = excluded.lon", (sid, lat, lon))
+        if HAS_RTREE:
+            gid = conn.execute("SELECT id FROM sites_geo WHERE sample_id = ?", (sid,)).fetchone()[0]
+            conn.execute("INSERT OR REPLACE INTO sites_rtree VALUES (?, ?, ?, ?, ?)", (gid, lat, lat, lon, lon))
+
+def ensure(conn):
+    """
+    Indexes the positions of a store that predates the index. Call inside the caller's transaction.
+    """
+    if conn.execute("SELECT 1 FROM sites_geo LIMIT 1").fetchone(): return
+    rows = conn.execute("SELECT sample_id, lat, lon FROM records").fetchall()
+    update_many(conn, [{"sample_id": sid, "lat": lat, "lon": lon} for sid, lat, lon in rows])
+
+def _bbox_query(columns, bbox, extra=""):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if HAS_RTREE:
+        sql = (f"SELECT {columns} FROM sites_rtree t JOIN sites_geo g ON g.id = t.id "
+               "JOIN records r ON r.sample_id = g.sample_id "
+               "WHERE t.min_lat >= ? AND t.max_lat <= ? AND t.min_lon >= ? AND t.max_lon <= ?")
+    else:
+        sql = (f"SELECT {columns} FROM sites_geo g JOIN records r ON r.sample_id = g.sample_id "
+               "WHERE g.lat BETWEEN ? AND ? AND g.lon BETWEEN ? AND ?")
+    return sql + extra, [min_lat, max_lat, min_lon, max_lon]
+
+def _conn(db_path):
+    import results_store
+    return results_store.connect(db_path)
+
+def count(bbox, db_path=None):
+    sql, params = _bbox_query("COUNT(*)", bbox)
+    return _conn(db_path).execute(sql, params).fetchone()[0]
+
+def query_bbox(bbox, limit=None, db_path=None):
+    """
+    Sites inside (min_lat, min_lon, max_lat, max_lon) as dicts with their status columns.
+    """
+    sql, params = _bbox_query("g.sample_id, g.lat, g.lon, r.qc_status, r.has_solar, r.pv_area_sqm_est", bbox,
+                              " LIMIT ?" if limit else "")
+    if limit: params.append(int(limit))
+    cols = ("sample_id", "lat", "lon", "qc_status", "has_solar", "pv_area_sqm_est")
+    return [dict(zip(cols, row), has_solar=bool(row[4])) for row in _conn(db_path).execute(sql, params)]
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def radius_bbox(lat, lon, radius_m):
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+
+def query_radius(lat, lon, radius_m, limit=None, db_path=None):
+    """
+    Sites within radius_m of (lat, lon), nearest first, each with distance_m.
+    The R-tree narrows the search to the enclosing box before the exact distance check.
+    """
+    out = []
+    for row in query_bbox(radius_bbox(lat, lon, radius_m), db_path=db_path):
+        d = haversine_m(lat, lon, row['lat'], row['lon'])
+        if d <= radius_m: out.append(dict(row, distance_m=round(d, 1)))
+    out.sort(key=lambda r: r['distance_m'])
+    return out[:limit] if limit else out
+
+def aggregate_grid(bbox, cell_deg, db_path=None):
+    """
+    Server-side binning of the sites in bbox into cell_deg squares: one row per
+    non-empty cell with its site count, verified-solar count and centroid.
+    """
+    min_lat, min_lon = bbox[0], bbox[1]
+    sql, params = _bbox_query(
+        "CAST((g.lat - ?) / ? AS INTEGER) AS gy, CAST((g.lon - ?) / ? AS INTEGER) AS gx, COUNT(*), "
+        "SUM(r.has_solar AND r.qc_status = 'VERIFIABLE'), AVG(g.lat), AVG(g.lon)", bbox, " GROUP BY gy, gx")
+    params = [min_lat, cell_deg, min_lon, cell_deg] + params
+    radius_m = cell_deg * 111320 / 2
+    return [{"lat": lat, "lon": lon, "sites": n, "solar": int(solar or 0), "radius": radius_m}
+            for _, _, n, solar, lat, lon in _conn(db_path).execute(sql, params)]
+
+def viewport_bbox(lat, lon, zoom, size_px=VIEWPORT_PX):
+    """
+    Bounding box of a Web Mercator map of size_px centred on (lat, lon) at zoom.
+    """
+    w, h = size_px
+    world = 256 * 2 ** zoom
+    dlon = w * 360.0 / world / 2
+    y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2 * world
+    to_lat = lambda py: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * py / world))))
+    return (to_lat(min(y + h / 2, world)), lon - dlon, to_lat(max(y - h / 2, 0)), lon + dlon)
+
+def viewport(lat, lon, zoom, max_points=MAX_MAP_POINTS, db_path=None):
+    """
+    What the map needs for one viewport: ("points", sites) when few enough
+    sites are visible, otherwise ("bins", grid cells).
+    """
+    bbox = viewport_bbox(lat, lon, zoom)
+    if count(bbox, db_path) <= max_points: return "points", query_bbox(bbox, db_path=db_path)
+    return "bins", aggregate_grid(bbox, (bbox[3] - bbox[1]) / GRID_CELLS_ACROSS, db_path)
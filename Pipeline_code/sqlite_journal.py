@@ -0,0 +1,24 @@
+import os
+
+# Set to 1 on every machine (and every process, dashboard included) that shares
+# one output/ directory over a network filesystem. WAL keeps its index in shared
+# memory, which only works between processes on the same host, so the stores
+# fall back to a rollback journal there.
+SHARED_FS_ENV = "SURYANETRA_SHARED_FS"
+
+def shared_fs():
+    return os.environ.get(SHARED_FS_ENV, "") not in ("", "0")
+
+def apply(conn, path):
+    """
+    Puts a freshly opened store connection in WAL mode, or in rollback-journal
+    mode when the output directory is shared between machines. Refuses to
+    carry on in WAL on a shared filesystem (another process still holds the
+    database in WAL and has to be stopped first).
+    """
+    want = "delete" if shared_fs() else "wal"
+    got = conn.execute(f"PRAGMA journal_mode={want}").fetchone()[0].lower()
+    if want == "delete" and got != want:
+        raise RuntimeError(f"{path} is still in {got} mode; stop the other processes using it and retry")
+    conn.execute("PRAGMA synchronous=FULL" if want == "delete" else "PRAGMA synchronous=NORMAL")
+    return got
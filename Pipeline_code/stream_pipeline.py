@@ -0,0 +1,378 @@
+import os
+import sys
+import json
+import time
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import cascade
+import detect
+import fetch_pipeline
+import fetch_planner
+import results_store
+import overlay
+import tile_archive
+from metrics import METRICS
+
+# Threads per stage; inference and writing are single batching stages
+CONCURRENCY = {"fetch": 8, "decode": 2, "quality": 2, "infer": 1, "post": 2}
+WRITE_BATCH = 64        # records per results-store transaction
+QUEUE_DEPTH = 32        # max items waiting between two stages (bounds memory)
+BATCH_WAIT_S = 0.05     # how long inference waits to fill a batch before flushing
+SHARED_DET_CACHE = 256  # shared tiles whose detections are kept for members still to come
+PLAN_WINDOW = 10000     # sites read from the input and grouped into shared tiles at a time
+
+_DONE = object()
+
+class Stage:
+    """
+    A pool of threads applying `fn` to items from in_q and pushing results to out_q.
+    `fn` returns the item to forward, or None to drop it. The last thread to see
+    the end-of-stream marker forwards it downstream. Failures are appended to
+    `errors` and passed to `on_error(sid, stage, error)` as they happen.
+    """
+    def __init__(self, name, fn, in_q, out_q, workers, errors, on_error=None):
+        self.name, self.fn, self.in_q, self.out_q = name, fn, in_q, out_q
+        self.workers = max(1, int(workers))
+        self.errors = errors
+        self.on_error = on_error
+        self.busy_s = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+        self.remaining = self.workers
+        self.threads = [threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True) for i in range(self.workers)]
+
+    def start(self):
+        for t in self.threads: t.start()
+        return self
+
+    def _record(self, elapsed, n=1):
+        with self.lock:
+            self.busy_s += elapsed
+            self.items += n
+
+    def _failed(self, items, error):
+        for item in items:
+            self.errors.append((item.get("sid"), self.name, error))
+            if self.on_error: self.on_error(item.get("sid"), self.name, error)
+        METRICS.inc(f"errors_{self.name}", len(items))
+
+    def _finish(self):
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last: self.out_q.put(_DONE)
+        else: self.in_q.put(_DONE)   # let sibling threads see the marker too
+
+    def _loop(self):
+        while True:
+            item = self.in_q.get()
+            if item is _DONE: return self._finish()
+            t0 = time.perf_counter()
+            try: out = self.fn(item)
+            except Exception as e:
+                self._failed([item], str(e))
+                out = None
+            elapsed = time.perf_counter() - t0
+            self._record(elapsed)
+            METRICS.observe(self.name, elapsed, item.get("sid"))
+            if out is not None: self.out_q.put(out)
+
+class BatchStage(Stage):
+    """
+    Single-threaded stage that groups items into batches of up to batch_size,
+    flushing early when the upstream queue runs dry.
+    """
+    def __init__(self, name, fn, in_q, out_q, batch_size, errors, on_error=None):
+        super().__init__(name, fn, in_q, out_q, 1, errors, on_error)
+        self.batch_size = max(1, int(batch_size))
+
+    def _flush(self, batch):
+        t0 = time.perf_counter()
+        try: out = self.fn(batch)
+        except Exception as e:
+            self._failed(batch, str(e))
+            out = []
+        elapsed = time.perf_counter() - t0
+        self._record(elapsed, len(batch))
+        METRICS.observe(f"{self.name}_batch", elapsed)
+        for item in batch: METRICS.observe(self.name, elapsed / len(batch), item.get("sid"))
+        for item in out: self.out_q.put(item)
+
+    def _loop(self):
+        batch = []
+        while True:
+            try: item = self.in_q.get(timeout=BATCH_WAIT_S if batch else None)
+            except queue.Empty:
+                self._flush(batch); batch = []
+                continue
+            if item is _DONE:
+                if batch: self._flush(batch)
+                return self._finish()
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch); batch = []
+
+def run_stream(sites, fetch=True, force=False, batch_size=detect.BATCH_SIZE, concurrency=None, progress=None,
+               render=detect.RENDER_OVERLAYS, cancel=None, on_site=None, backend=None):
+    """
+    Streams an iterable of (lat, lon, sample_id) sites, read lazily, through fetch -> decode -> quality gate ->
+    batched inference -> post-processing -> result writing, each stage on its
+    own threads and connected by bounded queues. With fetch=False the tiles must
+    already be in the tile archive or output/images. Unchanged sites are skipped as in run_pipeline,
+    and overlays are only drawn here when render=True. With detect.CASCADE on, the
+    infer stage runs the stage-1 screen first, as run_batch does. With
+    detect.USE_SHARED_TILES on, clustered sites are fetched as fetch_planner
+    shared tiles (planned PLAN_WINDOW sites at a time) and each shared tile is
+    inferred once for all of its sites. The model is only loaded once a site
+    actually needs inference.
+    Setting the `cancel` event stops feeding new sites; those already in flight
+    finish. `on_site(sid, status, error)` is called once per site, as it happens,
+    with "done", "skipped" or "failed" (from several threads). `progress(done, total)`
+    gets total=None when `sites` has no length.
+    `backend` overrides detect.INFERENCE_BACKEND for this process.
+    Returns a summary dict with per-stage busy time.
+    """
+    if backend: detect.INFERENCE_BACKEND = backend
+    conc = dict(CONCURRENCY, **(concurrency or {}))
+    total = len(sites) if hasattr(sites, "__len__") else None
+    if not os.path.exists(detect.weights_path()): print(f"❌ No Model ({detect.weights_path()})"); return {}
+    os.makedirs(detect.JSON_OUT_DIR, exist_ok=True)
+
+    t_start = time.perf_counter()
+    manifest = detect.load_manifest()
+    config_hash = detect.get_config_hash(detect.model_hash())
+    raw_keys = detect.raw_keys()
+    model = None
+    bucket = fetch_pipeline.TokenBucket(fetch_pipeline.RATE_LIMIT_QPS)
+    stored = results_store.ids()
+    errors, skipped = [], []
+
+    group_of, fetch_plan = {}, None
+
+    def windows():
+        window = []
+        for lat, lon, sid in sites:
+            window.append((float(lat), float(lon), str(sid)))
+            if len(window) < PLAN_WINDOW: continue
+            yield window
+            window = []
+        if window: yield window
+
+    def ordered(window):
+        # Members of a shared tile are fed back to back so it is fetched and inferred once
+        nonlocal fetch_plan
+        if not detect.USE_SHARED_TILES: return window
+        if not fetch:
+            planned = fetch_planner.crops_for([sid for _, _, sid in window])
+            return sorted(window, key=lambda s: planned[s[2]][0] if s[2] in planned else "")
+        groups, singles = fetch_planner.plan(window)
+        plan = fetch_planner.summarize(groups, singles)
+        fetch_plan = plan if fetch_plan is None else {k: fetch_plan[k] + v for k, v in plan.items()}
+        for g in groups:
+            for sid, _, _ in g["sites"]: group_of[sid] = g
+        by_sid = {sid: (lat, lon, sid) for lat, lon, sid in window}
+        return [by_sid[sid] for g in groups for sid, _, _ in g["sites"]] + singles
+
+    group_fetches, group_lock = {}, threading.Lock()
+    shared_dets = OrderedDict()
+
+    def fetch_shared(group):
+        # The first member to arrive fetches the shared tile; the others wait for its crops
+        with group_lock:
+            state = group_fetches.get(group["tile_id"])
+            owner = state is None
+            if owner: state = group_fetches[group["tile_id"]] = {"ready": threading.Event()}
+        if owner:
+            try: state["paths"], _ = fetch_planner.fetch_group(group, detect.IMG_DIR, bucket, pool_size=conc["fetch"])
+            except Exception as e: state["error"] = e
+            finally: state["ready"].set()
+        state["ready"].wait()
+        if "error" in state: raise state["error"]
+        return state["paths"]
+
+    def do_fetch(item):
+        if fetch and item['sid'] in group_of:
+            path = fetch_shared(group_of[item['sid']])[item['sid']]
+        elif fetch:
+            path = fetch_pipeline.fetch_tile(item['lat'], item['lon'], item['sid'], detect.IMG_DIR, bucket,
+                                             pool_size=conc["fetch"])
+        else:
+            path = tile_archive.find(item['sid'], detect.IMG_DIR)
+            if path is None: raise FileNotFoundError(f"no tile for {item['sid']}")
+        item['img_path'] = path
+        return item
+
+    def do_decode(item):
+        # A memoryview straight out of the archive mmap for archived tiles
+        raw = tile_archive.read_bytes(item['img_path'])
+        if raw is None: raise FileNotFoundError(item['img_path'])
+        site_data = {'lat': item['lat'], 'lon': item['lon']}
+        item['site_data'] = site_data
+        item['image_hash'] = hashlib.sha256(raw).hexdigest()
+        item['entry'] = detect.manifest_entry(item['image_hash'], config_hash, site_data)
+        up_to_date = manifest["sites"].get(item['sid']) == item['entry'] and item['sid'] in stored
+        if up_to_date and not force:
+            skipped.append(item['sid'])
+            if on_site: on_site(item['sid'], "skipped", None)
+            return None
+        # Only the decision changed: re-decide from the stored raw detections, no decode or inference
+        stored_raw = results_store.get_raw_detections([item['sid']]).get(item['sid']) if detect.REUSE_RAW else None
+        if detect.raw_current(stored_raw, item['image_hash'], raw_keys):
+            item['rec'], item['det'] = detect.site_from_raw(item['sid'], site_data, stored_raw, item['img_path'], item['image_hash'])
+            item['reused'] = True
+            return item
+        item['img'] = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if item['img'] is None: raise RuntimeError("undecodable image")
+        return item
+
+    def do_quality(item):
+        if item.get('reused'): return item
+        item['quality'] = detect.check_image_quality(item['img'])
+        return item
+
+    def do_infer(batch):
+        # Tiles rejected by the quality gate skip the model
+        usable = [item for item in batch if not item.get('reused') and item['quality'][0]]
+        for item in batch:
+            if not item.get('reused'): item['xyxy'], item['confs'] = detect.no_detections()
+        nonlocal model
+        crops = detect.shared_crops([(i['sid'], i['img_path'], i['site_data'], i['entry']) for i in usable]) if usable else {}
+        tiles = {}
+        for tid in {crops[i['sid']][0] for i in usable if i['sid'] in crops} - set(shared_dets):
+            tiles[tid] = fetch_planner.load_shared(tid)
+        # Sites whose shared tile is no longer archived are inferred on their own crop
+        from_shared = lambda i: i['sid'] in crops and tiles.get(crops[i['sid']][0], True) is not None
+        on_shared = [i for i in usable if from_shared(i)]
+        usable = [i for i in usable if not from_shared(i)]
+        # Loaded on the first batch that needs it, so a run of unchanged sites never loads it
+        if model is None and (usable or any(img is not None for img in tiles.values())): model = detect.load_model()
+        if detect.CASCADE and usable:
+            # Stage 1 drops tiles with no signal near the centre; a sample of those still runs in full
+            t1 = time.perf_counter()
+            scores = detect.cascade_scores(model, [item['img'] for item in usable], [detect.get_meters_per_pixel(item['lat']) for item in usable])
+            METRICS.observe("cascade_stage1", time.perf_counter() - t1)
+            METRICS.inc("cascade_checked", len(usable))
+            passed = []
+            for item, score in zip(usable, scores):
+                if score >= detect.CASCADE_SETTINGS["threshold"]:
+                    passed.append(item)
+                    METRICS.inc("cascade_passed")
+                elif cascade.audit_pick(item['sid'], detect.CASCADE_SETTINGS["audit_rate"]):
+                    passed.append(item)
+                    item['audited'] = True
+                    METRICS.inc("cascade_audited")
+                else: item['screen_score'] = score
+            usable = passed
+        if usable:
+            for item, det in zip(usable, detect.predict_batch(model, [item['img'] for item in usable])):
+                item['xyxy'], item['confs'] = det
+        needed = sorted(t for t, img in tiles.items() if img is not None)
+        if needed:
+            for tid, det in zip(needed, detect.predict_batch(model, [tiles[t] for t in needed], imgsz=fetch_planner.SHARED_PX)):
+                shared_dets[tid] = det
+            METRICS.inc("shared_tile_inferences", len(needed))
+        for item in on_shared:
+            tid, dx, dy = crops[item['sid']]
+            shared_dets.move_to_end(tid)
+            item['xyxy'], item['confs'] = detect.crop_detections(*shared_dets[tid], dx, dy)
+            METRICS.inc("shared_tile_sites")
+        while len(shared_dets) > SHARED_DET_CACHE: shared_dets.popitem(last=False)
+        return batch
+
+    def do_post(item):
+        if item.get('reused'): return item
+        img = item['img']
+        h, w = img.shape[:2]
+        scale = detect.get_meters_per_pixel(item['lat'])
+        is_usable, quality_note = item['quality']
+        candidates, geo = detect.filter_candidates(item['xyxy'], item['confs'], w, h, scale)
+        screen_score = item.get('screen_score')
+        notes = [detect.cascade_note(screen_score)] if screen_score is not None else None
+        item['rec'] = detect.build_record(item['sid'], item['site_data'], is_usable, quality_note, candidates, geo, notes)
+        if item.get('audited') and item['rec']['has_solar']: METRICS.inc("cascade_audit_misses")
+        item['det'] = detect.detection_row(item['sid'], item['img_path'], item['image_hash'], w, h, scale, candidates, item['rec'])
+        if render: overlay.write_overlay(item['sid'], img, item['det'])
+        item['raw'] = detect.raw_row(item['sid'], item['image_hash'], img, item['quality'], item['xyxy'], item['confs'], raw_keys, screen_score)
+        del item['img'], item['xyxy'], item['confs']
+        return item
+
+    def do_write(batch):
+        detect.save_results([item['rec'] for item in batch], [item['det'] for item in batch],
+                            [item['raw'] for item in batch if 'raw' in item])
+        return [{"sid": item['sid'], "entry": item['entry']} for item in batch]
+
+    def on_error(sid, stage, err):
+        print(f"   ❌ {sid} failed in {stage}: {err}")
+        if on_site: on_site(sid, "failed", f"{stage}: {err}")
+
+    qs = [queue.Queue(maxsize=QUEUE_DEPTH) for _ in range(7)]
+    stages = [
+        Stage("fetch", do_fetch, qs[0], qs[1], conc["fetch"], errors, on_error),
+        Stage("decode", do_decode, qs[1], qs[2], conc["decode"], errors, on_error),
+        Stage("quality", do_quality, qs[2], qs[3], conc["quality"], errors, on_error),
+        BatchStage("infer", do_infer, qs[3], qs[4], batch_size, errors, on_error),
+        Stage("post", do_post, qs[4], qs[5], conc["post"], errors, on_error),
+        BatchStage("write", do_write, qs[5], qs[6], WRITE_BATCH, errors, on_error),
+    ]
+    for s in stages: s.start()
+
+    def feed():
+        try:
+            for window in windows():
+                for lat, lon, sid in ordered(window):
+                    if cancel is not None and cancel.is_set(): return
+                    qs[0].put({"sid": sid, "lat": lat, "lon": lon})
+        except Exception as e:
+            print(f"   ❌ Reading sites failed: {e}")
+            errors.append((None, "feed", str(e)))
+        finally:
+            qs[0].put(_DONE)
+    threading.Thread(target=feed, daemon=True).start()
+
+    processed = []
+    checkpoint = detect.ManifestCheckpoint(manifest)
+    while True:
+        item = qs[-1].get()
+        if item is _DONE: break
+        checkpoint.add(item['sid'], item['entry'])
+        processed.append(item['sid'])
+        if on_site: on_site(item['sid'], "done", None)
+        if progress: progress(len(processed) + len(skipped) + len(errors), total)
+    checkpoint.flush()
+
+    wall = time.perf_counter() - t_start
+    METRICS.inc("sites_processed", len(processed))
+    METRICS.inc("sites_skipped", len(skipped))
+    METRICS.set_gauge("images_per_second", round(len(processed) / wall, 3) if wall > 0 else 0)
+    quality = detect.quality_gate_report()
+    cascade_stats = detect.cascade_report() if detect.CASCADE else None
+    METRICS.write("stream")
+    summary = {
+        "processed": processed, "skipped": skipped, "errors": errors,
+        "wall_s": round(wall, 2), "quality_gate": quality, "cascade": cascade_stats, "fetch_plan": fetch_plan, "cancelled": bool(cancel is not None and cancel.is_set()),
+        "stages": {s.name: {"items": s.items, "busy_s": round(s.busy_s, 2), "workers": s.workers} for s in stages},
+    }
+    print(f"✅ Stream done: {len(processed)} processed, {len(skipped)} unchanged, {len(errors)} failed in {wall:.1f}s")
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+    import coord_store
+    parser = argparse.ArgumentParser(description="SūryaNetra streaming fetch → detect pipeline")
+    parser.add_argument("coords", nargs="?", default=detect.COORD_FILE, help="CSV / Parquet / xlsx file with sample_id, latitude, longitude")
+    parser.add_argument("--no-fetch", action="store_true", help="Use tiles already in the tile archive / output/images")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=detect.BATCH_SIZE)
+    parser.add_argument("--render-overlays", action="store_true", help="Draw audit overlays now instead of on first view")
+    args = parser.parse_args()
+    coord_store.ingest(args.coords)
+    summary = run_stream(coord_store.iter_sites(source=args.coords), fetch=not args.no_fetch,
+                         force=args.force, batch_size=args.batch_size, render=args.render_overlays)
+    print(json.dumps(summary.get("stages", {}), indent=2))
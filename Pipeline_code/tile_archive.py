@@ -0,0 +1,255 @@
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+
+import sqlite_journal
+
+try: import fcntl
+except ImportError: fcntl = None   # Windows: appends are still serialized within the process
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARCHIVE_DIR = os.path.join(BASE_DIR, "output", "tiles")
+REF_PREFIX = "archive://"   # image references that live in the archive rather than on disk
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    sample_id TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+# compact() writes the packed tiles to a new data file and bumps `generation`
+# in the same transaction as the new offsets, so a reader in another process
+# always pairs an offset with the file it belongs to.
+GEN_SQL = "(SELECT value FROM meta WHERE key = 'generation')"
+
+def sniff_format(data):
+    head = bytes(data[:12])
+    if head.startswith(b"\x89PNG"): return "png"
+    if head.startswith(b"\xff\xd8"): return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "webp"
+    return "bin"
+
+def is_ref(ref):
+    return isinstance(ref, str) and ref.startswith(REF_PREFIX)
+
+def ref_for(sample_id):
+    return f"{REF_PREFIX}{sample_id}"
+
+class TileArchive:
+    """
+    One append-only data file (tiles.dat) holding the original Static Maps
+    response bytes, plus a SQLite index of sample_id -> offset/length/format/sha256.
+    Reads slice a shared read-only mmap, so pulling a tile is an index lookup and
+    a memoryview with no open()/stat() per site. Re-fetched sites append a new
+    copy and repoint the index; compact() reclaims the dead bytes into a new
+    data file generation.
+    """
+    def __init__(self, archive_dir=None):
+        self.archive_dir = archive_dir or ARCHIVE_DIR
+        self.index_path = os.path.join(self.archive_dir, "tiles.idx.db")
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.mm = None
+        self.mm_gen = None
+
+    def data_file(self, gen):
+        return os.path.join(self.archive_dir, "tiles.dat" if not gen else f"tiles.{gen}.dat")
+
+    def generation(self):
+        row = self._conn().execute(f"SELECT {GEN_SQL}").fetchone()
+        return row[0] or 0
+
+    @property
+    def data_path(self):
+        return self.data_file(self.generation())
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            sqlite_journal.apply(conn, self.index_path)
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def put(self, sample_id, data):
+        """
+        Appends the raw bytes for a site (skipped when identical bytes are already
+        indexed). Returns the archive reference for the tile.
+        """
+        sample_id = str(sample_id)
+        digest = hashlib.sha256(data).hexdigest()
+        conn = self._conn()
+        row = conn.execute("SELECT sha256 FROM tiles WHERE sample_id = ?", (sample_id,)).fetchone()
+        if row and row[0] == digest: return ref_for(sample_id)
+        with self.lock:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            with open(self.data_file(self.generation()), "ab") as f:
+                # The flock keeps appends from several processes from interleaving
+                if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(data)
+                    f.flush()
+                finally:
+                    if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)",
+                         (sample_id, offset, len(data), sniff_format(data), digest, time.time()))
+        return ref_for(sample_id)
+
+    def _map(self, gen, end):
+        with self.lock:
+            if self.mm is None or self.mm_gen != gen or len(self.mm) < end:
+                # Older maps stay alive for as long as memoryviews into them do
+                with open(self.data_file(gen), "rb") as f: self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mm_gen = gen
+            return self.mm
+
+    def entry(self, sample_id):
+        """
+        (offset, length, format, sha256) for a site, or None.
+        """
+        return self._conn().execute("SELECT offset, length, format, sha256 FROM tiles WHERE sample_id = ?",
+                                    (str(sample_id),)).fetchone()
+
+    def get(self, sample_id):
+        """
+        Zero-copy memoryview of the stored bytes, or None.
+        """
+        q = f"SELECT offset, length, {GEN_SQL} FROM tiles WHERE sample_id = ?"
+        for attempt in range(2):
+            e = self._conn().execute(q, (str(sample_id),)).fetchone()
+            if e is None: return None
+            offset, length, gen = e[0], e[1], e[2] or 0
+            try: return memoryview(self._map(gen, offset + length))[offset:offset + length]
+            except FileNotFoundError:
+                # A compaction retired that generation between the lookup and the map; look again
+                if attempt: raise
+
+    def has(self, sample_id):
+        return self.entry(sample_id) is not None
+
+    def ids(self):
+        return {r[0] for r in self._conn().execute("SELECT sample_id FROM tiles")}
+
+    def hashes(self, sample_ids=None):
+        """
+        {sample_id: sha256} straight from the index, so callers never re-hash tiles.
+        """
+        conn = self._conn()
+        if sample_ids is None: return dict(conn.execute("SELECT sample_id, sha256 FROM tiles"))
+        ids, out = list({str(s) for s in sample_ids}), {}
+        for i in range(0, len(ids), 900):   # stay under SQLite's bound-parameter limit
+            chunk = ids[i:i + 900]
+            out.update(conn.execute(f"SELECT sample_id, sha256 FROM tiles WHERE sample_id IN ({','.join('?' * len(chunk))})", chunk))
+        return out
+
+    def stats(self):
+        n, live = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM tiles").fetchone()
+        path = self.data_path
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        return {"tiles": n, "live_bytes": live, "file_bytes": size, "dead_bytes": size - live}
+
+    def compact(self):
+        """
+        Copies only the indexed tiles into the next generation's data file and
+        switches the index over to it. Readers in other processes pick up the
+        new generation on their next lookup; the old file is then removed
+        (open maps of it stay valid). Run while nothing else is writing.
+        """
+        gen = self.generation()
+        old_path, new_path = self.data_file(gen), self.data_file(gen + 1)
+        if not os.path.exists(old_path): return 0
+        conn = self._conn()
+        rows = conn.execute("SELECT sample_id, offset, length FROM tiles ORDER BY offset").fetchall()
+        moved = []
+        with self.lock, open(old_path, "rb") as src, open(new_path, "wb") as dst:
+            for sid, offset, length in rows:
+                src.seek(offset)
+                moved.append((dst.tell(), sid))
+                dst.write(src.read(length))
+            dst.flush()
+            os.fsync(dst.fileno())
+        before = os.path.getsize(old_path)
+        with conn:
+            conn.executemany("UPDATE tiles SET offset = ? WHERE sample_id = ?", moved)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (gen + 1,))
+        os.remove(old_path)
+        return before - os.path.getsize(new_path)
+
+ARCHIVE = TileArchive()
+
+def find(sample_id, img_dir):
+    """
+    Reference for a site's tile: the archive entry if there is one, else a PNG/JPG in img_dir, else None.
+    """
+    if ARCHIVE.has(sample_id): return ref_for(sample_id)
+    for ext in (".png", ".jpg"):
+        path = os.path.join(img_dir, f"{sample_id}{ext}")
+        if os.path.exists(path): return path
+    return None
+
+def read_bytes(ref):
+    """
+    Encoded tile bytes for an archive reference (a memoryview) or a file path.
+    """
+    if is_ref(ref): return ARCHIVE.get(ref[len(REF_PREFIX):])
+    try:
+        with open(ref, "rb") as f: return f.read()
+    except OSError: return None
+
+def imread(ref):
+    """
+    cv2.imread that also understands archive references. None if the tile is missing or undecodable.
+    """
+    import cv2
+    import numpy as np
+    if not is_ref(ref): return cv2.imread(ref)
+    data = read_bytes(ref)
+    if data is None: return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SūryaNetra packed tile archive")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_pack = sub.add_parser("pack", help="Append the PNG/JPG tiles in a directory to the archive")
+    p_pack.add_argument("img_dir")
+    p_exp = sub.add_parser("export", help="Write archived tiles back out as files")
+    p_exp.add_argument("out_dir")
+    p_exp.add_argument("sample_ids", nargs="*")
+    sub.add_parser("compact", help="Reclaim space from superseded tiles")
+    sub.add_parser("stats")
+    args = parser.parse_args()
+
+    if args.cmd == "pack":
+        n = 0
+        for e in os.scandir(args.img_dir):
+            sid, ext = os.path.splitext(e.name)
+            if ext.lower() not in (".png", ".jpg"): continue
+            with open(e.path, "rb") as f: ARCHIVE.put(sid, f.read())
+            n += 1
+        print(f"✅ Packed {n} tile(s) into {ARCHIVE.data_path}")
+    elif args.cmd == "export":
+        os.makedirs(args.out_dir, exist_ok=True)
+        sids = args.sample_ids or sorted(ARCHIVE.ids())
+        for sid in sids:
+            data, e = ARCHIVE.get(sid), ARCHIVE.entry(sid)
+            if data is None: print(f"   ⚠️ {sid}: not archived"); continue
+            with open(os.path.join(args.out_dir, f"{sid}.{e[2]}"), "wb") as f: f.write(data)
+        print(f"✅ Exported {len(sids)} tile(s) to {args.out_dir}")
+    elif args.cmd == "compact": print(f"✅ Reclaimed {ARCHIVE.compact() / 1e6:.1f} MB")
+    elif args.cmd == "stats": print(ARCHIVE.stats())
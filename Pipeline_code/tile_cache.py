@@ -0,0 +1,165 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(BASE_DIR, "output", "tile_cache")
+
+COORD_PRECISION = 6               # decimal places kept in the key (~0.1 m)
+MAX_CACHE_BYTES = 2 * 1024 ** 3   # LRU eviction above this
+CACHE_TTL_S = None                # e.g. 90 * 86400 to refetch imagery older than 90 days
+REF_EXT = ".ref"                  # entries that point at a tile already stored elsewhere (the tile archive)
+
+def materialize(src, dest):
+    """
+    Places `src` at `dest` by hardlink, falling back to a copy across filesystems.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest): return dest
+        os.remove(dest)
+    try: os.link(src, dest)
+    except OSError: shutil.copyfile(src, dest)
+    return dest
+
+class TileCache:
+    """
+    Coordinate-keyed tile store: the key hashes the rounded request coordinates,
+    zoom, size and map type, not the tile bytes. An entry is either the tile
+    file itself or, via put_ref, a short reference to where the bytes already
+    live, so archived tiles are not stored twice. Recency lives in each file's
+    atime (bumped on every hit) and age in its mtime, so several processes can
+    share one cache directory without an index file.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, ttl=CACHE_TTL_S, precision=COORD_PRECISION):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.size_bytes = None
+        self.hits = self.misses = self.expired = self.evictions = 0
+
+    def key(self, lat, lon, zoom, size, map_type):
+        p = self.precision
+        raw = f"{round(float(lat), p):.{p}f},{round(float(lon), p):.{p}f}|{zoom}|{size}|{map_type}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def path(self, key, ext=".png"):
+        return os.path.join(self.cache_dir, key[:2], f"{key}{ext}")
+
+    def get(self, key, ext=".png"):
+        """
+        Returns the cached file path for `key`, or None on a miss.
+        """
+        path = self.path(key, ext)
+        try: st = os.stat(path)
+        except FileNotFoundError:
+            with self.lock: self.misses += 1
+            return None
+        now = time.time()
+        if self.ttl is not None and now - st.st_mtime > self.ttl:
+            self._remove(path, st.st_size)
+            with self.lock:
+                self.expired += 1
+                self.misses += 1
+            return None
+        os.utime(path, (now, st.st_mtime))
+        with self.lock: self.hits += 1
+        return path
+
+    def put(self, key, src):
+        """
+        Adds the file at `src` to the cache (hardlinked when possible).
+        """
+        path = self.path(key)
+        old = self._size(path)
+        materialize(src, path)
+        return self._added(path, old)
+
+    def put_bytes(self, key, data, ext=".png"):
+        """
+        Adds raw tile bytes to the cache.
+        """
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f: f.write(data)
+        old = self._size(path)
+        os.replace(tmp_path, path)
+        return self._added(path, old)
+
+    def put_ref(self, key, ref):
+        """
+        Records where the tile for `key` is stored instead of a copy of its bytes.
+        """
+        return self.put_bytes(key, ref.encode(), REF_EXT)
+
+    def get_ref(self, key):
+        path = self.get(key, REF_EXT)
+        if path is None: return None
+        with open(path) as f: return f.read()
+
+    @staticmethod
+    def _size(path):
+        try: return os.path.getsize(path)
+        except OSError: return 0
+
+    def _added(self, path, old=0):
+        # `old` is the size of the entry this write replaced, already counted in size_bytes
+        now = time.time()
+        os.utime(path, (now, now))
+        with self.lock:
+            if self.size_bytes is None: self.size_bytes = self._scan_size()
+            else: self.size_bytes += os.path.getsize(path) - old
+            over = self.size_bytes > self.max_bytes
+        if over: self.evict()
+        return path
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir): return []
+        entries = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir(): continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith((".png", REF_EXT)):
+                    st = e.stat()
+                    entries.append((st.st_atime, st.st_size, e.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _remove(self, path, size):
+        try: os.remove(path)
+        except FileNotFoundError: return
+        with self.lock:
+            if self.size_bytes is not None: self.size_bytes -= size
+
+    def evict(self):
+        """
+        Drops least-recently-used tiles until the cache is back under 90% of max_bytes.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target: break
+            try: os.remove(path)
+            except FileNotFoundError: continue
+            total -= size
+            removed += 1
+        with self.lock:
+            self.size_bytes = total
+            self.evictions += removed
+        return removed
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "expired": self.expired,
+                    "evictions": self.evictions, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "size_bytes": self.size_bytes}